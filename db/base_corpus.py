@@ -10,11 +10,15 @@ from __future__ import print_function
 
 import os
 import re
+import time
 import unicodedata
 import uuid
+from contextlib import contextmanager
 
 import six
 
+from db.object_cache import ObjectCache
+from db.record_codec import DEFAULT_CODEC, checkCodec
 from proc.general_utils import (AttributeDict, normalizeTitle, removeSymbols)
 from scidoc.citation_utils import getAuthorNamesAsOneString, isSameFirstAuthor, getOverlappingAuthors
 from scidoc.scidoc import SciDoc
@@ -92,6 +96,31 @@ class BaseReferenceMatcher(object):
         ##                            return doc_meta
         return None
 
+    def paperUpdated(self, metadata):
+        """
+            Called by the corpus when a paper is added or updated. Matchers
+            that keep their own index of the papers should update it here.
+
+            :param metadata: the paper's metadata. May be partial: only the
+                fields being changed, plus the guid
+        """
+        pass
+
+    def papersDeleted(self, guids=None):
+        """
+            Called by the corpus when papers are deleted
+
+            :param guids: list of guids, or None if all papers were deleted
+        """
+        pass
+
+    def writesRolledBack(self):
+        """
+            Called by the corpus when a transaction is rolled back: any paper
+            may be back to what it was before the transaction.
+        """
+        pass
+
 
 class DefaultReferenceMatcher(BaseReferenceMatcher):
     """
@@ -144,6 +173,198 @@ class DefaultReferenceMatcher(BaseReferenceMatcher):
         return None
 
 
+class IndexedReferenceMatcher(DefaultReferenceMatcher):
+    """
+        Same matching as DefaultReferenceMatcher, but the lookups are done in
+        an in-memory index of the papers table instead of running up to five
+        queries per reference:
+
+            doi -> [guid]
+            corpus_id -> [guid]
+            norm_title -> [(guid, lowercase surnames)]
+
+        If several papers have the same doi or corpus_id, the one indexed
+        first is returned.
+
+        The index is built with a single scroll through the papers, the first
+        time a reference is matched or when build() is called. Only matches
+        hit the DB, to return the paper's full metadata (which is cached by the
+        corpus).
+
+        Papers added, updated or deleted through the corpus this matcher is
+        attached to are kept up to date in the index. Papers written by other
+        processes aren't: call refresh() with their guids, or build() again.
+    """
+
+    LOOKUP_FIELDS = ["guid", "doi", "corpus_id", "norm_title", "surnames"]
+
+    def __init__(self, corpus):
+        super(IndexedReferenceMatcher, self).__init__(corpus)
+        self.built = False
+        self.clear()
+
+    def clear(self):
+        self.by_doi = {}
+        self.by_corpus_id = {}
+        self.by_norm_title = {}
+        # guid -> the values it is indexed under, so that they can be removed
+        self.entries = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def build(self, conditions=None):
+        """
+            (Re)builds the index from the papers in the corpus
+
+            :param conditions: optional, only index the papers that match
+        """
+        self.corpus.checkConnectedToDB()
+        self.clear()
+        for metadata in self.corpus.iterPapersMetadata(conditions, fields=self.LOOKUP_FIELDS):
+            if metadata:
+                self.addPaper(metadata)
+        self.built = True
+
+    def refresh(self, guids=None):
+        """
+            Reloads the given papers from the corpus, removing those that no
+            longer exist. With no guids, rebuilds the whole index.
+        """
+        if guids is None:
+            self.build()
+            return
+
+        guids = list(guids)
+        for guid, metadata in zip(guids, self.corpus.getMetadataByGUIDs(guids)):
+            if metadata:
+                self.addPaper(metadata)
+            else:
+                self.removePaper(guid)
+
+    @staticmethod
+    def _lookupValue(value):
+        if value in ["", None]:
+            return None
+        return six.text_type(value)
+
+    def addPaper(self, metadata):
+        """
+            Adds or updates a paper in the index. Fields missing from metadata
+            keep their previous values, so partial updates can be passed too.
+        """
+        guid = metadata["guid"]
+        old = self.entries.get(guid)
+        new = dict(old) if old is not None else {}
+
+        for field in ["doi", "corpus_id", "norm_title"]:
+            if field in metadata:
+                new[field] = self._lookupValue(metadata[field])
+        if "surnames" in metadata:
+            new["surnames"] = tuple([surname.lower() for surname in metadata["surnames"] or [] if surname])
+
+        if old is not None:
+            if new == old:
+                return
+            self.removePaper(guid)
+
+        if new.get("doi"):
+            self.by_doi.setdefault(new["doi"], []).append(guid)
+        if new.get("corpus_id"):
+            self.by_corpus_id.setdefault(new["corpus_id"], []).append(guid)
+        if new.get("norm_title"):
+            self.by_norm_title.setdefault(new["norm_title"], []).append((guid, new.get("surnames", ())))
+        self.entries[guid] = new
+
+    def removePaper(self, guid):
+        """
+            Removes a paper from the index, if it's there
+        """
+        old = self.entries.pop(guid, None)
+        if old is None:
+            return
+
+        # if other papers have the same id, the next one takes its place
+        for lookup, field in [(self.by_doi, "doi"), (self.by_corpus_id, "corpus_id")]:
+            if old.get(field):
+                guids = [other for other in lookup.get(old[field], []) if other != guid]
+                if guids:
+                    lookup[old[field]] = guids
+                else:
+                    lookup.pop(old[field], None)
+
+        if old.get("norm_title"):
+            papers = [paper for paper in self.by_norm_title.get(old["norm_title"], []) if paper[0] != guid]
+            if papers:
+                self.by_norm_title[old["norm_title"]] = papers
+            else:
+                self.by_norm_title.pop(old["norm_title"], None)
+
+    def paperUpdated(self, metadata):
+        if self.built:
+            self.addPaper(metadata)
+
+    def papersDeleted(self, guids=None):
+        if guids is None:
+            self.clear()
+        elif self.built:
+            for guid in guids:
+                self.removePaper(guid)
+
+    def writesRolledBack(self):
+        # rebuilt from the DB the next time a reference is matched
+        self.clear()
+        self.built = False
+
+    def matchGUID(self, ref):
+        """
+            Returns the guid of the paper in the index that matches the
+            reference, or None
+        """
+        if not self.built:
+            self.build()
+
+        for ref_field, lookup in [("doi", self.by_doi), ("pmid", self.by_corpus_id),
+                                  ("corpus_id", self.by_corpus_id), ("guid", None)]:
+            if ref.get(ref_field, "") not in ["", None]:
+                value = six.text_type(ref[ref_field])
+                # there's an error in the parsing if there's a quotation mark in there
+                if "\"" in value or "\\" in value:
+                    continue
+                if lookup is None:
+                    if value in self.entries:
+                        return value
+                    if value.lower() in self.entries:
+                        return value.lower()
+                elif value in lookup:
+                    return lookup[value][0]
+
+        norm_title = normalizeTitle(ref["title"])
+
+        if not isinstance(norm_title, six.text_type):
+            norm_title = six.text_type(norm_title, errors="ignore")
+
+        ref_surnames = set([surname.lower() for surname in ref.get("surnames", []) if surname])
+        for guid, surnames in self.by_norm_title.get(norm_title, []):
+            # essentially, if ANY surname matches
+            if ref_surnames.intersection(surnames):
+                return guid
+        return None
+
+    def matchReference(self, ref, doc=None):
+        """
+            Returns the metadata of the matching document in the db based on
+            the guid, corpus_id, title and surnames of authors
+
+            :param ref: reference dict
+            :param doc: SciDoc (optional). Only here to enable decendant classes to use
+        """
+        guid = self.matchGUID(ref)
+        if guid is None:
+            return None
+        return self.corpus.getMetadataByGUID(guid)
+
+
 def shouldIgnoreCitation(source_metadata, target_metadata, filter_options):
     """
     If the citation is outside the date range we care about or there are more overlapping authors
@@ -210,6 +431,14 @@ class BaseCorpus(object):
         self.global_counters = {}
         self.AUTO_ADD_AUTHORS = False
         self.query_filter = ""
+        # recently loaded SciDocs and metadata. Disabled until turned on with
+        # setObjectCacheLimits(), as runPipeline() does
+        self.scidoc_cache = ObjectCache(0, 0)
+        self.metadata_cache = ObjectCache(0, 0)
+        # how SciDocs and cached JSON are serialized, see db.record_codec
+        self.record_codec = DEFAULT_CODEC
+        # see loadCitationGraph()
+        self.citation_graph = None
 
     def setPaths(self, root_dir):
         """
@@ -223,6 +452,67 @@ class BaseCorpus(object):
         self.paths.experiments = self.ROOT_DIR + "experiments" + os.sep
         self.paths.output = self.ROOT_DIR + "output" + os.sep
 
+    def setObjectCacheLimits(self, scidoc_items=None, scidoc_bytes=None, metadata_items=None, metadata_bytes=None):
+        """
+            Sets the maximum number of items and approximate size in bytes of
+            the in-memory caches of SciDocs and metadata. 0 disables a cache,
+            both start disabled. Limits that are None are left as they are.
+
+            The caches are per process: if other processes are updating the
+            same papers (e.g. parallel import), disable them.
+        """
+        self.scidoc_cache.setLimits(scidoc_items if scidoc_items is not None else self.scidoc_cache.max_items,
+                                    scidoc_bytes if scidoc_bytes is not None else self.scidoc_cache.max_bytes)
+        self.metadata_cache.setLimits(
+            metadata_items if metadata_items is not None else self.metadata_cache.max_items,
+            metadata_bytes if metadata_bytes is not None else self.metadata_cache.max_bytes)
+
+    def setRecordCodec(self, codec):
+        """
+            Sets the codec new SciDocs and cached JSON are saved with. Records
+            saved with any other codec can still be loaded.
+
+            :param codec: one of db.record_codec.availableCodecs()
+        """
+        checkCodec(codec)
+        self.record_codec = codec
+
+    def getObjectCacheStats(self):
+        """
+            Returns the hit/miss counters and size of the object caches
+        """
+        return {"scidocs": self.scidoc_cache.stats(), "metadata": self.metadata_cache.stats()}
+
+    def getCachedSciDoc(self, guid, ignore_errors=None):
+        """
+            Returns a new SciDoc built from the cached data for guid, or None
+            if it is not in the cache
+        """
+        data = self.scidoc_cache.get(guid)
+        if data is None:
+            return None
+        return SciDoc(data, ignore_errors=ignore_errors)
+
+    def cacheSciDoc(self, guid, doc):
+        """
+            Stores a snapshot of the SciDoc in the cache
+        """
+        self.scidoc_cache.set(guid, doc.data)
+
+    def getCachedMetadata(self, guid):
+        return self.metadata_cache.get(guid)
+
+    def cacheMetadata(self, guid, metadata):
+        self.metadata_cache.set(guid, metadata)
+
+    def invalidateCachedPaper(self, guid):
+        """
+            Removes the paper's SciDoc and metadata from the caches. Called
+            when they are saved.
+        """
+        self.scidoc_cache.invalidate(guid)
+        self.metadata_cache.invalidate(guid)
+
     def connectCorpus(self, base_directory, initializing_corpus=False, suppress_error=False):
         """
             If DB has been created, connect to it. If not, initialize it first.
@@ -297,7 +587,7 @@ class BaseCorpus(object):
         """
 
         res = []
-        for paper_guid in self.listPapers():
+        for paper_guid in self.iterPapers():
             metadata = self.getMetadataByGUID(paper_guid)
             old_outlinks = metadata["outlinks"]
             doc = self.loadSciDoc(metadata["guid"])
@@ -307,7 +597,9 @@ class BaseCorpus(object):
                 res.append(paper_guid)
             metadata["outlinks"] = new_outlinks
             self.updatePaper(metadata)
+            self.updateCitationGraph(paper_guid, new_outlinks, metadata.get("year"))
 
+        self.markLinksChanged(graph_updated=True)
         return res
 
     def listDocInCollectionReferences(self, doc):
@@ -329,6 +621,105 @@ class BaseCorpus(object):
             match = self.matcher.matchReference(ref)
             ref["in_collection"] = True if match else False
 
+    def getCitationGraphPath(self):
+        return os.path.join(self.paths.fileDB, "citation_graph")
+
+    def getLinksStampPath(self):
+        return os.path.join(self.paths.fileDB, "links_stamp.txt")
+
+    def getLinksStamp(self):
+        """
+            Returns the stamp written by the last markLinksChanged(), or None
+        """
+        path = self.getLinksStampPath()
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            return f.read().strip()
+
+    def markLinksChanged(self, graph_updated=False):
+        """
+            Records that the inlinks/outlinks of papers have changed with a new
+            stamp, so that a citation graph saved before the change is rebuilt
+            by loadCitationGraph()
+
+            :param graph_updated: the loaded citation graph was kept up to date
+                with updateCitationGraph() through these changes, so it is
+                current. Otherwise it is unloaded.
+            :returns: the new stamp
+        """
+        stamp = "%s %s" % (time.strftime("%Y-%m-%dT%H:%M:%S"), uuid.uuid4().hex)
+        path = self.getLinksStampPath()
+        if os.path.dirname(path) and not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, "w") as f:
+            f.write(stamp)
+
+        if self.citation_graph is not None:
+            if graph_updated:
+                self.citation_graph.links_stamp = stamp
+            else:
+                self.citation_graph = None
+        return stamp
+
+    def loadCitationGraph(self, path=None, rebuild=False, mmap=True):
+        """
+            Loads the citation graph of the corpus, building it from the papers
+            and saving it first if it doesn't exist or links have changed since
+            it was saved (see markLinksChanged()). Once loaded, it is used by
+            getInlinks() and getOutlinks() and kept up to date by
+            updateCitationGraph().
+
+            :param path: directory of the graph, by default in fileDB
+            :param rebuild: build it even if it exists
+        """
+        from db.citation_graph import CitationGraph
+
+        path = path or self.getCitationGraphPath()
+        stamp = self.getLinksStamp()
+        if not rebuild and CitationGraph.exists(path):
+            self.citation_graph = CitationGraph.load(path, mmap=mmap)
+            if stamp is None or self.citation_graph.links_stamp == stamp:
+                return self.citation_graph
+            print("Links have changed since the citation graph in %s was saved, rebuilding it" % path)
+
+        self.citation_graph = CitationGraph.build(self)
+        self.citation_graph.links_stamp = stamp
+        self.citation_graph.save(path)
+        return self.citation_graph
+
+    def saveCitationGraph(self, path=None):
+        """
+            Saves the changes made to the citation graph since it was loaded
+        """
+        if self.citation_graph is not None:
+            self.citation_graph.save(path or self.getCitationGraphPath())
+
+    def updateCitationGraph(self, guid, outlinks, year=None):
+        """
+            Sets the outlinks of a paper in the citation graph, if one is loaded
+        """
+        if self.citation_graph is not None:
+            self.citation_graph.setOutlinks(guid, outlinks, year)
+
+    def getOutlinks(self, guid):
+        """
+            Returns the guids of the in-collection papers guid cites, from the
+            citation graph if one is loaded
+        """
+        if self.citation_graph is not None and guid in self.citation_graph:
+            return self.citation_graph.outlinks(guid)
+        return self.getMetadataByGUID(guid)["outlinks"]
+
+    def getInlinks(self, guid):
+        """
+            Returns the guids of the in-collection papers that cite guid, from
+            the citation graph if one is loaded
+        """
+        if self.citation_graph is not None and guid in self.citation_graph:
+            return self.citation_graph.inlinks(guid)
+        return self.getMetadataByGUID(guid)["inlinks"]
+
     def listInCollectionReferencesOfList(self, guid_list):
         """
             Will return all in-collection references of all the files in the list
@@ -336,7 +727,7 @@ class BaseCorpus(object):
         res = []
         assert isinstance(guid_list, list)
         for guid in guid_list:
-            res.extend(self.getMetadataByGUID(guid)["outlinks"])
+            res.extend(self.getOutlinks(guid))
         res = list(set(res))
         return res
 
@@ -375,9 +766,10 @@ class BaseCorpus(object):
 
         cit_to_guid = {}
 
+        doc_meta = self.getMetadataByGUID(doc.metadata["guid"])
+
         for ref in doc["references"]:
             match = self.matcher.matchReference(ref, doc)
-            doc_meta=self.getMetadataByGUID(doc.metadata["guid"])
             if match:
                 if not shouldIgnoreCitation(doc_meta, match, filter_options):
                     ref["guid"] = match["guid"]
@@ -553,6 +945,19 @@ class BaseCorpus(object):
         """
         raise NotImplementedError
 
+    def loadCachedJsonMany(self, paths):
+        """
+            Loads many precomputed JSON resources at once. Returns a list with
+            the data for each path, None where it can't be loaded.
+        """
+        res = []
+        for path in paths:
+            try:
+                res.append(self.loadCachedJson(path))
+            except Exception:
+                res.append(None)
+        return res
+
     def deleteCachedJson(self, path):
         """
             Delete precomputed JSON
@@ -571,6 +976,23 @@ class BaseCorpus(object):
         """
         raise NotImplementedError
 
+    def loadSciDocs(self, guids, ignore_errors=None):
+        """
+            Loads many SciDocs at once. Returns a list with a SciDoc for each
+            guid, None where it can't be loaded. Descendant classes should
+            override this if they can fetch many records in one request.
+        """
+        res = []
+        for guid in guids:
+            try:
+                if ignore_errors is None:
+                    res.append(self.loadSciDoc(guid))
+                else:
+                    res.append(self.loadSciDoc(guid, ignore_errors=ignore_errors))
+            except Exception:
+                res.append(None)
+        return res
+
     def saveSciDoc(self, doc):
         """
             Saves the document as JSON using the SciDoc's saveToFile method,
@@ -618,6 +1040,19 @@ class BaseCorpus(object):
         """
         raise NotImplementedError
 
+    def getMetadataByGUIDs(self, guids):
+        """
+            Returns a list with the metadata of each paper in guids, None for
+            those that can't be found
+        """
+        res = []
+        for guid in guids:
+            try:
+                res.append(self.getMetadataByGUID(guid))
+            except Exception:
+                res.append(None)
+        return res
+
     def getMetadataByField(self, field, value):
         """
             Returns a single paper's metadata by any field
@@ -636,6 +1071,25 @@ class BaseCorpus(object):
         """
         raise NotImplementedError
 
+    def appendInlink(self, guid, inlink_guid):
+        """
+            Adds inlink_guid to the inlinks of paper guid, if it's not there
+            already. Descendant classes should override this if they can do it
+            without loading the whole record.
+        """
+        metadata = self.getMetadataByGUID(guid)
+        if inlink_guid not in metadata["inlinks"]:
+            metadata["inlinks"].append(inlink_guid)
+            self.updatePaper(metadata)
+
+    @contextmanager
+    def bulkWriting(self, flush_size=None, flush_interval=None):
+        """
+            Context manager for a batch of writes. Here writes are done
+            straight away, descendant classes can buffer them.
+        """
+        yield None
+
     def listPapers(self, conditions=None):
         """
             Return a list of GUIDs in papers table where [conditions]. It's a
@@ -643,6 +1097,45 @@ class BaseCorpus(object):
         """
         raise NotImplementedError
 
+    def iterPapers(self, conditions=None):
+        """
+            Iterates over the GUIDs in papers table where [conditions].
+            Descendant classes should override this if they can stream them
+            instead of listing them all first.
+        """
+        return iter(self.listPapers(conditions) or [])
+
+    def iterPapersMetadata(self, conditions=None, fields=None):
+        """
+            Iterates over the metadata of the papers where [conditions].
+
+            :param fields: optional list of metadata fields. If given, only
+                these fields are needed, and descendant classes may return
+                only them.
+        """
+        for guid in self.iterPapers(conditions):
+            yield self.getMetadataByGUID(guid)
+
+    def useIndexedReferenceMatcher(self, build=True, fuzzy=False):
+        """
+            Replaces the default reference matcher with an
+            IndexedReferenceMatcher, unless another kind of matcher has been
+            set. Worth it when matching the references of many papers.
+
+            :param build: build the index now instead of on the first match
+            :param fuzzy: use a FuzzyReferenceMatcher, which also matches
+                references with slightly different titles
+        """
+        if fuzzy:
+            from db.fuzzy_matcher import FuzzyReferenceMatcher
+            if type(self.matcher) in [DefaultReferenceMatcher, IndexedReferenceMatcher]:
+                self.matcher = FuzzyReferenceMatcher(self)
+        elif type(self.matcher) == DefaultReferenceMatcher:
+            self.matcher = IndexedReferenceMatcher(self)
+        if build and isinstance(self.matcher, IndexedReferenceMatcher) and not self.matcher.built:
+            self.matcher.build()
+        return self.matcher
+
     def runSingleValueQuery(self, query):
         raise NotImplementedError
 
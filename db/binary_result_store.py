@@ -0,0 +1,437 @@
+# Compact binary storage for precomputed retrieval results (prr_* tables)
+#
+# Copyright:   (c) Daniel Duma 2018
+# Author: Daniel Duma <danielduma@gmail.com>
+
+# For license information, see LICENSE.TXT
+
+from __future__ import print_function
+
+from __future__ import absolute_import
+import json, os, struct, sys
+
+import numpy as np
+import six
+from six.moves import range
+
+from db.result_store import ResultIncrementalReader, OfflineResultReader
+from retrieval.compiled_formula import (CompiledFormulaSet, OP_HIT, OP_CONST, OP_SUM, OP_PROD, OP_MAX,
+                                        EMPTY_NODE_VALUES)
+
+BINARY_RESULTS_MAGIC = b"PRRBIN01"
+BINARY_RESULTS_EXTENSION = ".prrbin"
+# every array in the file starts at a multiple of this
+ARRAY_ALIGNMENT = 64
+
+# kinds of node stored in the file. Unlike the opcodes of CompiledFormulaSet,
+# these keep enough information to rebuild the original formula dicts
+KIND_HIT = 0
+KIND_CONST = 1
+KIND_COORD = 2
+KIND_SUM = 3
+KIND_PROD = 4
+KIND_MAX = 5
+KIND_NO_MATCH = 6
+
+OPERATION_KINDS = {"+": KIND_SUM, "*": KIND_PROD, "max": KIND_MAX}
+KIND_OPERATIONS = {KIND_SUM: "+", KIND_PROD: "*", KIND_MAX: "max"}
+KIND_TO_OPCODE = np.array([OP_HIT, OP_CONST, OP_CONST, OP_SUM, OP_PROD, OP_MAX, OP_CONST], dtype=np.int8)
+
+# value stored for a missing tf/docFreq/maxDocs/term
+MISSING_VALUE = -1
+
+NODE_ARRAYS = [("kind", np.int8),
+               ("parent", np.int64),
+               ("depth", np.int32),
+               ("value", np.float64),
+               ("field", np.int32),
+               ("qw", np.float64),
+               ("fw", np.float64),
+               ("tf", np.int64),
+               ("doc_freq", np.int64),
+               ("max_docs", np.int64),
+               ("term", np.int32),
+               ("arity", np.int8),
+               ]
+
+
+def getBinaryResultsPath(cache_dir, table_name):
+    """
+        Returns the path of the binary file for a table in a cache directory
+    """
+    return os.path.join(cache_dir, table_name + BINARY_RESULTS_EXTENSION)
+
+
+class BinaryResultWriter(object):
+    """
+        Flattens a list of precomputed results into one file: a JSON header with
+        the metadata of each result, the guids and string tables, followed by
+        the node arrays of every formula in pre-order and the offset index.
+    """
+
+    def __init__(self):
+        self.nodes = {name: [] for name, _ in NODE_ARRAYS}
+        self.fields = []
+        self.field_index = {}
+        self.terms = []
+        self.term_index = {}
+
+        self.res_ids = []
+        self.results = []
+        self.guids = []
+        self.result_formula_offsets = [0]
+        self.formula_node_offsets = [0]
+
+    def stringIndex(self, string, strings, index):
+        """
+            Returns the position of a string in a string table, adding it if new
+        """
+        position = index.get(string)
+        if position is None:
+            position = len(strings)
+            strings.append(string)
+            index[string] = position
+        return position
+
+    def addNode(self, kind, parent, depth, value=0.0, hit=None):
+        """
+            Appends a node, returns its index
+        """
+        nodes = self.nodes
+        nodes["kind"].append(kind)
+        nodes["parent"].append(parent)
+        nodes["depth"].append(depth)
+        nodes["value"].append(value)
+        if hit is None:
+            for name in ["field", "tf", "doc_freq", "max_docs", "term"]:
+                nodes[name].append(MISSING_VALUE)
+            nodes["qw"].append(0.0)
+            nodes["fw"].append(0.0)
+            nodes["arity"].append(0)
+        else:
+            # (field, qw, fw), (field, qw, fw, term), (field, qw, fw, tf, docFreq, maxDocs)
+            # or (field, qw, fw, tf, docFreq, maxDocs, term)
+            nodes["field"].append(self.stringIndex(hit[0], self.fields, self.field_index))
+            nodes["qw"].append(float(hit[1]))
+            nodes["fw"].append(float(hit[2]))
+            if len(hit) >= 6:
+                for name, element in zip(["tf", "doc_freq", "max_docs"], hit[3:6]):
+                    nodes[name].append(MISSING_VALUE if element is None else int(element))
+            else:
+                for name in ["tf", "doc_freq", "max_docs"]:
+                    nodes[name].append(MISSING_VALUE)
+            if len(hit) in [4, 7]:
+                nodes["term"].append(self.stringIndex(hit[-1], self.terms, self.term_index))
+            else:
+                nodes["term"].append(MISSING_VALUE)
+            nodes["arity"].append(len(hit))
+        return len(nodes["kind"]) - 1
+
+    def addPart(self, part, parent, depth):
+        """
+            Recursively flattens a part of a formula
+        """
+        if isinstance(part, tuple) or isinstance(part, list):
+            self.addNode(KIND_HIT, parent, depth, float(part[1]) * float(part[2]), hit=part)
+        elif isinstance(part, dict):
+            if "type" not in part:
+                self.addNode(KIND_NO_MATCH, parent, depth, float(part.get("coord", 0)))
+            elif part["type"] in OPERATION_KINDS:
+                index = self.addNode(OPERATION_KINDS[part["type"]], parent, depth)
+                for sub_part in part["parts"]:
+                    self.addPart(sub_part, index, depth + 1)
+            elif part["type"] == "const":
+                self.addNode(KIND_CONST, parent, depth, float(part["value"]))
+            elif part["type"] == "coord":
+                self.addNode(KIND_COORD, parent, depth, float(part["value"]))
+            else:
+                raise ValueError("Unexpected operation type: %s" % part["type"])
+        else:
+            raise ValueError("Unexpected type %s" % type(part))
+
+    def addResult(self, result, res_id=None):
+        """
+            Adds a precomputed result, as returned by ElasticResultStorer.getResult()
+        """
+        metadata = {key: result[key] for key in result if key != "formulas"}
+        # results that could not be read have no "formulas" and must stay that way
+        metadata["_has_formulas"] = "formulas" in result
+        self.results.append(metadata)
+        self.res_ids.append(res_id if res_id is not None else str(len(self.res_ids)))
+
+        for unique_result in result.get("formulas", []):
+            self.guids.append(unique_result["guid"])
+            self.addPart(unique_result["formula"], -1, 0)
+            self.formula_node_offsets.append(len(self.nodes["kind"]))
+        self.result_formula_offsets.append(len(self.guids))
+
+    def save(self, path):
+        """
+            Writes the file. Layout: magic, uint64 header length, JSON header,
+            then each array aligned to ARRAY_ALIGNMENT bytes.
+        """
+        arrays = [(name, np.array(self.nodes[name], dtype=dtype)) for name, dtype in NODE_ARRAYS]
+        arrays.append(("result_formula_offsets", np.array(self.result_formula_offsets, dtype=np.int64)))
+        arrays.append(("formula_node_offsets", np.array(self.formula_node_offsets, dtype=np.int64)))
+
+        header = {"res_ids": self.res_ids,
+                  "results": self.results,
+                  "guids": self.guids,
+                  "fields": self.fields,
+                  "terms": self.terms,
+                  "arrays": {}}
+
+        # the offsets depend on the length of the header, so they are relative
+        # to the start of the data section
+        position = 0
+        for name, array in arrays:
+            header["arrays"][name] = {"dtype": array.dtype.str, "shape": list(array.shape), "offset": position}
+            position += array.nbytes
+            position += (-position) % ARRAY_ALIGNMENT
+
+        header_bytes = json.dumps(header).encode("utf-8")
+        data_start = len(BINARY_RESULTS_MAGIC) + 8 + len(header_bytes)
+        padding = (-data_start) % ARRAY_ALIGNMENT
+
+        with open(path, "wb") as f:
+            f.write(BINARY_RESULTS_MAGIC)
+            f.write(struct.pack("<Q", len(header_bytes) + padding))
+            f.write(header_bytes)
+            f.write(b" " * padding)
+            for name, array in arrays:
+                f.write(array.tobytes())
+                f.write(b"\0" * ((-array.nbytes) % ARRAY_ALIGNMENT))
+
+
+def writeBinaryResults(results, path, res_ids=None):
+    """
+        Saves any iterable of results (list, ResultDiskReader, etc.) as a binary
+        results file.
+
+        :param res_ids: ids of the results, in the same order. If None and
+            results is a reader, its res_ids are used
+    """
+    if res_ids is None:
+        res_ids = getattr(results, "res_ids", None)
+    writer = BinaryResultWriter()
+    for index, result in enumerate(results):
+        writer.addResult(result, res_ids[index] if res_ids else None)
+    writer.save(path)
+
+
+def convertJsonCacheToBinary(cache_dir, table_name, res_ids=None, output_path=None):
+    """
+        Converts the <cache_dir>/<table_name>/<res_id>.json files written by
+        ResultDiskReader into a single binary file.
+
+        :param res_ids: order of the results. It defines the cross-validation
+            folds, so pass the reader's res_ids to keep them the same. If None,
+            every file in the directory is added
+        :returns: path of the binary file
+    """
+    reader = OfflineResultReader(table_name, cache_dir)
+    if res_ids is not None:
+        reader.res_ids = list(res_ids)
+    if output_path is None:
+        output_path = getBinaryResultsPath(cache_dir, table_name)
+    writeBinaryResults(reader, output_path, reader.res_ids)
+    return output_path
+
+
+class BinaryResultReader(ResultIncrementalReader):
+    """
+        Reads a binary results file. The arrays are memory-mapped and subsets
+        share them, only the list of selected results is copied.
+
+        Same interface as the other readers: __getitem__ returns the result
+        dict with its formulas rebuilt, and compileFormulas() goes straight from
+        the arrays to a CompiledFormulaSet without rebuilding any dicts.
+    """
+
+    def __init__(self, path, res_indices=None, max_results=sys.maxsize, _shared=None):
+        """
+            :param res_indices: positions in the file of the results to hold.
+                Default: all of them, up to max_results
+        """
+        self.path = path
+        if _shared:
+            self.header, self.arrays = _shared
+        else:
+            self.header, self.arrays = self.openFile(path)
+
+        if res_indices is None:
+            res_indices = np.arange(min(len(self.header["results"]), max_results), dtype=np.int64)
+        self.res_indices = np.asarray(res_indices, dtype=np.int64)
+        self.res_ids = [self.header["res_ids"][i] for i in self.res_indices]
+
+    def openFile(self, path):
+        """
+            Reads the header and memory-maps every array
+        """
+        with open(path, "rb") as f:
+            magic = f.read(len(BINARY_RESULTS_MAGIC))
+            if magic != BINARY_RESULTS_MAGIC:
+                raise ValueError("Not a binary results file: %s" % path)
+            header_length = struct.unpack("<Q", f.read(8))[0]
+            header = json.loads(f.read(header_length).decode("utf-8"))
+
+        data_start = len(BINARY_RESULTS_MAGIC) + 8 + header_length
+        arrays = {}
+        for name, info in six.iteritems(header["arrays"]):
+            shape = tuple(info["shape"])
+            if int(np.prod(shape)) == 0:
+                arrays[name] = np.zeros(shape, dtype=np.dtype(info["dtype"]))
+            else:
+                arrays[name] = np.memmap(path, dtype=np.dtype(info["dtype"]), mode="r",
+                                         offset=data_start + info["offset"], shape=shape)
+        return header, arrays
+
+    def __len__(self):
+        return len(self.res_indices)
+
+    def __getitem__(self, index):
+        return self.retrieveItem(self.res_indices[index])
+
+    def __iter__(self):
+        for position in self.res_indices:
+            yield self.retrieveItem(position)
+
+    def subset(self, items):
+        """
+            Selects a subset of the items it holds, returns a new instance with
+            those that shares the same memory-mapped arrays
+        """
+        return BinaryResultReader(self.path, res_indices=self.res_indices[np.asarray(items, dtype=np.int64)],
+                                  _shared=(self.header, self.arrays))
+
+    def retrieveItem(self, position):
+        """
+            Rebuilds the result dict stored at a position of the file
+        """
+        result = dict(self.header["results"][position])
+        if not result.pop("_has_formulas", True):
+            return result
+
+        formula_offsets = self.arrays["formula_node_offsets"]
+        first, last = self.arrays["result_formula_offsets"][position:position + 2]
+        result["formulas"] = [{"guid": self.header["guids"][formula],
+                               "formula": self.buildFormula(formula_offsets[formula], formula_offsets[formula + 1])}
+                              for formula in range(first, last)]
+        return result
+
+    def buildFormula(self, start, end):
+        """
+            Rebuilds the nested dict/tuple formula from its nodes in pre-order
+        """
+        columns = {name: self.arrays[name][start:end].tolist() for name, _ in NODE_ARRAYS}
+        root = None
+        stack = []
+        for node in range(end - start):
+            kind = columns["kind"][node]
+            depth = columns["depth"][node]
+            if kind == KIND_HIT:
+                part = [self.header["fields"][columns["field"][node]], columns["qw"][node], columns["fw"][node]]
+                arity = columns["arity"][node]
+                if arity >= 6:
+                    part.extend([None if columns[name][node] == MISSING_VALUE else columns[name][node]
+                                 for name in ["tf", "doc_freq", "max_docs"]])
+                if arity in [4, 7]:
+                    part.append(self.header["terms"][columns["term"][node]])
+            elif kind in KIND_OPERATIONS:
+                part = {"type": KIND_OPERATIONS[kind], "parts": []}
+            elif kind == KIND_CONST:
+                part = {"type": "const", "value": columns["value"][node]}
+            elif kind == KIND_COORD:
+                part = {"type": "coord", "value": columns["value"][node]}
+            else:
+                part = {"coord": columns["value"][node], "matches": []}
+
+            while stack and stack[-1][0] >= depth:
+                stack.pop()
+            if stack:
+                stack[-1][1]["parts"].append(part)
+            else:
+                root = part
+            if kind in KIND_OPERATIONS:
+                stack.append((depth, part))
+        return root
+
+    def compileFormulas(self):
+        """
+            Builds a CompiledFormulaSet of the formulas of the results held
+            directly from the arrays.
+
+            :returns: tuple (results, guids, offsets, formula_set), where
+                results are the result dicts without formulas and offsets is
+                the index of the first formula of each result
+        """
+        arrays = self.arrays
+        result_offsets = arrays["result_formula_offsets"]
+        formula_offsets = arrays["formula_node_offsets"]
+
+        results = []
+        guids = []
+        offsets = [0]
+        node_slices = []
+        roots = []
+        shifts = []
+        num_nodes = 0
+        for position in self.res_indices:
+            result = dict(self.header["results"][position])
+            if not result.pop("_has_formulas", True):
+                continue
+            results.append(result)
+
+            first, last = result_offsets[position], result_offsets[position + 1]
+            guids.extend(self.header["guids"][first:last])
+            offsets.append(len(guids))
+
+            node_start, node_end = formula_offsets[first], formula_offsets[last]
+            node_slices.append(slice(node_start, node_end))
+            shifts.append((num_nodes - node_start, node_end - node_start))
+            roots.append(np.asarray(formula_offsets[first:last]) + (num_nodes - node_start))
+            num_nodes += node_end - node_start
+
+        def gather(name):
+            parts = [arrays[name][node_slice] for node_slice in node_slices]
+            if len(parts) == 1:
+                return parts[0]
+            if len(parts) == 0:
+                return np.zeros(0, dtype=arrays[name].dtype)
+            return np.concatenate(parts)
+
+        kind = gather("kind")
+        depth = gather("depth")
+        value = np.array(gather("value"), dtype=np.float64)
+        parent = np.array(gather("parent"), dtype=np.int64)
+        if len(shifts) > 0:
+            parent += np.repeat([shift for shift, _ in shifts], [length for _, length in shifts])
+            parent[depth == 0] = -1
+
+        op = KIND_TO_OPCODE[kind]
+        # operations with no parts evaluate to a constant, as in CompiledFormulaSet
+        child_counts = np.bincount(parent[parent >= 0], minlength=len(op))
+        for opcode, empty_value in six.iteritems(EMPTY_NODE_VALUES):
+            empty = (op == opcode) & (child_counts == 0)
+            op[empty] = OP_CONST
+            value[empty] = empty_value
+
+        # only the fields used in these results are columns of the weight vector
+        field = np.array(gather("field"), dtype=np.int32)
+        used_fields = np.unique(field[op == OP_HIT])
+        remap = np.full(len(self.header["fields"]) + 1, -1, dtype=np.int32)
+        remap[used_fields] = np.arange(len(used_fields), dtype=np.int32)
+        field = np.where(op == OP_HIT, remap[field], -1).astype(np.int32)
+
+        formula_set = CompiledFormulaSet([self.header["fields"][index] for index in used_fields])
+        formula_set.setArrays(op, parent, np.asarray(depth, dtype=np.int32), value, field,
+                              np.concatenate(roots) if roots else np.zeros(0, dtype=np.int64))
+        return results, guids, np.array(offsets, dtype=np.int64), formula_set
+
+
+def main():
+    pass
+
+
+if __name__ == '__main__':
+    main()
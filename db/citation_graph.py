@@ -0,0 +1,317 @@
+# Citation graph of the papers in the corpus, as compressed sparse rows
+#
+# Copyright:   (c) Daniel Duma 2018
+# Author: Daniel Duma <danielduma@gmail.com>
+
+# For license information, see LICENSE.TXT
+
+"""
+    The inlinks and outlinks of each paper are stored in its metadata, so
+    walking the graph means loading metadata records one at a time. The
+    CitationGraph keeps the whole graph in a few integer arrays instead:
+
+        out_indptr, out_indices: outlinks of paper i are
+            out_indices[out_indptr[i]:out_indptr[i + 1]]
+        in_indptr, in_indices: the same for inlinks
+
+    plus the guid of each paper id and its year. The arrays are saved as .npy
+    files in a directory and memory-mapped when loaded, so processes that
+    load the same graph share its pages.
+
+    The graph is built from the papers' outlinks; inlinks are derived from
+    them. Changes made with setOutlinks() are kept in a small overlay on top
+    of the arrays until compact() or save() are called.
+
+    links_stamp is saved with the graph: the corpus' stamp of its last change
+    to the links that the graph includes, see BaseCorpus.markLinksChanged().
+"""
+
+from __future__ import absolute_import
+import json
+import os
+from array import array
+
+import numpy as np
+
+YEAR_UNKNOWN = -1
+
+GRAPH_ARRAYS = ["out_indptr", "out_indices", "in_indptr", "in_indices"]
+GRAPH_FORMAT_VERSION = 1
+
+
+def _year(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return YEAR_UNKNOWN
+
+
+def buildCSR(sources, targets, num_nodes):
+    """
+        Returns (indptr, indices) for the edges sources[i] -> targets[i]
+    """
+    sources = np.asarray(sources, dtype=np.int32)
+    targets = np.asarray(targets, dtype=np.int32)
+    order = np.argsort(sources, kind="stable")
+    indptr = np.zeros(num_nodes + 1, dtype=np.int64)
+    np.cumsum(np.bincount(sources, minlength=num_nodes), out=indptr[1:])
+    return indptr, targets[order]
+
+
+class CitationGraph(object):
+    """
+        Compact in-memory citation graph with a guid <-> int id map
+    """
+
+    def __init__(self):
+        self.guids = []
+        self.guid_to_id = {}
+        self.years = array("i")
+        self.out_indptr = np.zeros(1, dtype=np.int64)
+        self.out_indices = np.zeros(0, dtype=np.int32)
+        self.in_indptr = np.zeros(1, dtype=np.int64)
+        self.in_indices = np.zeros(0, dtype=np.int32)
+        # number of papers in the CSR arrays, papers added later only have
+        # rows in the overlay
+        self.base_size = 0
+        self.links_stamp = None
+        self._clearOverlay()
+
+    def _clearOverlay(self):
+        # paper id -> array of outlink ids, replaces its row in the arrays
+        self.overlay_out = {}
+        # paper id -> set of ids of papers in overlay_out that cite it
+        self.overlay_in = {}
+        self._overridden = None
+
+    def __len__(self):
+        return len(self.guids)
+
+    def __contains__(self, guid):
+        return guid in self.guid_to_id
+
+    def addPaper(self, guid, year=None):
+        """
+            Returns the id of the paper, adding it to the graph if needed
+        """
+        paper_id = self.guid_to_id.get(guid)
+        if paper_id is None:
+            paper_id = len(self.guids)
+            self.guids.append(guid)
+            self.guid_to_id[guid] = paper_id
+            self.years.append(_year(year))
+        elif year is not None:
+            self.years[paper_id] = _year(year)
+        return paper_id
+
+    @classmethod
+    def build(cls, corpus, conditions=None):
+        """
+            Builds the graph with one pass over the papers in the corpus
+
+            :param conditions: optional, only include the papers that match
+        """
+        graph = cls()
+        sources = array("i")
+        targets = array("i")
+        for metadata in corpus.iterPapersMetadata(conditions, fields=["guid", "year", "outlinks"]):
+            if not metadata:
+                continue
+            source = graph.addPaper(metadata["guid"], metadata.get("year"))
+            # removes duplicates, keeps the order
+            for target_guid in list(dict.fromkeys(metadata.get("outlinks") or [])):
+                sources.append(source)
+                targets.append(graph.addPaper(target_guid))
+
+        graph._setArrays(sources, targets)
+        return graph
+
+    def _setArrays(self, sources, targets):
+        num_nodes = len(self.guids)
+        self.out_indptr, self.out_indices = buildCSR(sources, targets, num_nodes)
+        self.in_indptr, self.in_indices = buildCSR(targets, sources, num_nodes)
+        self.base_size = num_nodes
+        self._clearOverlay()
+
+    def _baseRow(self, indptr, indices, paper_id):
+        if paper_id >= self.base_size:
+            return indices[:0]
+        return indices[indptr[paper_id]:indptr[paper_id + 1]]
+
+    def outlinkIds(self, paper_id):
+        row = self.overlay_out.get(paper_id)
+        if row is not None:
+            return row
+        return self._baseRow(self.out_indptr, self.out_indices, paper_id)
+
+    def inlinkIds(self, paper_id):
+        row = self._baseRow(self.in_indptr, self.in_indices, paper_id)
+        if self.overlay_out:
+            if self._overridden is None:
+                self._overridden = np.array(sorted(self.overlay_out), dtype=np.int32)
+            row = row[~np.isin(row, self._overridden)]
+            extra = self.overlay_in.get(paper_id)
+            if extra:
+                row = np.concatenate([row, np.array(sorted(extra), dtype=np.int32)])
+        return row
+
+    def setOutlinks(self, guid, outlink_guids, year=None):
+        """
+            Replaces the outlinks of a paper, updating the inlinks of the
+            papers it cites
+        """
+        source = self.addPaper(guid, year)
+        for target in self.outlinkIds(source):
+            if source in self.overlay_in.get(target, ()):
+                self.overlay_in[target].discard(source)
+
+        targets = [self.addPaper(target_guid) for target_guid in dict.fromkeys(outlink_guids or [])]
+        self.overlay_out[source] = np.array(targets, dtype=np.int32)
+        for target in targets:
+            self.overlay_in.setdefault(target, set()).add(source)
+        self._overridden = None
+
+    def compact(self):
+        """
+            Merges the changes in the overlay into the arrays
+        """
+        if not self.overlay_out and self.base_size == len(self.guids):
+            return
+
+        sources = []
+        targets = []
+        for paper_id in range(len(self.guids)):
+            row = self.outlinkIds(paper_id)
+            sources.append(np.full(len(row), paper_id, dtype=np.int32))
+            targets.append(row)
+        self._setArrays(np.concatenate(sources) if sources else [], np.concatenate(targets) if targets else [])
+
+    def _filterByYear(self, ids, min_year=None, max_year=None):
+        if min_year is None and max_year is None:
+            return ids
+        years = np.frombuffer(self.years, dtype=np.int32)[ids]
+        keep = years != YEAR_UNKNOWN
+        if min_year is not None:
+            keep &= years >= min_year
+        if max_year is not None:
+            keep &= years <= max_year
+        return ids[keep]
+
+    def _toGuids(self, ids):
+        return [self.guids[paper_id] for paper_id in ids]
+
+    def outlinks(self, guid, min_year=None, max_year=None):
+        """
+            Returns the guids of the papers cited by guid, optionally only
+            those published between min_year and max_year
+        """
+        paper_id = self.guid_to_id.get(guid)
+        if paper_id is None:
+            return []
+        return self._toGuids(self._filterByYear(self.outlinkIds(paper_id), min_year, max_year))
+
+    def inlinks(self, guid, min_year=None, max_year=None):
+        """
+            Returns the guids of the papers that cite guid, optionally only
+            those published between min_year and max_year
+        """
+        paper_id = self.guid_to_id.get(guid)
+        if paper_id is None:
+            return []
+        return self._toGuids(self._filterByYear(self.inlinkIds(paper_id), min_year, max_year))
+
+    def outDegree(self, guid):
+        paper_id = self.guid_to_id.get(guid)
+        return 0 if paper_id is None else len(self.outlinkIds(paper_id))
+
+    def inDegree(self, guid):
+        paper_id = self.guid_to_id.get(guid)
+        return 0 if paper_id is None else len(self.inlinkIds(paper_id))
+
+    def inDegrees(self):
+        """
+            Returns an array with the number of inlinks of each paper id
+        """
+        self.compact()
+        return np.diff(self.in_indptr)
+
+    def _countNeighbours(self, rows, exclude, max_results):
+        rows = [row for row in rows if len(row)]
+        if not rows:
+            return []
+        counts = np.bincount(np.concatenate(rows), minlength=len(self.guids))
+        counts[exclude] = 0
+        found = np.nonzero(counts)[0]
+        # most frequent first, ties by id so the order is stable
+        found = found[np.lexsort((found, -counts[found]))]
+        if max_results is not None:
+            found = found[:max_results]
+        return [(self.guids[paper_id], int(counts[paper_id])) for paper_id in found]
+
+    def coCitations(self, guid, max_results=None):
+        """
+            Returns [(guid, count)] of the papers cited together with guid,
+            most often co-cited first
+        """
+        paper_id = self.guid_to_id.get(guid)
+        if paper_id is None:
+            return []
+        return self._countNeighbours([self.outlinkIds(source) for source in self.inlinkIds(paper_id)],
+                                     paper_id, max_results)
+
+    def bibliographicCoupling(self, guid, max_results=None):
+        """
+            Returns [(guid, count)] of the papers that cite the same papers
+            as guid, with the number of references they share
+        """
+        paper_id = self.guid_to_id.get(guid)
+        if paper_id is None:
+            return []
+        return self._countNeighbours([self.inlinkIds(target) for target in self.outlinkIds(paper_id)],
+                                     paper_id, max_results)
+
+    def save(self, path):
+        """
+            Saves the graph to a directory, merging any changes first
+        """
+        self.compact()
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        for name in GRAPH_ARRAYS:
+            np.save(os.path.join(path, name + ".npy"), getattr(self, name))
+        np.save(os.path.join(path, "years.npy"), np.frombuffer(self.years, dtype=np.int32))
+        with open(os.path.join(path, "guids.json"), "w") as f:
+            json.dump(self.guids, f)
+        with open(os.path.join(path, "graph.json"), "w") as f:
+            json.dump({"version": GRAPH_FORMAT_VERSION,
+                       "num_papers": len(self.guids),
+                       "num_links": len(self.out_indices),
+                       "links_stamp": self.links_stamp}, f)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """
+            Loads a graph saved with save()
+
+            :param mmap: memory-map the link arrays instead of reading them
+        """
+        with open(os.path.join(path, "graph.json")) as f:
+            info = json.load(f)
+        if info["version"] != GRAPH_FORMAT_VERSION:
+            raise ValueError("Unsupported citation graph version: %s" % info["version"])
+
+        graph = cls()
+        with open(os.path.join(path, "guids.json")) as f:
+            graph.guids = json.load(f)
+        graph.guid_to_id = {guid: paper_id for paper_id, guid in enumerate(graph.guids)}
+        graph.years = array("i", np.load(os.path.join(path, "years.npy")).astype(np.int32).tobytes())
+        for name in GRAPH_ARRAYS:
+            setattr(graph, name, np.load(os.path.join(path, name + ".npy"), mmap_mode="r" if mmap else None))
+        graph.base_size = len(graph.guids)
+        graph.links_stamp = info.get("links_stamp")
+        return graph
+
+    @staticmethod
+    def exists(path):
+        return os.path.exists(os.path.join(path, "graph.json"))
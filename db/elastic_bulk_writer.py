@@ -0,0 +1,173 @@
+# Buffered writes to the corpus indices through the _bulk API
+#
+# Copyright:   (c) Daniel Duma 2018
+# Author: Daniel Duma <danielduma@gmail.com>
+
+# For license information, see LICENSE.TXT
+
+from __future__ import absolute_import
+import logging
+import threading
+import time
+
+from elasticsearch.helpers import bulk, BulkIndexError
+
+from retrieval.concurrent_retrieval import callWithRetries
+
+DEFAULT_FLUSH_SIZE = 500
+DEFAULT_FLUSH_INTERVAL = 10.0  # seconds
+DEFAULT_MAX_RETRIES = 3
+
+# Appends params.guid to a paper's inlinks if it's not there yet, and keeps
+# num_inlinks up to date. Runs on the ES node, so concurrent appends to the
+# same paper from different processes don't overwrite each other.
+SCRIPT_APPEND_INLINK = """
+if (ctx._source.metadata.inlinks == null) { ctx._source.metadata.inlinks = []; }
+if (ctx._source.metadata.inlinks.contains(params.guid)) { ctx.op = 'noop'; }
+else {
+    ctx._source.metadata.inlinks.add(params.guid);
+    ctx._source.num_inlinks = ctx._source.metadata.inlinks.size();
+}
+"""
+
+
+class CorpusBulkWriter(object):
+    """
+        Collects index and update operations on any index and sends them to
+        Elasticsearch in _bulk requests of up to flush_size operations.
+
+        The buffer is also flushed when an operation is added more than
+        flush_interval seconds after the last flush, and on close(). There is
+        no timer thread: an idle writer keeps its buffer until close().
+
+        Operations are sent in the order they were added. Documents in the
+        buffer are not visible to searches or gets until they are flushed.
+        Failed items don't stop the rest of the batch: they are logged and
+        kept in .errors. Thread-safe.
+    """
+
+    def __init__(self, es, flush_size=DEFAULT_FLUSH_SIZE, flush_interval=DEFAULT_FLUSH_INTERVAL,
+                 max_retries=DEFAULT_MAX_RETRIES):
+        self.es = es
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.actions = []
+        self.lock = threading.Lock()
+        self.last_flush = time.time()
+        self.touched_indices = set()
+        self.num_written = 0
+        self.errors = []
+
+    def __len__(self):
+        return len(self.actions)
+
+    def addAction(self, action):
+        """
+            Adds an action in the format of elasticsearch.helpers.bulk, flushes
+            if the buffer is full or it's time
+        """
+        with self.lock:
+            self.actions.append(action)
+            self.touched_indices.add(action["_index"])
+            must_flush = (len(self.actions) >= self.flush_size or
+                          time.time() - self.last_flush >= self.flush_interval)
+        if must_flush:
+            self.flush()
+
+    def index(self, index, doc_type, rec_id, body, op_type="index"):
+        """
+            Buffered equivalent of es.index()
+
+            :param op_type: one of ["index", "create"]
+        """
+        self.addAction({"_op_type": op_type,
+                        "_index": index,
+                        "_type": doc_type,
+                        "_id": rec_id,
+                        "_source": body})
+
+    def update(self, index, doc_type, rec_id, doc, upsert=None):
+        """
+            Buffered partial update: doc is merged into the existing document
+        """
+        action = {"_op_type": "update",
+                  "_index": index,
+                  "_type": doc_type,
+                  "_id": rec_id,
+                  "doc": doc}
+        if upsert is not None:
+            action["upsert"] = upsert
+        self.addAction(action)
+
+    def scriptedUpdate(self, index, doc_type, rec_id, source, params=None, upsert=None, script_key="source"):
+        """
+            Buffered update with a painless script, which can modify the
+            document in place (e.g. append to a list) without reading it first
+
+            :param script_key: "source" from ES 5.6, "inline" for 5.0-5.5
+        """
+        action = {"_op_type": "update",
+                  "_index": index,
+                  "_type": doc_type,
+                  "_id": rec_id,
+                  "script": {script_key: source, "lang": "painless", "params": params or {}}}
+        if upsert is not None:
+            action["upsert"] = upsert
+        self.addAction(action)
+
+    def flush(self):
+        """
+            Sends all the buffered operations
+        """
+        with self.lock:
+            actions = self.actions
+            self.actions = []
+            self.last_flush = time.time()
+
+            if not actions:
+                return
+
+            # 429s for single items are retried by bulk(), connection errors
+            # for the whole request by callWithRetries()
+            success, errors = callWithRetries(bulk, (self.es, actions),
+                                              {"raise_on_error": False,
+                                               "raise_on_exception": False,
+                                               "max_retries": self.max_retries},
+                                              max_retries=self.max_retries)
+            self.num_written += success
+            for error in errors:
+                logging.warning("Error in bulk write: %s" % str(error))
+            self.errors.extend(errors)
+
+    def raiseIfErrors(self):
+        """
+            Raises BulkIndexError if any operation has failed since the last
+            call, so failed writes can't go unnoticed
+        """
+        with self.lock:
+            errors = self.errors
+            self.errors = []
+        if errors:
+            raise BulkIndexError("%d operation(s) failed in bulk writes" % len(errors), errors)
+
+    def refresh(self):
+        """
+            Makes everything written so far visible to searches
+        """
+        if self.touched_indices:
+            self.es.indices.refresh(index=",".join(sorted(self.touched_indices)))
+
+    def close(self, refresh=True):
+        """
+            Flushes the buffer and optionally refreshes the indices written to
+        """
+        self.flush()
+        if refresh:
+            self.refresh()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,167 @@
+# Shared Elasticsearch clients and HTTP sessions
+#
+# Copyright:   (c) Daniel Duma 2018
+# Author: Daniel Duma <danielduma@gmail.com>
+
+# For license information, see LICENSE.TXT
+
+"""
+    Every Elasticsearch client has its own pool of connections, so creating
+    one per result storer or retrieval object means dozens of pools and
+    sockets to the same node. getElasticClient() returns the same client for
+    all the users of an endpoint in a process, and getHTTPSession() a pooled
+    requests.Session for the calls that go to the REST API directly.
+
+    Clients and sessions are per process: a worker forked after the parent
+    created one gets its own, instead of sharing the parent's sockets.
+"""
+
+from __future__ import absolute_import
+import os
+import threading
+
+import requests
+import six
+from elasticsearch import Elasticsearch
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# defaults for all the clients, see configureConnections()
+CONNECTION_OPTIONS = {
+    # max open connections per node, per client
+    "maxsize": 10,
+    # seconds
+    "timeout": 360,
+    "max_retries": 3,
+    "retry_on_timeout": True,
+    # sniffing only makes sense for clusters, and fails behind proxies
+    "sniff_on_start": False,
+    "sniff_on_connection_fail": False,
+    # for the requests session
+    "http_pool_maxsize": 10,
+    "http_max_retries": 3,
+    "http_backoff_factor": 0.5,
+}
+
+_lock = threading.Lock()
+_clients = {}
+_sessions = {}
+
+
+def configureConnections(**options):
+    """
+        Changes the defaults used for new clients and sessions, e.g.
+        configureConnections(maxsize=20, max_retries=5)
+    """
+    for key in options:
+        if key not in CONNECTION_OPTIONS:
+            raise ValueError("Unknown connection option: %s" % key)
+    with _lock:
+        CONNECTION_OPTIONS.update(options)
+
+
+def endpointKey(endpoint):
+    if isinstance(endpoint, dict):
+        return tuple(sorted(endpoint.items()))
+    return endpoint
+
+
+def endpointURL(endpoint):
+    """
+        Returns the base URL of an endpoint given as a dict or a string,
+        ending in "/"
+    """
+    if isinstance(endpoint, six.string_types):
+        url = endpoint
+        if not url.startswith("http"):
+            url = "http://" + url
+    else:
+        url = "http://%s:%d" % (endpoint.get("host", "localhost"), int(endpoint.get("port", 9200)))
+    if not url.endswith("/"):
+        url += "/"
+    return url
+
+
+def getElasticClient(endpoint=None, timeout=None, maxsize=None, http_auth=None, **kwargs):
+    """
+        Returns the shared client for the endpoint, creating it if needed.
+
+        A client is shared by everyone that uses the same endpoint,
+        credentials and retry options. If this call needs a longer timeout or
+        more connections than the current client has, a new client replaces
+        it for later calls (whoever holds the old one can keep using it).
+
+        :param endpoint: {"host", "port"} dict or URL string, localhost:9200
+            by default
+        :param kwargs: other options for Elasticsearch(), override
+            CONNECTION_OPTIONS
+    """
+    endpoint = endpoint or {"host": "localhost", "port": 9200}
+    options = {key: CONNECTION_OPTIONS[key] for key in ["timeout", "maxsize", "max_retries", "retry_on_timeout",
+                                                        "sniff_on_start", "sniff_on_connection_fail"]}
+    if timeout is not None:
+        options["timeout"] = timeout
+    if maxsize is not None:
+        options["maxsize"] = maxsize
+    options.update(kwargs)
+
+    # clients with different retry or sniffing options aren't shared
+    other_options = tuple(sorted([(name, value) for name, value in options.items()
+                                  if name not in ["timeout", "maxsize"]]))
+    key = (os.getpid(), endpointKey(endpoint), endpointKey(http_auth) if http_auth else None, other_options)
+    with _lock:
+        existing = _clients.get(key)
+        if existing is not None:
+            client, client_options = existing
+            if client_options["timeout"] >= options["timeout"] and client_options["maxsize"] >= options["maxsize"]:
+                return client
+            options["timeout"] = max(options["timeout"], client_options["timeout"])
+            options["maxsize"] = max(options["maxsize"], client_options["maxsize"])
+
+        if http_auth:
+            options["http_auth"] = http_auth
+        client = Elasticsearch([endpoint], **options)
+        options.pop("http_auth", None)
+        _clients[key] = (client, options)
+        return client
+
+
+def getHTTPSession():
+    """
+        Returns the shared requests.Session of this process. Its connections
+        are kept alive and reused, and failed connections and 502-504 errors
+        are retried with exponential backoff.
+    """
+    pid = os.getpid()
+    with _lock:
+        session = _sessions.get(pid)
+        if session is None:
+            retry = Retry(total=CONNECTION_OPTIONS["http_max_retries"],
+                          backoff_factor=CONNECTION_OPTIONS["http_backoff_factor"],
+                          status_forcelist=[502, 503, 504],
+                          allowed_methods=None)
+            adapter = HTTPAdapter(pool_connections=CONNECTION_OPTIONS["http_pool_maxsize"],
+                                  pool_maxsize=CONNECTION_OPTIONS["http_pool_maxsize"],
+                                  max_retries=retry)
+            session = requests.Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _sessions[pid] = session
+        return session
+
+
+def closeConnections():
+    """
+        Closes the clients and sessions of this process
+    """
+    pid = os.getpid()
+    with _lock:
+        for key in [key for key in _clients if key[0] == pid]:
+            client, options = _clients.pop(key)
+            try:
+                client.close()
+            except Exception:
+                pass
+        session = _sessions.pop(pid, None)
+        if session is not None:
+            session.close()
@@ -9,18 +9,22 @@ from __future__ import print_function
 
 from __future__ import absolute_import
 import sys, json, datetime, re, copy
+import threading
+from contextlib import contextmanager
 
-from elasticsearch import Elasticsearch
 from elasticsearch.exceptions import ConnectionTimeout, ConnectionError, TransportError
-import requests
 import six.moves.urllib.request, six.moves.urllib.parse, six.moves.urllib.error
 from six import string_types
+from six.moves import queue
 
 from proc.general_utils import ensureTrailingBackslash
 from scidoc.scidoc import SciDoc
 from .base_corpus import BaseCorpus, TABLE_PAPERS, TABLE_CACHE, TABLE_AUTHORS, TABLE_LINKS, TABLE_MISSING_REFERENCES, \
     TABLE_SCIDOCS, TABLE_VENUES
 from proc.doc_sim import DocSimilarity
+from .record_codec import encodeRecord, decodeRecord
+from .elastic_connection import getElasticClient, getHTTPSession, endpointURL
+from .elastic_bulk_writer import CorpusBulkWriter, SCRIPT_APPEND_INLINK, DEFAULT_FLUSH_SIZE, DEFAULT_FLUSH_INTERVAL
 
 ES_INDEX_PAPERS = "papers2"
 ES_INDEX_SCIDOCS = "scidocs"
@@ -72,6 +76,10 @@ ES_ALL_INDECES = [ES_INDEX_PAPERS, ES_INDEX_SCIDOCS, ES_INDEX_CACHE,
 EXCLUDE_INDEX = "exclude_"
 
 DEFAULT_TIMEOUT = 360
+DEFAULT_CONNECTION_POOL_SIZE = 10  # max open connections per ES node
+DEFAULT_MGET_BATCH_SIZE = 200  # max number of records fetched per mget request
+DEFAULT_SCROLL_PAGE_SIZE = 1000
+DEFAULT_SCROLL_SLICES = 4
 
 import logging
 
@@ -80,6 +88,16 @@ logging.getLogger("requests").setLevel(logging.ERROR)
 logging.getLogger("urllib3").setLevel(logging.ERROR)
 
 
+def getTotalHits(res):
+    """
+        Total number of hits of a search response. ES 7 returns a dict.
+    """
+    total = res["hits"]["total"]
+    if isinstance(total, dict):
+        return total["value"]
+    return total
+
+
 def buildMetadataDSLQuery(must=None, should=None):
     if not must and not should:
         return {"query": {"match_all": {}}}
@@ -122,10 +140,19 @@ class ElasticCorpus(BaseCorpus):
         self.paths.fullLuceneIndex = "index_"
         self.max_results = sys.maxsize
         self.es_version = 2
+        # (major, minor) of the server, see getServerVersion()
+        self.server_version = None
         self.use_dsl_queries = False
         self.default_timeout = DEFAULT_TIMEOUT
+        self.connection_pool_size = DEFAULT_CONNECTION_POOL_SIZE
+        self.mget_batch_size = DEFAULT_MGET_BATCH_SIZE
         self.scroll_time = "60m"
         self.doc_sim = DocSimilarity(self)
+        # see bulkWriting()
+        self.bulk_writer = None
+        self.bulk_writing_depth = 0
+        self.bulk_flush_size = DEFAULT_FLUSH_SIZE
+        self.bulk_flush_interval = DEFAULT_FLUSH_INTERVAL
 
     def connectCorpus(self, base_directory, endpoint={"host": "localhost", "port": 9200}, initializing_corpus=False,
                       suppress_error=False, http_auth=None):
@@ -299,6 +326,47 @@ class ElasticCorpus(BaseCorpus):
             raise IndexError("Can't find record with id %s" % rec_id)
         return res["_source"]
 
+    def getRecords(self, rec_ids, table=TABLE_PAPERS, source=None):
+        """
+            Like getRecord() for many records, using one mget request for every
+            mget_batch_size ids.
+
+            :param rec_ids: list of ids of the records
+            :param table: table alias, e.g. [TABLE_PAPERS, TABLE_SCIDOCS]
+            :param source: fields to return
+            :returns: list with the fields of each record, in the same order as
+                rec_ids, None for records that don't exist
+        """
+        self.checkConnectedToDB()
+
+        if table not in index_equivalence:
+            raise ValueError("Unknown record type")
+
+        res = []
+        for start in range(0, len(rec_ids), self.mget_batch_size):
+            batch = list(rec_ids[start:start + self.mget_batch_size])
+            docs = self.es.mget(
+                index=index_equivalence[table]["index"],
+                doc_type=index_equivalence[table]["type"],
+                body={"ids": batch},
+                _source=source
+            )["docs"]
+
+            for doc in docs:
+                if doc.get("found"):
+                    res.append(doc["_source"])
+                else:
+                    res.append(None)
+        return res
+
+    def getRecordFields(self, rec_ids, table=TABLE_PAPERS):
+        """
+            Like getRecordField() for many records. Returns None for records
+            that don't exist.
+        """
+        field = index_equivalence[table]["source"]
+        return [record[field] if record else None for record in self.getRecords(rec_ids, table, source=field)]
+
     def setRecord(self, rec_id, body, table=TABLE_PAPERS, op_type="update"):
         """
             Abstracts over setting getting data for a row in the db.
@@ -312,6 +380,9 @@ class ElasticCorpus(BaseCorpus):
         if table not in index_equivalence:
             raise ValueError("Unknown record type")
 
+        if table in [TABLE_PAPERS, TABLE_SCIDOCS]:
+            self.invalidateCachedPaper(rec_id)
+
         ##~        try:
         if op_type == "update":
             body = {"doc": body}
@@ -368,8 +439,8 @@ class ElasticCorpus(BaseCorpus):
             :type query: string
         """
         url_query = six.moves.urllib.parse.quote(query.encode('utf8'))
-        uri = "http://%s:%s/_sql/_explain?sql=%s" % (self.endpoint["host"], self.endpoint["port"], url_query)
-        response = requests.get(uri)
+        uri = endpointURL(self.endpoint) + "_sql/_explain?sql=%s" % url_query
+        response = getHTTPSession().get(uri)
         dsl_query = json.loads(response.text)
 
         if "error" in dsl_query:
@@ -425,17 +496,12 @@ class ElasticCorpus(BaseCorpus):
         self.checkConnectedToDB()
 
         timestamp = datetime.datetime.now()
-        self.es.index(
-            index=ES_INDEX_CACHE,
-            doc_type=ES_TYPE_CACHE,
-            id=path,
-            op_type="index",
-            body={
-                "data": json.dumps(data),
-                "time_created": timestamp,
-                "time_modified": timestamp,
-            }
-        )
+        self.indexRecord(ES_INDEX_CACHE, ES_TYPE_CACHE, path,
+                         {
+                             "data": encodeRecord(data, self.record_codec),
+                             "time_created": timestamp,
+                             "time_modified": timestamp,
+                         })
 
     def loadCachedJson(self, path):
         """
@@ -444,40 +510,68 @@ class ElasticCorpus(BaseCorpus):
             :param path: unique ID of resource to load
         """
         try:
-            return json.loads(self.getRecordField(path, TABLE_CACHE))
+            return decodeRecord(self.getRecordField(path, TABLE_CACHE))
         except:
             print("Exception: can't load cached JSON", path)
             raise FileNotFoundError
 
+    def loadCachedJsonMany(self, paths):
+        """
+            Loads many precomputed JSON resources in bulk. Returns a list with
+            the data for each path, None for those that aren't in the cache.
+        """
+        return [decodeRecord(data) if data is not None else None
+                for data in self.getRecordFields(paths, TABLE_CACHE)]
+
+    def loadSciDocs(self, guids, ignore_errors=None):
+        """
+            Loads many SciDocs in bulk. Returns a list with a SciDoc for each
+            guid, None for those that don't exist.
+        """
+        res = [self.getCachedSciDoc(guid, ignore_errors=ignore_errors) for guid in guids]
+        missing = [guid for guid, doc in zip(guids, res) if doc is None]
+        if not missing:
+            return res
+
+        loaded = {}
+        for guid, data in zip(missing, self.getRecordFields(missing, TABLE_SCIDOCS)):
+            if data is not None:
+                loaded[guid] = SciDoc(decodeRecord(data), ignore_errors=ignore_errors)
+                self.cacheSciDoc(guid, loaded[guid])
+
+        return [doc if doc is not None else loaded.get(guid) for guid, doc in zip(guids, res)]
+
     def loadSciDoc(self, guid, ignore_errors=None):
         """
             If a SciDocJSON file exists for guid, it returns it, otherwise None
         """
-        data = json.loads(self.getRecordField(guid, TABLE_SCIDOCS))
-        return SciDoc(data, ignore_errors=ignore_errors)
+        doc = self.getCachedSciDoc(guid, ignore_errors=ignore_errors)
+        if doc is not None:
+            return doc
+
+        data = decodeRecord(self.getRecordField(guid, TABLE_SCIDOCS))
+        doc = SciDoc(data, ignore_errors=ignore_errors)
+        self.cacheSciDoc(guid, doc)
+        return doc
 
     def saveSciDoc(self, doc):
         """
             Saves the document as JSON in the index
         """
         self.checkConnectedToDB()
+        self.invalidateCachedPaper(doc["metadata"]["guid"])
 
         attempts = 0
         while attempts < 3:
             try:
                 timestamp = datetime.datetime.now()
-                self.es.index(
-                    index=ES_INDEX_SCIDOCS,
-                    doc_type=ES_TYPE_SCIDOC,
-                    id=doc["metadata"]["guid"],
-                    op_type="index",
-                    body={
-                        "scidoc": json.dumps(doc.data),
-                        "guid": doc["metadata"]["guid"],
-                        "time_created": timestamp,
-                        "time_modified": timestamp,
-                    }
-                )
+                self.indexRecord(ES_INDEX_SCIDOCS, ES_TYPE_SCIDOC, doc["metadata"]["guid"],
+                                 {
+                                     "scidoc": encodeRecord(doc.data, self.record_codec),
+                                     "guid": doc["metadata"]["guid"],
+                                     "time_created": timestamp,
+                                     "time_modified": timestamp,
+                                 })
                 break
             except ConnectionTimeout:
                 attempts += 1
@@ -486,8 +580,8 @@ class ElasticCorpus(BaseCorpus):
         """
             Connects to database
         """
-        self.es = Elasticsearch([self.endpoint], timeout=self.default_timeout, http_auth=self.http_auth)
-        self.es.retry_on_timeout = True
+        self.es = getElasticClient(self.endpoint, timeout=self.default_timeout, maxsize=self.connection_pool_size,
+                                   http_auth=self.http_auth)
         # try:
         #     info = self.es.info()
         #     # print(info)
@@ -501,6 +595,48 @@ class ElasticCorpus(BaseCorpus):
         #     self.use_dsl_queries = False
         self.doc_sim = DocSimilarity(self)
 
+    def getServerVersion(self):
+        """
+            Returns (major, minor) of the version of the ES server, asking it
+            only once. Falls back to es_version if the server doesn't say.
+        """
+        if self.server_version is None:
+            self.checkConnectedToDB()
+            try:
+                number = self.es.info()["version"]["number"]
+                self.server_version = tuple(int(part) for part in number.split(".")[:2])
+            except Exception:
+                print("Cannot retrieve ES server version, assuming", self.es_version)
+                self.server_version = (self.es_version, 0)
+        return self.server_version
+
+    def getPainlessScriptKey(self):
+        """
+            Returns the key to send an inline painless script under, or None if
+            the server has no painless (ES 2)
+        """
+        version = self.getServerVersion()
+        if version >= (5, 6):
+            return "source"
+        elif version >= (5, 0):
+            return "inline"
+        return None
+
+    def setConnectionPoolSize(self, size):
+        """
+            Makes sure the client keeps at least this many connections open
+            per node, so that many threads can share it without waiting for
+            a free connection. Reconnects if the pool has to grow.
+
+            :param size: number of concurrent requests we expect
+        """
+        if size <= self.connection_pool_size:
+            return
+
+        self.connection_pool_size = size
+        if self.es:
+            self.connectToDB(suppress_error=True)
+
     def isIndexOpen(self, index_name):
         """
         Returns True if specified index is open
@@ -508,15 +644,9 @@ class ElasticCorpus(BaseCorpus):
         :param index_name: name of index
         :return: True or False
         """
-        if isinstance(self.endpoint, string_types):
-            url = self.endpoint
-        elif isinstance(self.endpoint, dict):
-            url = "http://%s:%d/" % (self.endpoint["host"], self.endpoint["port"])
-        if url[-1] != "/":
-            url = url + "/"
-
+        url = endpointURL(self.endpoint)
         url += "_cluster/state/metadata/%s?filter_path=metadata.indices.*.state" % index_name
-        r = requests.get(url)
+        r = getHTTPSession().get(url)
         data = r.json()
         state = data["metadata"]["indices"][index_name]["state"]
         if state.startswith("close"):
@@ -528,7 +658,29 @@ class ElasticCorpus(BaseCorpus):
         """
             Returns a paper's metadata by GUID
         """
-        return self.getRecordField(guid, "papers")
+        metadata = self.getCachedMetadata(guid)
+        if metadata is None:
+            metadata = self.getRecordField(guid, "papers")
+            self.cacheMetadata(guid, metadata)
+        return metadata
+
+    def getMetadataByGUIDs(self, guids):
+        """
+            Returns the metadata of many papers, fetched in bulk. None for
+            papers that don't exist.
+        """
+        res = [self.getCachedMetadata(guid) for guid in guids]
+        missing = [guid for guid, metadata in zip(guids, res) if metadata is None]
+        if not missing:
+            return res
+
+        loaded = {}
+        for guid, metadata in zip(missing, self.getRecordFields(missing, "papers")):
+            if metadata is not None:
+                loaded[guid] = metadata
+                self.cacheMetadata(guid, metadata)
+
+        return [metadata if metadata is not None else loaded.get(guid) for guid, metadata in zip(guids, res)]
 
     def getMetadataByField(self, field, value):
         """
@@ -690,27 +842,30 @@ class ElasticCorpus(BaseCorpus):
             else:
                 return [r["_source"] for r in hits]
 
-    def listRecords(self, conditions=None, field="guid", max_results=sys.maxsize, table=TABLE_PAPERS, sort=None):
+    def iterRecords(self, conditions=None, field="guid", max_results=sys.maxsize, table=TABLE_PAPERS, sort=None,
+                    page_size=DEFAULT_SCROLL_PAGE_SIZE, source=None):
         """
-            This is the equivalent of a SELECT clause
+            Like listRecords, but yields the values one at a time as they are
+            scrolled through, without keeping them all in memory
+
+            :param source: the _source fields to retrieve, if not just field
         """
         self.checkConnectedToDB()
 
         es_index = index_equivalence[table]["index"]
         es_type = index_equivalence[table]["type"]
 
-        prev_max_results = self.max_results
-        self.max_results = max_results
-
         if isinstance(conditions, string_types):  # assuming not use_dsl_queries
             query = self.filterQuery(conditions)
             # query = conditions
-            hits = self.unlimitedQuery(
+            pages = self.scrollQuery(
                 q=query,
                 index=es_index,
                 doc_type=es_type,
                 sort=sort,
-                _source=field,
+                _source=source or field,
+                max_results=max_results,
+                page_size=page_size,
             )
         else:
             if isinstance(conditions, dict):
@@ -722,17 +877,42 @@ class ElasticCorpus(BaseCorpus):
 
             query = buildMetadataDSLQuery(must)
 
-            hits = self.unlimitedQuery(
+            pages = self.scrollQuery(
                 body=query,
                 index=es_index,
                 doc_type=es_type,
                 sort=sort,
-                _source=field,
+                _source=source or field,
+                max_results=max_results,
+                page_size=page_size,
             )
 
-        self.max_results = prev_max_results
+        for hits in pages:
+            for value in self.abstractNestedResults(query, hits, field):
+                yield value
 
-        return self.abstractNestedResults(query, hits, field)
+    def iterPapersMetadata(self, conditions=None, fields=None):
+        """
+            Iterates over the metadata of the papers where [conditions],
+            scrolling through them. With fields, only those metadata fields
+            are retrieved.
+        """
+        source = None
+        if fields:
+            source = ",".join(["metadata." + field for field in fields])
+        return self.iterRecords(conditions, "metadata", table=TABLE_PAPERS, source=source)
+
+    def listRecords(self, conditions=None, field="guid", max_results=sys.maxsize, table=TABLE_PAPERS, sort=None):
+        """
+            This is the equivalent of a SELECT clause
+        """
+        return list(self.iterRecords(conditions, field, max_results, table, sort))
+
+    def iterPapers(self, conditions=None, field="guid", max_results=sys.maxsize, sort=None):
+        """
+            Yields the GUIDs in papers table where [conditions]
+        """
+        return self.iterRecords(conditions, field, max_results, "papers", sort)
 
     def listPapers(self, conditions=None, field="guid", max_results=sys.maxsize, sort=None):
         """
@@ -853,13 +1033,7 @@ class ElasticCorpus(BaseCorpus):
         if op_type == "create":
             body["time_created"] = timestamp
 
-        self.es.index(
-            index=ES_INDEX_AUTHORS,
-            doc_type=ES_TYPE_AUTHOR,
-            op_type=op_type,
-            id=author["author_id"],
-            body=body
-        )
+        self.indexRecord(ES_INDEX_AUTHORS, ES_TYPE_AUTHOR, author["author_id"], body, op_type=op_type)
 
     def addPaper(self, metadata, check_existing=True, has_scidoc=True):
         """
@@ -880,6 +1054,7 @@ class ElasticCorpus(BaseCorpus):
                 index, False otherwise
         """
         self.checkConnectedToDB()
+        self.invalidateCachedPaper(metadata["guid"])
 
         timestamp = datetime.datetime.now()
         body = {"guid": metadata["guid"],
@@ -887,7 +1062,6 @@ class ElasticCorpus(BaseCorpus):
                 "norm_title": metadata["norm_title"],
                 "num_in_collection_references": metadata.get("num_in_collection_references", 0),
                 "num_resolvable_citations": metadata.get("num_resolvable_citations", 0),
-                "num_inlinks": len(metadata.get("inlinks", [])),
                 "time_modified": timestamp,
                 ##                "corpus_id": metadata["corpus_id"],
                 ##                "filename": metadata["filename"],
@@ -898,13 +1072,20 @@ class ElasticCorpus(BaseCorpus):
                 ##                "year": metadata["year"],
                 }
 
+        # a partial update without inlinks leaves them as they are, see appendInlink()
+        if op_type != "update" or "inlinks" in metadata:
+            body["num_inlinks"] = len(metadata.get("inlinks", []))
+
         if has_scidoc is not None:
             body["has_scidoc"] = has_scidoc
 
         if op_type == "create":
             body["time_created"] = timestamp
 
-        if op_type == "update":
+        if op_type == "update" and self.bulk_writer is not None:
+            self.bulk_writer.update(ES_INDEX_PAPERS, ES_TYPE_PAPER, metadata["guid"], body)
+
+        elif op_type == "update":
             body = {"doc": body}
             try:
                 self.es.update(
@@ -923,14 +1104,103 @@ class ElasticCorpus(BaseCorpus):
                 )
 
         else:
-            self.es.index(
+            self.indexRecord(ES_INDEX_PAPERS, ES_TYPE_PAPER, metadata["guid"], body, op_type=op_type)
+
+        self.matcher.paperUpdated(metadata)
+
+    def appendInlink(self, guid, inlink_guid):
+        """
+            Adds inlink_guid to the inlinks of paper guid, if it's not there
+            already, with a scripted update: no need to load the paper first
+            and concurrent appends don't overwrite each other.
+
+            ES 2 has no painless, so there the paper is loaded, changed and
+            saved again, after sending any buffered writes so they are not
+            lost.
+        """
+        self.checkConnectedToDB()
+        self.invalidateCachedPaper(guid)
+
+        script_key = self.getPainlessScriptKey()
+        if script_key is None:
+            if self.bulk_writer is not None:
+                self.bulk_writer.flush()
+            BaseCorpus.appendInlink(self, guid, inlink_guid)
+            return
+
+        params = {"guid": inlink_guid}
+        if self.bulk_writer is not None:
+            self.bulk_writer.scriptedUpdate(ES_INDEX_PAPERS, ES_TYPE_PAPER, guid, SCRIPT_APPEND_INLINK, params,
+                                            script_key=script_key)
+        else:
+            self.es.update(
                 index=ES_INDEX_PAPERS,
                 doc_type=ES_TYPE_PAPER,
+                id=guid,
+                body={"script": {script_key: SCRIPT_APPEND_INLINK, "lang": "painless", "params": params}}
+            )
+
+    def cacheSciDoc(self, guid, doc):
+        # what we read while bulk writing may be missing buffered writes
+        if self.bulk_writer is None:
+            BaseCorpus.cacheSciDoc(self, guid, doc)
+
+    def cacheMetadata(self, guid, metadata):
+        if self.bulk_writer is None:
+            BaseCorpus.cacheMetadata(self, guid, metadata)
+
+    def indexRecord(self, index, doc_type, rec_id, body, op_type="index"):
+        """
+            es.index(), through the bulk writer if bulkWriting() is active
+        """
+        if self.bulk_writer is not None:
+            self.bulk_writer.index(index, doc_type, rec_id, body, op_type=op_type)
+        else:
+            self.es.index(
+                index=index,
+                doc_type=doc_type,
                 op_type=op_type,
-                id=metadata["guid"],
+                id=rec_id,
                 body=body
             )
 
+    @contextmanager
+    def bulkWriting(self, flush_size=None, flush_interval=None):
+        """
+            Context manager: inside it, saveSciDoc, addPaper, updatePaper,
+            appendInlink, saveCachedJson and updateAuthor are buffered and sent
+            in _bulk requests. Nested calls share the outermost writer, which is
+            flushed and the indices refreshed when it exits.
+
+            Writes are not visible to reads until they are flushed. If any
+            of them failed, BulkIndexError is raised when the outermost
+            session ends.
+
+            :param flush_size: maximum number of operations in a bulk request
+            :param flush_interval: maximum seconds between flushes while writing
+        """
+        self.checkConnectedToDB()
+
+        if self.bulk_writing_depth == 0:
+            self.bulk_writer = CorpusBulkWriter(
+                self.es,
+                flush_size=flush_size or self.bulk_flush_size,
+                flush_interval=flush_interval or self.bulk_flush_interval)
+        self.bulk_writing_depth += 1
+        succeeded = False
+        try:
+            yield self.bulk_writer
+            succeeded = True
+        finally:
+            self.bulk_writing_depth -= 1
+            if self.bulk_writing_depth == 0:
+                writer = self.bulk_writer
+                self.bulk_writer = None
+                writer.close()
+                # don't hide the exception that ended the session
+                if succeeded:
+                    writer.raiseIfErrors()
+
     def addLink(self, GUID_from, GUID_to, authors_from, authors_to, year_from, year_to, numcitations):
         """
             Add a link in the citation graph.
@@ -984,6 +1254,10 @@ class ElasticCorpus(BaseCorpus):
             raise ValueError("Unknown record type")
 
         es_table = index_equivalence[record_type]["index"]
+        self.scidoc_cache.clear()
+        self.metadata_cache.clear()
+        if record_type == TABLE_PAPERS:
+            self.matcher.papersDeleted()
 
         if self.es.indices.exists(index=es_table):
             print("Deleting ALL files in %s" % es_table)
@@ -1019,19 +1293,23 @@ class ElasticCorpus(BaseCorpus):
         if self.use_dsl_queries:
             query = buildMetadataDSLQuery(conditions)
 
-            to_delete = self.unlimitedQuery(
+            pages = self.scrollQuery(
                 index=es_table,
                 doc_type=es_type,
-                body=query)
+                body=query,
+                _source=False)
         else:
             query = conditions
 
-            to_delete = self.unlimitedQuery(
+            pages = self.scrollQuery(
                 index=es_table,
                 doc_type=es_type,
-                q=query)
+                q=query,
+                _source=False)
 
-        self.bulkDelete([item["_id"] for item in to_delete])
+        # the scroll is a snapshot, so we can delete while scrolling
+        for to_delete in pages:
+            self.bulkDelete([item["_id"] for item in to_delete], record_type)
 
     def bulkDelete(self, id_list, table="papers"):
         """
@@ -1048,7 +1326,12 @@ class ElasticCorpus(BaseCorpus):
         es_type = index_equivalence[table]["type"]
 
         bulk_commands = []
+        if table == TABLE_PAPERS:
+            self.matcher.papersDeleted(id_list)
+
         for item in id_list:
+            if table in [TABLE_PAPERS, TABLE_SCIDOCS]:
+                self.invalidateCachedPaper(item)
             bulk_commands.append("{ \"delete\" : {  \"_id\" : \"%s\" } }" % item)
 
         if len(bulk_commands) > 0:
@@ -1058,84 +1341,150 @@ class ElasticCorpus(BaseCorpus):
                 doc_type=es_type,
             )
 
-    def unlimitedQuery(self, *args, **kwargs):
+    def scrollQuery(self, *args, **kwargs):
         """
-            Wraps elasticsearch querying to enable auto scroll for retrieving
-            large amounts of results
+            Runs a query with the scroll API and yields the hits one page at a
+            time, without keeping them in memory. The scroll context is
+            cleared when the iteration ends, also if it ends early.
 
-            It does more or less what elasticsearch.helpers.scan does, only this
-            one actually works.
-        """
+            Takes the same arguments as es.search(), plus:
 
-        size = min(self.max_results, 1000)
+            :param page_size: number of hits per page
+            :param max_results: stop after this many hits
+            :param slice_id: with max_slices, only return this slice of the
+                results (sliced scroll), see parallelScrollQuery()
+            :param max_slices: number of slices the results are split into
+            :param with_total: if True, yields (hits, total_hits) tuples
+        """
+        page_size = kwargs.pop("page_size", DEFAULT_SCROLL_PAGE_SIZE)
+        max_results = kwargs.pop("max_results", sys.maxsize)
+        slice_id = kwargs.pop("slice_id", None)
+        max_slices = kwargs.pop("max_slices", None)
+        with_total = kwargs.pop("with_total", False)
+        scroll_time = kwargs.pop("scroll_time", self.scroll_time)
 
-        sort = ["_doc"]
+        sort = kwargs.pop("sort", None)
+        sort = [sort] if sort is not None else ["_doc"]
 
-        if "sort" in kwargs:
-            if kwargs["sort"] is not None:
-                sort = [kwargs["sort"]]
-            del kwargs["sort"]
+        if max_slices is not None and max_slices > 1:
+            body = dict(kwargs.get("body") or {})
+            body["slice"] = {"id": slice_id, "max": max_slices}
+            kwargs["body"] = body
 
         res = self.es.search(
             *args,
-            size=size,
+            size=min(max_results, page_size),
             sort=sort,
-            scroll=self.scroll_time,
+            scroll=scroll_time,
             **kwargs
         )
+        scroll_id = res.get("_scroll_id")
+        total = getTotalHits(res)
 
-        results = res['hits']['hits']
-        scroll_size = res['hits']['total']
-        while (scroll_size > 0) and len(results) < self.max_results:
-            try:
-                scroll_id = res['_scroll_id']
-                rs = self.es.scroll(scroll_id=scroll_id, scroll=self.scroll_time)
-                res = rs
-                results.extend(rs['hits']['hits'])
-                scroll_size = len(rs['hits']['hits'])
-            except Exception as e:
-                print(e)
-                break
-
-        return results[:self.max_results]
+        try:
+            num_results = 0
+            while res["hits"]["hits"] and num_results < max_results:
+                hits = res["hits"]["hits"][:max_results - num_results]
+                num_results += len(hits)
+                yield (hits, total) if with_total else hits
+
+                if num_results >= max_results:
+                    break
+
+                res = self.es.scroll(scroll_id=scroll_id, scroll=scroll_time)
+                scroll_id = res.get("_scroll_id", scroll_id)
+        finally:
+            if scroll_id:
+                try:
+                    self.es.clear_scroll(scroll_id=scroll_id)
+                except Exception as e:
+                    logging.warning("Could not clear scroll: %s" % str(e))
+
+    def iterateQuery(self, *args, **kwargs):
+        """
+            Same as scrollQuery(), but yields single hits
+        """
+        for hits in self.scrollQuery(*args, **kwargs):
+            for hit in hits:
+                yield hit
+
+    def parallelScrollQuery(self, *args, **kwargs):
+        """
+            Sliced scroll: splits the results of the query in num_slices and
+            scrolls through each slice in a separate thread. Yields pages of
+            hits as they arrive, so the order of the pages is not defined.
+            Needs ES 5 or later.
+
+            Takes the same arguments as scrollQuery(), plus num_slices.
+            max_results applies to each slice.
+        """
+        num_slices = kwargs.pop("num_slices", DEFAULT_SCROLL_SLICES)
+        if num_slices <= 1:
+            for hits in self.scrollQuery(*args, **kwargs):
+                yield hits
+            return
 
-    def yieldingUnlimitedQuery(self, *args, **kwargs):
-        """
-            Unlimited query that yields results as they arrive
-        """
-        scroll_time = "20m"
+        pages = queue.Queue(maxsize=2 * num_slices)
+        stop = threading.Event()
+        finished = object()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    pages.put(item, timeout=1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
 
-        size = min(self.max_results, 10000)
+        def scrollSlice(slice_id):
+            try:
+                slice_kwargs = dict(kwargs, slice_id=slice_id, max_slices=num_slices)
+                for hits in self.scrollQuery(*args, **slice_kwargs):
+                    if not put(hits):
+                        break
+            except Exception as e:
+                put(e)
+            finally:
+                put(finished)
 
-        sort = ["_doc"]
+        threads = [threading.Thread(target=scrollSlice, args=(slice_id,)) for slice_id in range(num_slices)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
 
-        if "sort" in kwargs:
-            if kwargs["sort"] is not None:
-                sort = [kwargs["sort"]]
-            del kwargs["sort"]
+        try:
+            running = num_slices
+            while running:
+                item = pages.get()
+                if item is finished:
+                    running -= 1
+                elif isinstance(item, Exception):
+                    raise item
+                else:
+                    yield item
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
 
-        res = self.es.search(
-            *args,
-            size=size,
-            sort=sort,
-            scroll=scroll_time,
-            **kwargs
-        )
+    def unlimitedQuery(self, *args, **kwargs):
+        """
+            Wraps elasticsearch querying to enable auto scroll for retrieving
+            large amounts of results, up to self.max_results.
 
-        results = res['hits']['hits']
-        scroll_size = res['hits']['total']
-        while (scroll_size > 0) and len(results) < self.max_results:
-            try:
-                scroll_id = res['_scroll_id']
-                rs = self.es.scroll(scroll_id=scroll_id, scroll=scroll_time)
-                res = rs
-                yield rs['hits']['hits'], scroll_size
-                scroll_size = len(rs['hits']['hits'])
-            except Exception as e:
-                print(e)
-                break
+            Returns a list with all the hits: for large numbers of results use
+            scrollQuery() or iterateQuery() instead.
+        """
+        return list(self.iterateQuery(*args, max_results=self.max_results, **kwargs))
 
-        return
+    def yieldingUnlimitedQuery(self, *args, **kwargs):
+        """
+            Unlimited query that yields (hits, total_hits) one page at a time
+        """
+        kwargs.setdefault("page_size", 10000)
+        kwargs.setdefault("max_results", self.max_results)
+        return self.scrollQuery(*args, with_total=True, **kwargs)
 
     def setCorpusFilter(self, collection_id=None, import_id=None, date=None):
         """
@@ -0,0 +1,229 @@
+# Fuzzy reference matching with MinHash-LSH blocking over titles
+#
+# Copyright:   (c) Daniel Duma 2018
+# Author: Daniel Duma <danielduma@gmail.com>
+
+# For license information, see LICENSE.TXT
+
+"""
+    References whose titles are slightly different from the paper's (OCR
+    errors, dropped subtitles, different punctuation) are missed by exact
+    norm_title matching. Comparing each reference with every paper in the
+    corpus would make import O(N^2), so papers are first put in buckets by
+    MinHash-LSH over the character n-grams of their normalized titles: only
+    papers that share a bucket with the reference are compared.
+
+    With the defaults (64 hashes in 16 bands of 4) titles with a Jaccard
+    similarity of their n-grams over ~0.5 are almost always candidates and
+    those under ~0.2 almost never are. Candidates must share an author
+    surname with the reference and have a compatible year, and are then
+    scored by edit distance.
+"""
+
+from __future__ import absolute_import
+import zlib
+
+import numpy as np
+import six
+
+from db.base_corpus import IndexedReferenceMatcher
+from proc.general_utils import normalizeTitle, levenshtein
+
+# 2^31 - 1, so that products of two hashes fit in 64 bits
+MERSENNE_PRIME = (1 << 31) - 1
+
+
+def titleShingles(norm_title, ngram_size=3):
+    """
+        Returns the set of character n-grams of a normalized title
+    """
+    padded = " " + norm_title + " "
+    if len(padded) <= ngram_size:
+        return set([padded])
+    return set([padded[i:i + ngram_size] for i in range(len(padded) - ngram_size + 1)])
+
+
+def titleSimilarity(title1, title2):
+    """
+        1 minus the edit distance between the titles, over the length of the
+        longest
+    """
+    longest = max(len(title1), len(title2))
+    if longest == 0:
+        return 0.0
+    return 1.0 - levenshtein(title1, title2) / float(longest)
+
+
+class MinHasher(object):
+    """
+        Computes MinHash signatures of sets of strings. The hash functions
+        are fixed by the seed, so signatures are comparable across processes.
+    """
+
+    def __init__(self, num_hashes=64, seed=1):
+        rng = np.random.RandomState(seed)
+        self.num_hashes = num_hashes
+        self.a = rng.randint(1, MERSENNE_PRIME, size=num_hashes).astype(np.uint64)
+        self.b = rng.randint(0, MERSENNE_PRIME, size=num_hashes).astype(np.uint64)
+
+    def signature(self, shingles):
+        hashes = np.array([zlib.crc32(shingle.encode("utf-8")) & 0xffffffff for shingle in shingles],
+                          dtype=np.uint64) % MERSENNE_PRIME
+        permuted = (np.outer(self.a, hashes) + self.b[:, np.newaxis]) % MERSENNE_PRIME
+        return permuted.min(axis=1)
+
+
+class FuzzyReferenceMatcher(IndexedReferenceMatcher):
+    """
+        IndexedReferenceMatcher that, when a reference can't be matched
+        exactly, looks for papers with a similar title in an LSH index.
+
+        A candidate is accepted if its title similarity (see
+        titleSimilarity()) is at least min_title_similarity, it shares a
+        surname with the reference and, if both have a year, the years are at
+        most max_year_difference apart. The best scoring candidate is returned.
+    """
+
+    LOOKUP_FIELDS = IndexedReferenceMatcher.LOOKUP_FIELDS + ["year"]
+
+    def __init__(self, corpus, num_hashes=64, num_bands=16, ngram_size=3, min_title_similarity=0.85,
+                 min_title_length=20, max_year_difference=1, max_bucket_size=1000):
+        """
+            :param num_hashes: MinHash signature length, must be a multiple of
+                num_bands. More bands means more candidates.
+            :param min_title_length: shorter titles are only matched exactly
+            :param max_bucket_size: buckets with more papers than this (very
+                common titles) aren't used to find candidates
+        """
+        assert num_hashes % num_bands == 0
+        self.minhasher = MinHasher(num_hashes)
+        self.num_bands = num_bands
+        self.rows_per_band = num_hashes // num_bands
+        self.ngram_size = ngram_size
+        self.min_title_similarity = min_title_similarity
+        self.min_title_length = min_title_length
+        self.max_year_difference = max_year_difference
+        self.max_bucket_size = max_bucket_size
+        super(FuzzyReferenceMatcher, self).__init__(corpus)
+
+    def clear(self):
+        super(FuzzyReferenceMatcher, self).clear()
+        self.buckets = {}
+        self.years = {}
+
+    def bandKeys(self, norm_title):
+        """
+            Returns the LSH bucket keys of a normalized title, one per band
+        """
+        signature = self.minhasher.signature(titleShingles(norm_title, self.ngram_size))
+        keys = []
+        for band in range(self.num_bands):
+            rows = signature[band * self.rows_per_band:(band + 1) * self.rows_per_band]
+            keys.append((band, hash(rows.tobytes())))
+        return keys
+
+    def addPaper(self, metadata):
+        guid = metadata["guid"]
+        old = self.entries.get(guid)
+        year = self._year(metadata["year"]) if "year" in metadata else self.years.get(guid)
+        super(FuzzyReferenceMatcher, self).addPaper(metadata)
+        self.years[guid] = year
+
+        new = self.entries[guid]
+        if new is old:
+            # nothing changed
+            return
+
+        if new.get("norm_title") and len(new["norm_title"]) >= self.min_title_length:
+            for key in self.bandKeys(new["norm_title"]):
+                self.buckets.setdefault(key, []).append(guid)
+
+    def removePaper(self, guid):
+        old = self.entries.get(guid)
+        super(FuzzyReferenceMatcher, self).removePaper(guid)
+        if old is None:
+            return
+
+        self.years.pop(guid, None)
+        if old.get("norm_title") and len(old["norm_title"]) >= self.min_title_length:
+            for key in self.bandKeys(old["norm_title"]):
+                guids = [other for other in self.buckets.get(key, []) if other != guid]
+                if guids:
+                    self.buckets[key] = guids
+                else:
+                    self.buckets.pop(key, None)
+
+    @staticmethod
+    def _year(value):
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            return None
+
+    def listCandidates(self, norm_title):
+        """
+            Returns the guids of the papers that share at least one LSH bucket
+            with the title
+        """
+        candidates = set()
+        for key in self.bandKeys(norm_title):
+            guids = self.buckets.get(key, [])
+            if len(guids) <= self.max_bucket_size:
+                candidates.update(guids)
+        return candidates
+
+    def scoreCandidate(self, guid, norm_title, ref_surnames, ref_year):
+        """
+            Returns the score of a candidate paper for a reference, or None if
+            it is not acceptable
+        """
+        entry = self.entries.get(guid)
+        if entry is None or not entry.get("norm_title"):
+            return None
+
+        if not ref_surnames.intersection(entry.get("surnames", ())):
+            return None
+
+        year = self.years.get(guid)
+        if ref_year is not None and year is not None and abs(ref_year - year) > self.max_year_difference:
+            return None
+
+        # the edit distance can't be lower than the difference in length
+        longest = max(len(norm_title), len(entry["norm_title"]))
+        if 1.0 - abs(len(norm_title) - len(entry["norm_title"])) / float(longest) < self.min_title_similarity:
+            return None
+
+        similarity = titleSimilarity(norm_title, entry["norm_title"])
+        if similarity < self.min_title_similarity:
+            return None
+        return similarity + (0.01 if ref_year is not None and ref_year == year else 0)
+
+    def matchFuzzyGUID(self, ref):
+        """
+            Returns the guid of the best fuzzy match for the reference, or None
+        """
+        norm_title = normalizeTitle(ref.get("title") or "")
+        if not isinstance(norm_title, six.text_type):
+            norm_title = six.text_type(norm_title, errors="ignore")
+        if len(norm_title) < self.min_title_length:
+            return None
+
+        ref_surnames = set([surname.lower() for surname in ref.get("surnames", []) if surname])
+        if not ref_surnames:
+            return None
+        ref_year = self._year(ref.get("year"))
+
+        best_guid = None
+        best_score = None
+        for guid in self.listCandidates(norm_title):
+            score = self.scoreCandidate(guid, norm_title, ref_surnames, ref_year)
+            if score is not None and (best_score is None or score > best_score):
+                best_guid = guid
+                best_score = score
+        return best_guid
+
+    def matchGUID(self, ref):
+        guid = super(FuzzyReferenceMatcher, self).matchGUID(ref)
+        if guid is None:
+            guid = self.matchFuzzyGUID(ref)
+        return guid
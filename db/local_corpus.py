@@ -1,5 +1,5 @@
-# LocalCorpus: uses SQLite for storage of paper metadata, .json files on disk
-# for SciDocs and all cached BOWs
+# LocalCorpus: uses SQLite for storage of paper metadata and cached BOWs, .json
+# files on disk for SciDocs
 #
 # Copyright:   (c) Daniel Duma 2015
 # Author: Daniel Duma <danielduma@gmail.com>
@@ -9,20 +9,93 @@
 from __future__ import print_function
 
 from __future__ import absolute_import
-import os, sys, json, glob, sqlite3, codecs, uuid, unicodedata
-from proc.general_utils import AttributeDict, ensureTrailingBackslash, ensureDirExists
+import os, sys, json, glob, sqlite3, codecs, uuid, unicodedata, re, time
+from contextlib import contextmanager
+from proc.general_utils import AttributeDict, ensureTrailingBackslash, ensureDirExists, normalizeTitle
 from scidoc.scidoc import SciDoc
+from .record_codec import CODEC_JSON, encodeRecordBytes, decodeRecord
 
-from .base_corpus import BaseCorpus
+from .base_corpus import BaseCorpus, TABLE_PAPERS, TABLE_SCIDOCS, TABLE_CACHE, TABLE_AUTHORS, TABLE_LINKS, \
+	TABLE_MISSING_REFERENCES
 import six
 
+# columns of the papers table. Any other metadata field is only in the JSON
+PAPER_COLUMNS=["guid", "doi", "corpus_id", "filename", "norm_title", "surnames", "year",
+	"num_in_collection_references", "num_references", "num_resolvable_citations", "num_citations",
+	"num_inlinks", "import_id", "collection_id"]
+
+# SQLite has a limit on the number of variables per statement
+MAX_SQL_VARIABLES=500
+
+TABLE_DEFINITIONS=[
+	"""create table if not exists papers (
+	GUID text primary key,
+	DOI text,
+	corpus_id text,
+	filename text,
+	norm_title text,
+	surnames text,
+	year text,
+	num_in_collection_references int,
+	num_references int,
+	num_resolvable_citations int,
+	num_citations int,
+	num_inlinks int,
+	import_id text,
+	collection_id text,
+	metadata text)""",
+	"""create table if not exists authors (
+	GUID text primary key,
+	full_name,
+	surname text,
+	metadata text)""",
+	"""create table if not exists links (
+	GUID_from text,
+	GUID_to text,
+	authors_from text,
+	authors_to text,
+	year_from text,
+	year_to text,
+	numcitations int)""",
+	"""create table if not exists missing_papers (
+	norm_title text,
+	reference_counts int,
+	metadata text)""",
+	"""create table if not exists cache (
+	id text primary key,
+	data text,
+	time_created real,
+	time_modified real)""",
+	]
+
+# the lookup fields of DefaultReferenceMatcher and getMetadataByField, plus
+# the ones used for sorting
+INDEX_DEFINITIONS=[
+	"create index if not exists papers_doi on papers (DOI)",
+	"create index if not exists papers_corpus_id on papers (corpus_id)",
+	"create index if not exists papers_filename on papers (filename)",
+	"create index if not exists papers_norm_title on papers (norm_title)",
+	"create index if not exists papers_collection_id on papers (collection_id)",
+	"create index if not exists papers_num_in_collection_references on papers (num_in_collection_references desc)",
+	"create index if not exists papers_matchable_citations on papers (num_resolvable_citations desc)",
+	"create index if not exists papers_inlinks on papers (num_inlinks desc)",
+	"create index if not exists links_guid_from on links (GUID_from)",
+	"create index if not exists links_guid_to on links (GUID_to)",
+	"create index if not exists missing_papers_norm_title on missing_papers (norm_title)",
+	]
+
+rx_valid_field=re.compile(r"^[A-Za-z0-9_\.]+$")
+
 class LocalCorpus(BaseCorpus):
 	"""
-		Class that deals with corpus access
-	"""
+		Class that deals with corpus access without an Elasticsearch server.
 
-	def bulkDelete(self, id_list, table=TABLE_PAPERS):
-		pass
+		Metadata, links and cached JSON (BOWs, resolvable citations) are stored
+		in a single SQLite file in WAL mode, SciDocs as .json files.
+
+		Every write is committed straight away, unless it's done inside
+		transaction() (or bulkWriting()), which commits them all at once.
+	"""
 
 	def __init__(self):
 		"""
@@ -36,6 +109,7 @@ class LocalCorpus(BaseCorpus):
 
 		self.setPaths("")
 		self.globalDBconn=None
+		self.transaction_depth=0
 
 		# annotate files with AZ, CSC, etc.
 		self.annotators={}
@@ -56,7 +130,7 @@ class LocalCorpus(BaseCorpus):
 		self.paths.fullLuceneIndex=self.paths.fileDB+"LuceneFullIndex"+os.sep
 		self.paths.output=self.ROOT_DIR+"output"+os.sep
 		self.paths.experiments=self.ROOT_DIR+"experiments"+os.sep
-		self.indexDB_path=self.paths.fileDB+"db\\index.db"
+		self.indexDB_path=os.path.join(self.paths.fileDB_db,"index.db")
 
 	def connectCorpus(self, base_directory, initializing_corpus=False,suppress_error=False):
 		"""
@@ -98,68 +172,40 @@ class LocalCorpus(BaseCorpus):
 
 	def connectToDB(self, suppress_error=False):
 		"""
-			Connects to SQLite DB
+			Connects to SQLite DB, switching it to WAL mode and creating any
+			tables and indexes that are missing
 		"""
 		if os.path.exists(self.indexDB_path):
 			self.globalDBconn=sqlite3.connect(self.indexDB_path)
+			# WAL lets readers work while we write, and with synchronous=NORMAL
+			# a commit doesn't wait for fsync
+			self.globalDBconn.execute("PRAGMA journal_mode=WAL")
+			self.globalDBconn.execute("PRAGMA synchronous=NORMAL")
+			self.createTables(self.globalDBconn)
 		else:
 			if not suppress_error:
 				print("ERROR: Couldn't connect to DB",self.indexDB_path)
 			self.globalDBconn=None
 
+	def createTables(self, conn):
+		"""
+			Creates the tables and indexes if they don't exist
+		"""
+		c=conn.cursor()
+		for definition in TABLE_DEFINITIONS+INDEX_DEFINITIONS:
+			c.execute(definition)
+		c.close()
+		conn.commit()
+
 	def createAndInitializeDatabase(self):
 		"""
 			Ensures that the directory structure is in place and creates
 			the SQLite database and tables
 		"""
 		self.createDefaultDirs()
-		if not os.path.exists(self.indexDB_path):
-			conn=sqlite3.connect(self.indexDB_path)
-			c=conn.cursor()
-			#        id int primary key,
-			c.execute("""create table papers (
-			GUID text primary key,
-			DOI text,
-			corpus_id text,
-			filename text,
-			norm_title text,
-			surnames text,
-			year text,
-			num_in_collection_references int,
-			num_references int,
-			num_resolvable_citations int,
-			num_citations int,
-			num_inlinks int,
-			import_id text,
-			collection_id text,
-			metadata text)""")
-			conn.commit()
-
-			c.execute("""create table authors (
-			GUID text primary key,
-			full_name,
-			surname text,
-			metadata text)""")
-			conn.commit()
-
-			c.execute("""create table links (
-			GUID_from text,
-			GUID_to text,
-			authors_from text,
-			authors_to text,
-			year_from text,
-			year_to text,
-			numcitations int)""")
-			conn.commit()
-
-			c.execute("""create table missing_papers (
-			norm_title text,
-			reference_counts int,
-			metadata text)""")
-			conn.commit()
-
-			c.close()
-			conn.close()
+		conn=sqlite3.connect(self.indexDB_path)
+		self.createTables(conn)
+		conn.close()
 
 	def createDefaultDirs(self):
 		"""
@@ -168,20 +214,113 @@ class LocalCorpus(BaseCorpus):
 		for path in self.paths:
 			ensureDirExists(self.paths[path])
 
+	def commit(self):
+		"""
+			Commits, unless we're inside a transaction()
+		"""
+		if self.transaction_depth == 0:
+			self.globalDBconn.commit()
+
+	@contextmanager
+	def transaction(self):
+		"""
+			Context manager: all writes inside it are committed together when
+			the outermost transaction() exits, or rolled back if there is an
+			exception. Much faster than committing every write.
+		"""
+		self.checkConnectedToDB()
+		self.transaction_depth+=1
+		try:
+			yield self
+		except:
+			self.transaction_depth-=1
+			if self.transaction_depth == 0:
+				self.globalDBconn.rollback()
+				# what we cached or indexed during the transaction may not be
+				# in the DB
+				self.scidoc_cache.clear()
+				self.metadata_cache.clear()
+				self.matcher.writesRolledBack()
+				self.citation_graph=None
+			raise
+		else:
+			self.transaction_depth-=1
+			if self.transaction_depth == 0:
+				self.globalDBconn.commit()
+
+	@contextmanager
+	def bulkWriting(self, flush_size=None, flush_interval=None):
+		"""
+			Same as transaction(), for compatibility with ElasticCorpus
+		"""
+		with self.transaction():
+			yield None
+
+	def columnForField(self, field):
+		"""
+			Returns the SQL expression for a metadata field: its column if it
+			has one, otherwise the value extracted from the JSON. Accepts
+			ElasticCorpus-style "metadata.<field>" names.
+		"""
+		if not rx_valid_field.match(field):
+			raise ValueError("Invalid field name: %s" % field)
+
+		if field.startswith("metadata."):
+			field=field[len("metadata."):]
+
+		if field.lower() in PAPER_COLUMNS:
+			return field.lower()
+		if field == "metadata":
+			return "metadata"
+		return "json_extract(metadata, '$.%s')" % field
+
 	def getMetadataByGUID(self,guid):
 		"""
 		"""
 		guid=guid.lower()
-		return self.getMetadataByField("guid",guid)
+		metadata=self.getCachedMetadata(guid)
+		if metadata is None:
+			metadata=self.getMetadataByField("guid",guid)
+			self.cacheMetadata(guid,metadata)
+		return metadata
+
+	def getMetadataByGUIDs(self, guids):
+		"""
+			Returns the metadata of many papers with one query per
+			MAX_SQL_VARIABLES. None for papers that don't exist.
+		"""
+		self.checkConnectedToDB()
+
+		guids=[guid.lower() for guid in guids]
+		found={}
+		missing=[]
+		for guid in guids:
+			metadata=self.getCachedMetadata(guid)
+			if metadata is None:
+				missing.append(guid)
+			else:
+				found[guid]=metadata
+
+		c=self.globalDBconn.cursor()
+		for start in range(0,len(missing),MAX_SQL_VARIABLES):
+			batch=missing[start:start+MAX_SQL_VARIABLES]
+			c.execute("select guid, metadata from papers where guid in (%s)" % ",".join(["?"]*len(batch)),batch)
+			for guid, data in c.fetchall():
+				found[guid]=json.loads(data)
+				self.cacheMetadata(guid,found[guid])
+		c.close()
+
+		return [found.get(guid) for guid in guids]
 
 	def getMetadataByField(self,field,value):
 		"""
 			Gets a single paper's metadata given a field and its value
 		"""
-		assert self.connectedToDB(), "Not connected to DB!"
+		self.checkConnectedToDB()
 
+		column=self.columnForField(field)
 		c=self.globalDBconn.cursor()
-		c.execute("select metadata from papers where "+field+" = ?",(value,))
+		c.execute("select metadata from papers where "+column+" = ? limit 1",(value,))
 		rows=c.fetchall()
 		c.close()
 		if len(rows) > 0:
@@ -189,106 +328,241 @@ class LocalCorpus(BaseCorpus):
 				return json.loads(rows[0][0])
 			except ValueError:
 				c=self.globalDBconn.cursor()
-				c.execute("DELETE FROM papers WHERE "+field+" = ?",(value,))
+				c.execute("DELETE FROM papers WHERE "+column+" = ?",(value,))
 				c.close()
-				self.globalDBconn.commit()
+				self.commit()
 				return None
 
-	def listFieldByField(self,field1,field2,value):
+	def listFieldByField(self,field1,field2,value,table=TABLE_PAPERS,max_results=100):
 		"""
 			Returns a list: for each paper, field1 if field2==value
 		"""
-		assert self.connectedToDB(), "Not connected to DB!"
+		self.checkConnectedToDB()
+
+		if table != TABLE_PAPERS:
+			raise ValueError("Only the papers table can be queried by field")
 
+		column1=self.columnForField(field1)
 		c=self.globalDBconn.cursor()
-		c.execute(u"select ? from papers where ?=?",(field1, field2, value,))
+		c.execute("select "+column1+" from papers where "+self.columnForField(field2)+" = ? limit ?",
+			(value,max_results))
 		rows=c.fetchall()
 		c.close()
 
-	def updatePaper(self,metadata):
+		if column1 == "metadata":
+			return [json.loads(row[0]) for row in rows]
+		return [row[0] for row in rows]
+
+	def paperRow(self, metadata):
 		"""
-			Updates an existing record in the db
+			Values of the columns of the papers table for this metadata
+		"""
+		return (six.text_type(metadata["guid"]).lower(),
+		six.text_type(metadata.get("doi","")),
+		six.text_type(metadata.get("corpus_id","")),
+		six.text_type(metadata.get("filename","")),
+		six.text_type(metadata.get("norm_title","")),
+		six.text_type(metadata.get("surnames",[])),
+		six.text_type(metadata.get("year","")),
+		metadata.get("num_in_collection_references",0),
+		metadata.get("num_references",0),
+		metadata.get("num_resolvable_citations",0),
+		metadata.get("num_citations",0),
+		len(metadata.get("inlinks",[])),
+		metadata.get("import_id",""),
+		metadata.get("collection_id",""),
+		json.dumps(metadata))
+
+	def updatePaper(self,metadata,op_type="index",has_scidoc=None):
 		"""
-		assert(self.globalDBconn)
+			Updates an existing record in the db
+
+			:param metadata: metadata of paper
+			:param op_type: one of ["index", "create", "update"]. With "update",
+				the fields in metadata are added to the existing metadata, as
+				with a partial update in ElasticCorpus
+			:param has_scidoc: ignored, for compatibility with ElasticCorpus
+		"""
+		self.checkConnectedToDB()
+		guid=metadata["guid"].lower()
+		self.invalidateCachedPaper(guid)
+
+		if op_type == "update":
+			existing=self.getMetadataByField("guid",guid)
+			if existing is None:
+				raise KeyError("Paper %s not found" % guid)
+			existing.update(metadata)
+			metadata=existing
+
+		if op_type == "create":
+			statement="insert into papers values (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)"
+		else:
+			statement="insert or replace into papers values (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)"
 
 		c=self.globalDBconn.cursor()
-		c.execute("""update papers set
-		metadata=?,
-		num_in_collection_references=?,
-		num_resolvable_citations=?,
-		num_citations=?,
-		num_references=?,
-		num_inlinks=?
-		where guid = ?""",
-		(json.dumps(metadata),
-		metadata["num_in_collection_references"],
-		metadata["num_resolvable_citations"],
-		metadata["num_citations"],
-		metadata["num_references"],
-		six.text_type(len(metadata["inlinks"])),
-		six.text_type(metadata["guid"])))
-		self.globalDBconn.commit()
+		c.execute(statement,self.paperRow(metadata))
 		c.close()
+		self.commit()
+		self.matcher.paperUpdated(metadata)
+
+	def appendInlink(self, guid, inlink_guid):
+		"""
+			Adds inlink_guid to the inlinks of paper guid, if it's not there
+			already
+		"""
+		metadata=self.getMetadataByGUID(guid)
+		if metadata is not None and inlink_guid not in metadata.get("inlinks",[]):
+			metadata.setdefault("inlinks",[]).append(inlink_guid)
+			self.updatePaper(metadata)
 
-	def listPapers(self,conditions=None, field="guid"):
+	def listPapers(self,conditions=None, field="guid", max_results=None, sort=None):
 		"""
 			Return a list of GUIDs in papers table where [conditions]
+
+			:param conditions: an SQL condition string, e.g. "year > 2010"
 		"""
-		query=self.filterQuery(conditions)
-		return self.runSingleValueQuery("select %s from papers %s" % (field,conditions if conditions else ""))
+		return list(self.iterPapers(conditions,field,max_results,sort))
+
+	def iterPapers(self, conditions=None, field="guid", max_results=None, sort=None, page_size=1000):
+		"""
+			Yields the GUIDs in papers table where [conditions], reading them
+			from the DB page_size at a time. Papers can be updated while
+			iterating.
+		"""
+		self.checkConnectedToDB()
+
+		column=self.columnForField(field)
+		where=" where (%s)" % conditions if conditions else ""
 
-	def cachedDataIDString(self, type, guid, params=None):
+		if sort:
+			query="select %s from papers%s order by %s" % (column,where,sort)
+			if max_results:
+				query+=" limit %d" % int(max_results)
+			for value in self.runSingleValueQuery(query) or []:
+				yield value
+			return
+
+		# paging by guid instead of keeping a cursor open: rows that are
+		# updated while we iterate are neither skipped nor repeated
+		query="select guid, %s from papers where guid > ?%s order by guid limit ?" % (column,
+			" and (%s)" % conditions if conditions else "")
+		last_guid=""
+		num_results=0
+		while True:
+			c=self.globalDBconn.cursor()
+			c.execute(query,(last_guid,page_size))
+			rows=c.fetchall()
+			c.close()
+
+			for guid, value in rows:
+				yield value
+				num_results+=1
+				if max_results and num_results >= max_results:
+					return
+
+			if len(rows) < page_size:
+				return
+			last_guid=rows[-1][0]
+
+	def iterPapersMetadata(self, conditions=None, fields=None):
 		"""
-			Returns a string that can be used as either a path or resource ID
+			Iterates over the metadata of the papers where [conditions]
 		"""
-		res=super(self.__class__, self).cachedDataIDString(type, guid, params)
-		res+=".json"
-		if type=="resolvable_citations":
-			return os.path.join(self.paths.cachedJson,res)
-		if type=="prebuilt_bow":
-			return os.path.join(self.paths.cachedJson+guid,res)
-		return
+		for data in self.iterPapers(conditions,"metadata"):
+			yield json.loads(data)
 
 	def cachedJsonExists(self, type, guid, params=None):
 		"""
+			True if the cached JSON associated with the given parameters exists
 		"""
-		return os.path.isfile(self.cachedDataIDString(type, guid, params))
+		return self.recordExists(self.cachedDataIDString(type, guid, params), TABLE_CACHE)
+
+	def recordExists(self, id, table=TABLE_PAPERS):
+		"""
+			Returns True if the specified record exists in the given table
+		"""
+		self.checkConnectedToDB()
+
+		if table == TABLE_SCIDOCS:
+			return os.path.exists(os.path.join(self.paths.jsonDocs,id.lower()+".json"))
+
+		c=self.globalDBconn.cursor()
+		if table == TABLE_CACHE:
+			c.execute("select 1 from cache where id = ?",(id,))
+		elif table == TABLE_PAPERS:
+			c.execute("select 1 from papers where guid = ?",(id.lower(),))
+		else:
+			raise ValueError("Unknown record type")
+		res=c.fetchone() is not None
+		c.close()
+		return res
 
 	def saveCachedJson(self, path, data):
 		"""
 			Save anything as JSON
+
+			:param path: unique ID of resource to save
+			:param data: any JSON-serializable data
 		"""
-		ensureDirExists(os.path.dirname(path))
-		lines=json.dumps(bow,indent=3)
-		try:
-			f=codecs.open(path, "w","utf-8")
-			f.write(lines)
-			f.close()
-		except:
-			print("Error saving JSON", path, "Exception in saveCachedJson():",sys.exc_info()[:2])
+		self.checkConnectedToDB()
+
+		timestamp=time.time()
+		c=self.globalDBconn.cursor()
+		c.execute("insert or replace into cache values (?,?,coalesce((select time_created from cache where id = ?),?),?)",
+			(path,sqlite3.Binary(encodeRecordBytes(data,self.record_codec)),path,timestamp,timestamp))
+		c.close()
+		self.commit()
 
 	def loadCachedJson(self,path):
 		"""
-			Load precomputed JSON
+			Load precomputed JSON. Raises FileNotFoundError if it's not there,
+			like ElasticCorpus.
+
+			:param path: unique ID of resource to load
 		"""
-		try:
-			f=open(path, "rb")
-##            print "Loading saved JSON ",path
-			res=json.load(f)
-			f.close()
-			return res
-		except:
-			print("Exception in loadCachedJson():", sys.exc_info()[:2], path)
-			return None
+		self.checkConnectedToDB()
+
+		c=self.globalDBconn.cursor()
+		c.execute("select data from cache where id = ?",(path,))
+		row=c.fetchone()
+		c.close()
+		if row is None:
+			print("Exception: can't load cached JSON", path)
+			raise FileNotFoundError
+		return decodeRecord(row[0])
+
+	def loadCachedJsonMany(self, paths):
+		"""
+			Loads many precomputed JSON resources. Returns a list with the data
+			for each path, None for those that aren't in the cache.
+		"""
+		self.checkConnectedToDB()
 
-	def loadSciDoc(self,guid):
+		found={}
+		c=self.globalDBconn.cursor()
+		for start in range(0,len(paths),MAX_SQL_VARIABLES):
+			batch=list(paths[start:start+MAX_SQL_VARIABLES])
+			c.execute("select id, data from cache where id in (%s)" % ",".join(["?"]*len(batch)),batch)
+			for path, data in c.fetchall():
+				found[path]=decodeRecord(data)
+		c.close()
+		return [found.get(path) for path in paths]
+
+	def loadSciDoc(self,guid,ignore_errors=None):
 		"""
 			If a SciDocJSON file exists for guid, it returns it, otherwise None
 		"""
 		guid=guid.lower()
+		doc=self.getCachedSciDoc(guid, ignore_errors=ignore_errors)
+		if doc is not None:
+			return doc
+
 		filename=os.path.join(self.paths.jsonDocs,guid+".json")
 		if os.path.exists(filename):
-			return SciDoc(filename)
+			with open(filename, "rb") as f:
+				doc=SciDoc(decodeRecord(f.read()), ignore_errors=ignore_errors)
+			self.cacheSciDoc(guid,doc)
+			return doc
 		else:
 			return None
 
@@ -297,11 +571,18 @@ class LocalCorpus(BaseCorpus):
 			Saves the document as JSON using the SciDoc's saveToFile method,
 			name is generated from its GUID + .json
 		"""
-		filename=os.path.join(self.paths.jsonDocs,doc["metadata"]["guid"]+".json")
-		doc.saveToFile(filename, indent=self.saveDocIndent)
+		self.invalidateCachedPaper(doc["metadata"]["guid"].lower())
+		filename=os.path.join(self.paths.jsonDocs,doc["metadata"]["guid"].lower()+".json")
+		if self.record_codec == CODEC_JSON:
+			data=json.dumps(doc.data, indent=self.saveDocIndent).encode("utf-8")
+		else:
+			data=encodeRecordBytes(doc.data,self.record_codec)
+		# same file name whatever the codec, the format is detected on load
+		with open(filename, "wb") as f:
+			f.write(data)
 
 	def runSingleValueQuery(self,query):
-		assert self.globalDBconn is not None, "Not connected to DB!"
+		self.checkConnectedToDB()
 
 		c=self.globalDBconn.cursor()
 		c.execute(query)
@@ -316,68 +597,35 @@ class LocalCorpus(BaseCorpus):
 		"""
 			Make sure author is in database
 		"""
-##        if not author.get("guid",None):
-##            author["guid"]=self.generateGUID()
-		# TODO implement this
-		raise NotImplementedError
-		pass
+		self.checkConnectedToDB()
 
-	def addPaper(self, metadata, check_existing=True, ):
-		"""
-			Adds a paper's metadata to the database
-		"""
-		assert self.globalDBconn is not None, "Not connected to DB!"
+		if not author.get("author_id",None):
+			author["author_id"]=self.generateAuthorID()
 
 		c=self.globalDBconn.cursor()
-
-		if check_existing:
-			doc_meta=self.getMetadataByGUID(metadata["guid"])
-			if doc_meta:
-				self.updatePaper(metadata)
-				return
-
-		for author in metadata["authors"]:
-			self.addAuthor(author)
-
-		c.execute(u"""insert into papers (
-		GUID,
-		DOI,
-		corpus_id,
-		filename,
-		norm_title,
-		surnames,
-		year,
-		num_in_collection_references,
-		num_references,
-		num_resolvable_citations,
-		num_citations,
-		num_inlinks,
-		import_id,
-		collection_id,
-		metadata
-		)
-		values (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)""",
-		(six.text_type(metadata["guid"]),
-		six.text_type(metadata["doi"]),
-		six.text_type(metadata["corpus_id"]),
-		six.text_type(metadata["filename"]),
-##            unicode(normalizeTitle(metadata["title"])),
-		six.text_type(metadata["norm_title"]),
-		six.text_type(metadata["surnames"]),
-		six.text_type(metadata["year"]),
-		metadata["num_in_collection_references"],
-		metadata["num_references"],
-		metadata["num_resolvable_citations"],
-		metadata["num_citations"],
-		six.text_type(len(metadata["inlinks"])),
-		metadata["import_id"], # import_id
-		metadata["collection_id"], # collection_id
-		json.dumps(metadata)))
-		self.globalDBconn.commit()
+		c.execute("insert or ignore into authors values (?,?,?,?)",
+			(author["author_id"],
+			" ".join([author.get(field,"") for field in ["given","middle","family"] if author.get(field)]),
+			author.get("family",""),
+			json.dumps(author)))
 		c.close()
+		self.commit()
+
+	def addPaper(self, metadata, check_existing=True, has_scidoc=True):
+		"""
+			Adds a paper's metadata to the database
+		"""
+		op_type="create" if check_existing else "index"
+		self.updatePaper(metadata, op_type, has_scidoc)
+		if self.AUTO_ADD_AUTHORS:
+			for author in metadata.get("authors",[]):
+				self.addAuthor(author)
 
 	def addLink(self,GUID_from,GUID_to,authors_from,authors_to,year_from,year_to,numcitations):
-		assert self.globalDBconn is not None, "Not connected to DB!"
+		"""
+			Add a link in the citation graph.
+		"""
+		self.checkConnectedToDB()
 
 		c=self.globalDBconn.cursor()
 		c.execute(u"""insert into links (
@@ -389,25 +637,22 @@ class LocalCorpus(BaseCorpus):
 		year_to,
 		numcitations
 		)
-		values (?,?,?,?,?,?,?,?,?,?)""",
-		(metadata["guid"],
-		metadata["filename"],
-		normalizeTitle(metadata["title"]),
-		metadata["surnames"],
-		metadata["year"],
-		metadata["num_in_collection_references"],
-		metadata["num_references"],
-		metadata["num_resolvable_citations"],
-		metadata["num_citations"],
-		metadata))
-		self.globalDBconn.commit()
+		values (?,?,?,?,?,?,?)""",
+		(GUID_from,
+		GUID_to,
+		six.text_type(authors_from),
+		six.text_type(authors_to),
+		six.text_type(year_from),
+		six.text_type(year_to),
+		numcitations))
 		c.close()
+		self.commit()
 
 	def addMissingPaper(self, metadata):
 		"""
 			Inserts known data about an unkown paper
 		"""
-		assert self.globalDBconn is not None, "Not connected to DB!"
+		self.checkConnectedToDB()
 
 		c=self.globalDBconn.cursor()
 		metadata["norm_title"]=normalizeTitle(metadata["title"])
@@ -415,8 +660,8 @@ class LocalCorpus(BaseCorpus):
 		rows=c.fetchall()
 		if len(rows) > 0:
 			c.execute("update missing_papers set reference_counts=reference_counts+1 where norm_title=?",(metadata["norm_title"],))
-			self.globalDBconn.commit()
 			c.close()
+			self.commit()
 			return
 
 		c.execute("""insert into missing_papers (
@@ -424,51 +669,78 @@ class LocalCorpus(BaseCorpus):
 		reference_counts,
 		metadata)
 		values (?,?,?)""",
-		(six.text_type(normalizeTitle(metadata["title"])),
+		(six.text_type(metadata["norm_title"]),
 		0,
 		six.text_type(json.dumps(metadata))))
-		self.globalDBconn.commit()
 		c.close()
+		self.commit()
 
-	def updateAllPapersMetadataOutlinks(self):
+	def bulkDelete(self, id_list, table=TABLE_PAPERS):
 		"""
-			Goes through the papers table, updating the outlinks in the metadata
-			field with the actual in-collection references.
-
-			Returns a list of guids of documents that have experienced changes,
-			so that indeces can be rebuilt accordingly if neccesary
+			Deletes all entries in id_list from the given table that match on id.
 		"""
+		self.checkConnectedToDB()
 
-		res=[]
-		for paper_guid in self.listPapers():
-			metadata=self.getMetadataByGUID(paper_guid)
-			old_outlinks=metadata["outlinks"]
-			doc=self.loadSciDoc(metadata["guid"])
-			new_outlinks=self.listDocInCollectionReferences(doc)
+		if table == TABLE_SCIDOCS:
+			for guid in id_list:
+				self.invalidateCachedPaper(guid.lower())
+				filename=os.path.join(self.paths.jsonDocs,guid.lower()+".json")
+				if os.path.exists(filename):
+					os.remove(filename)
+			return
 
-			if set(new_outlinks) != set(old_outlinks):
-				res.append(paper_guid)
-			metadata["outlinks"]=new_outlinks
-			self.updatePaper(metadata)
+		if table == TABLE_PAPERS:
+			id_list=[guid.lower() for guid in id_list]
+			for guid in id_list:
+				self.invalidateCachedPaper(guid)
+			self.matcher.papersDeleted(id_list)
+			statement="delete from papers where guid in (%s)"
+		elif table == TABLE_CACHE:
+			statement="delete from cache where id in (%s)"
+		else:
+			raise ValueError("Unknown record type")
 
-		return res
+		c=self.globalDBconn.cursor()
+		for start in range(0,len(id_list),MAX_SQL_VARIABLES):
+			batch=list(id_list[start:start+MAX_SQL_VARIABLES])
+			c.execute(statement % ",".join(["?"]*len(batch)),batch)
+		c.close()
+		self.commit()
 
-	def createDBindeces(self):
+	def deleteAll(self, record_type):
 		"""
-			Call this after importing the metadata into the corpus and before
-			matching in-collection references, it will speed up search massively
+			WARNING! This function deletes all the records in a given "table" or
+			of a given type.
+
+			:param record_type: one of ["papers","links","authors","scidocs","cache"]
 		"""
+		self.checkConnectedToDB()
+		self.scidoc_cache.clear()
+		self.metadata_cache.clear()
+
+		if record_type == TABLE_SCIDOCS:
+			for filename in glob.glob(os.path.join(self.paths.jsonDocs,"*.json")):
+				os.remove(filename)
+			return
+
+		tables={TABLE_PAPERS: "papers", TABLE_LINKS: "links", TABLE_AUTHORS: "authors",
+			TABLE_CACHE: "cache", TABLE_MISSING_REFERENCES: "missing_papers"}
+		if record_type not in tables:
+			raise ValueError("Unknown record type")
 
 		c=self.globalDBconn.cursor()
-		c.execute(u"CREATE UNIQUE INDEX `papers_guid` ON `papers` (`GUID` ASC);")
-		c.execute(u"CREATE  INDEX `papers_doi` ON `papers` (`DOI` ASC);")
-		c.execute(u"CREATE  INDEX `papers_corpus_id` ON `papers` (`corpus_id` ASC);")
-		c.execute(u"CREATE  INDEX `papers_norm_title` ON `papers` (`norm_title` ASC);")
-		c.execute(u"CREATE  INDEX `papers_num_in_collection_references` ON `papers` (`num_in_collection_references` DESC);")
-		c.execute(u"CREATE  INDEX `papers_matchable_citations` ON `papers` (`num_resolvable_citations` DESC);")
-		c.execute(u"CREATE  INDEX `papers_inlinks` ON `papers` (`num_inlinks` DESC);")
+		c.execute("delete from %s" % tables[record_type])
 		c.close()
-		self.globalDBconn.commit()
+		self.commit()
+		if record_type == TABLE_PAPERS:
+			self.matcher.papersDeleted()
+
+	def createDBindeces(self):
+		"""
+			Creates the indexes for the lookup fields. They are now created on
+			connection, so this is only needed for DBs opened some other way.
+		"""
+		self.createTables(self.globalDBconn)
 
 	def setCorpusFilter(self, collection_id=None, import_id=None, date=None):
 		"""
@@ -0,0 +1,145 @@
+# In-process LRU cache of parsed documents and metadata
+#
+# Copyright:   (c) Daniel Duma 2018
+# Author: Daniel Duma <danielduma@gmail.com>
+
+# For license information, see LICENSE.TXT
+
+from __future__ import absolute_import
+import marshal
+import pickle
+import threading
+from collections import OrderedDict
+
+# limits used when a pipeline turns the caches on, see setObjectCacheLimits()
+DEFAULT_SCIDOC_CACHE_ITEMS = 200
+DEFAULT_SCIDOC_CACHE_BYTES = 256 * 1024 * 1024
+DEFAULT_METADATA_CACHE_ITEMS = 20000
+DEFAULT_METADATA_CACHE_BYTES = 64 * 1024 * 1024
+
+
+def freezeData(data):
+    """
+        Serializes JSON-like data (dicts, lists, strings, numbers) to bytes.
+        marshal is much faster than json or deepcopy for these, pickle is the
+        fallback for anything else.
+    """
+    try:
+        return marshal.dumps(data)
+    except ValueError:
+        return b"P" + pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
+
+
+def thawData(frozen):
+    """
+        Returns a new copy of the data frozen with freezeData()
+    """
+    if frozen[:1] == b"P":
+        return pickle.loads(frozen[1:])
+    return marshal.loads(frozen)
+
+
+class ObjectCache(object):
+    """
+        LRU cache bounded both by number of items and by their approximate size
+        in memory, with hit/miss counters. Thread-safe.
+
+        Items are stored serialized, so every .get() returns a fresh copy:
+        callers can modify what they get (e.g. selectDocResolvableCitations
+        removes citations from the text) without corrupting the cache. The
+        size of an item is the size of its serialized form.
+
+        A cache with max_items=0 or max_bytes=0 is disabled.
+    """
+
+    def __init__(self, max_items, max_bytes):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.items = OrderedDict()
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self):
+        return self.max_items > 0 and self.max_bytes > 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def setLimits(self, max_items, max_bytes):
+        """
+            Changes the limits, evicting items if needed
+        """
+        with self.lock:
+            self.max_items = max_items
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def _evict(self):
+        while self.items and (len(self.items) > self.max_items or self.total_bytes > self.max_bytes):
+            key, frozen = self.items.popitem(last=False)
+            self.total_bytes -= len(frozen)
+
+    def get(self, key):
+        """
+            Returns a copy of the cached data for key, or None if not cached
+        """
+        if not self.enabled:
+            return None
+
+        with self.lock:
+            frozen = self.items.get(key)
+            if frozen is None:
+                self.misses += 1
+                return None
+            self.items.move_to_end(key)
+            self.hits += 1
+        return thawData(frozen)
+
+    def set(self, key, data):
+        """
+            Stores a snapshot of data: changing data afterwards doesn't change
+            the cached copy. Items bigger than the whole cache aren't stored.
+        """
+        if not self.enabled or data is None:
+            return
+
+        frozen = freezeData(data)
+        if len(frozen) > self.max_bytes:
+            self.invalidate(key)
+            return
+
+        with self.lock:
+            old = self.items.pop(key, None)
+            if old is not None:
+                self.total_bytes -= len(old)
+            self.items[key] = frozen
+            self.total_bytes += len(frozen)
+            self._evict()
+
+    def invalidate(self, key):
+        with self.lock:
+            old = self.items.pop(key, None)
+            if old is not None:
+                self.total_bytes -= len(old)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.total_bytes = 0
+
+    def stats(self):
+        """
+            Returns a dict with the counters and current size of the cache
+        """
+        total = self.hits + self.misses
+        return {"items": len(self.items),
+                "bytes": self.total_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / float(total) if total else 0.0}
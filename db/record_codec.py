@@ -0,0 +1,148 @@
+# Serialization of SciDocs and cached JSON for storage
+#
+# Copyright:   (c) Daniel Duma 2018
+# Author: Daniel Duma <danielduma@gmail.com>
+
+# For license information, see LICENSE.TXT
+
+"""
+    Records (SciDocs, BOWs, resolvable citations) used to be stored as plain
+    JSON strings. The other codecs store them compressed, as
+
+        ~<codec name>:<base64 of the encoded bytes>
+
+    in the text fields of Elasticsearch, or as ~<codec name>:<bytes> in files
+    and SQLite blobs. A JSON value can't start with "~", so records saved in
+    any format can always be read, whatever the current codec is.
+
+    "zlib-json" only needs the standard library. "zstd-msgpack" is smaller and
+    much faster to decode, but needs the msgpack and zstandard packages on
+    every machine that reads the records.
+
+    New records are saved as plain JSON unless a codec is chosen with
+    Corpus.setRecordCodec(), or with the "record_codec" option of an import
+    or a pipeline.
+"""
+
+from __future__ import absolute_import
+import base64
+import json
+import zlib
+
+import six
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+CODEC_JSON = "json"
+CODEC_ZLIB_JSON = "zlib-json"
+CODEC_ZSTD_MSGPACK = "zstd-msgpack"
+
+DEFAULT_CODEC = CODEC_JSON
+
+CODEC_MARKER = "~"
+CODEC_SEPARATOR = ":"
+
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 3
+
+
+def _encodeZlibJson(data):
+    return zlib.compress(json.dumps(data, separators=(",", ":")).encode("utf-8"), ZLIB_LEVEL)
+
+
+def _decodeZlibJson(encoded):
+    return json.loads(zlib.decompress(encoded).decode("utf-8"))
+
+
+def _encodeZstdMsgpack(data):
+    return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(msgpack.packb(data, use_bin_type=True))
+
+
+def _decodeZstdMsgpack(encoded):
+    return msgpack.unpackb(zstandard.ZstdDecompressor().decompress(encoded), raw=False)
+
+
+# name: (encoder, decoder, required modules)
+CODECS = {
+    CODEC_ZLIB_JSON: (_encodeZlibJson, _decodeZlibJson, []),
+    CODEC_ZSTD_MSGPACK: (_encodeZstdMsgpack, _decodeZstdMsgpack, [("msgpack", msgpack), ("zstandard", zstandard)]),
+}
+
+
+def availableCodecs():
+    """
+        Names of the codecs that can be used with the installed packages
+    """
+    res = [CODEC_JSON]
+    for name, (encoder, decoder, modules) in CODECS.items():
+        if all([module is not None for module_name, module in modules]):
+            res.append(name)
+    return res
+
+
+def _getCodec(name):
+    if name not in CODECS:
+        raise ValueError("Unknown codec: %s" % name)
+
+    encoder, decoder, modules = CODECS[name]
+    missing = [module_name for module_name, module in modules if module is None]
+    if missing:
+        raise ImportError("Codec %s needs these packages: %s" % (name, ", ".join(missing)))
+    return encoder, decoder
+
+
+def checkCodec(name):
+    """
+        Raises ValueError or ImportError if the codec can't be used here
+    """
+    if name != CODEC_JSON:
+        _getCodec(name)
+
+
+def encodeRecord(data, codec=DEFAULT_CODEC):
+    """
+        Encodes data as a string, for text fields
+    """
+    if codec == CODEC_JSON:
+        return json.dumps(data)
+
+    encoder, decoder = _getCodec(codec)
+    return CODEC_MARKER + codec + CODEC_SEPARATOR + base64.b64encode(encoder(data)).decode("ascii")
+
+
+def encodeRecordBytes(data, codec=DEFAULT_CODEC):
+    """
+        Encodes data as bytes, for files and blobs
+    """
+    if codec == CODEC_JSON:
+        return json.dumps(data).encode("utf-8")
+
+    encoder, decoder = _getCodec(codec)
+    return (CODEC_MARKER + codec + CODEC_SEPARATOR).encode("ascii") + encoder(data)
+
+
+def decodeRecord(value):
+    """
+        Decodes a record saved with any codec, as a string or bytes. Plain
+        JSON is detected, so records saved before codecs existed still load.
+    """
+    if isinstance(value, six.binary_type):
+        if not value.startswith(CODEC_MARKER.encode("ascii")):
+            return json.loads(value.decode("utf-8"))
+        header, encoded = value[1:].split(CODEC_SEPARATOR.encode("ascii"), 1)
+        encoder, decoder = _getCodec(header.decode("ascii"))
+        return decoder(encoded)
+
+    if not value.startswith(CODEC_MARKER):
+        return json.loads(value)
+    name, encoded = value[1:].split(CODEC_SEPARATOR, 1)
+    encoder, decoder = _getCodec(name)
+    return decoder(base64.b64decode(encoded))
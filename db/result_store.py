@@ -10,10 +10,10 @@ from __future__ import print_function
 from __future__ import absolute_import
 import json, sys, time, os, glob
 
-from elasticsearch import Elasticsearch
 from elasticsearch.exceptions import ConnectionTimeout, ConnectionError, TransportError
 from proc.nlp_functions import AZ_ZONES_LIST, CORESC_LIST, RANDOM_ZONES_7, RANDOM_ZONES_11
 from proc.general_utils import ensureDirExists
+from db.elastic_connection import getElasticClient
 
 import db.corpora as cp
 import six
@@ -79,10 +79,10 @@ class ElasticResultStorer(object):
 
     def connect(self):
         """
-            Connect to elasticsearch server
+            Connect to elasticsearch server. All the storers for the same
+            endpoint share a client.
         """
-        self.es = Elasticsearch([self.endpoint], timeout=DEFAULT_TIMEOUT)
-        self.es.retry_on_timeout = True
+        self.es = getElasticClient(self.endpoint, timeout=DEFAULT_TIMEOUT)
 
     def refreshIndex(self):
         self.es.indices.refresh(index=self.index_name)
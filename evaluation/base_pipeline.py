@@ -13,8 +13,13 @@ from copy import deepcopy
 from collections import defaultdict
 
 from retrieval.base_retrieval import BaseRetrieval, MAX_RESULTS_RECALL
+from retrieval.concurrent_retrieval import createConcurrentRetrieval
+from retrieval.explain_cache import createExplainCache
 
 import db.corpora as cp
+from db.elastic_connection import configureConnections
+from db.object_cache import (DEFAULT_SCIDOC_CACHE_ITEMS, DEFAULT_SCIDOC_CACHE_BYTES,
+                             DEFAULT_METADATA_CACHE_ITEMS, DEFAULT_METADATA_CACHE_BYTES)
 from proc.results_logging import ResultsLogger
 from .pipeline_functions import getDictOfTestingMethods
 from .weight_functions import addExtraWeights
@@ -52,6 +57,18 @@ class BaseTestingPipeline(object):
         self.max_per_class_results = 1000
         self.previous_guid = ""
         self.per_class_count = {}
+        self.explain_cache = None
+
+    def setExplainCaches(self):
+        """
+            Makes all retrieval models that support it share the explain cache
+        """
+        if not self.explain_cache:
+            return
+
+        for model in self.retrieval_models.values():
+            if hasattr(model, "setExplainCache"):
+                model.setExplainCache(self.explain_cache)
 
     def loadModelForSingleFile(self, guid):
         """
@@ -64,6 +81,7 @@ class BaseTestingPipeline(object):
                 model["method"],
                 logger=None,
                 use_default_similarity=self.exp["use_default_similarity"])
+        self.setExplainCaches()
 
     def generateRetrievalModels(self, all_doc_methods, all_files, ):
         """
@@ -183,6 +201,7 @@ class BaseTestingPipeline(object):
                     multi_match_type=all_doc_methods[model["method"]].get("multi_match_type"))
 
         self.main_all_doc_methods = all_doc_methods
+        self.setExplainCaches()
 
     def newResultDict(self, guid, precomputed_query, doc_method):
         """
@@ -263,9 +282,11 @@ class BaseTestingPipeline(object):
         elif isinstance(actual_runtime_parameters, dict):
             return self.main_all_doc_methods[method]["runtime_parameters"]
 
-    def processOneQuery(self, precomputed_query):
+    def prepareQuery(self, precomputed_query):
         """
-            Runs the retrieval and evaluation for a single query
+            Checks if the query has to be run and sets everything up for it.
+            Returns the dict of doc_methods with their runtime parameters, or
+            None if the query must be skipped.
         """
         if self.exp.get("queries_classification", "") not in ["", None]:
             query_class = self.exp.get("queries_classification", None)
@@ -275,12 +296,9 @@ class BaseTestingPipeline(object):
                     self.per_class_count[q_type] += 1
                 else:
                     # print("Too many queries of type %s already" % q_type)
-                    return
+                    return None
 
         guid = precomputed_query["file_guid"]
-        meta = cp.Corpus.getMetadataByGUID(guid)
-        self.logger.total_citations += meta["num_resolvable_citations"]
-
         all_doc_methods = deepcopy(self.main_all_doc_methods)
 
         # If we're running per-file resolution and we are now on a different file, load its model
@@ -292,40 +310,121 @@ class BaseTestingPipeline(object):
         for method in self.main_all_doc_methods:
             all_doc_methods[method]["runtime_parameters"] = self.setRuntimeParameters(method, precomputed_query)
 
-        self.current_all_doc_methods = all_doc_methods
+        return all_doc_methods
 
+    def explainResults(self, precomputed_query, doc_method, retrieved_results):
+        """
+            To be overriden by descendant classes: the requests to ES that
+            addResult() needs for these results (e.g. explaining them), as long
+            as they don't touch the logger or the writers, so that they can run
+            on a worker thread together with the query. Whatever this returns
+            is passed to addResult() as `explained`.
+        """
+        return None
+
+    def runQueryForAllMethods(self, precomputed_query, all_doc_methods):
+        """
+            Runs the query with every doc_method, and explainResults() on its
+            results. Only talks to ES, so that it can run on a worker thread.
+
+            :returns: tuple (metadata of the citing file, list of
+                (doc_method, method_query, retrieval_results, explained) tuples)
+        """
+        meta = cp.Corpus.getMetadataByGUID(precomputed_query["file_guid"])
+
+        all_results = []
         # for every method used for extracting BOWs
         for doc_method in all_doc_methods:
             # Log everything if the logger is enabled
             ##                self.logger.logReport("Citation: "+precomputed_query["citation_id"]+"\n Query method:"+precomputed_query["query_method"]+" \nDoc method: "+doc_method +"\n")
             ##                self.logger.logReport(precomputed_query["query_text"]+"\n")
 
+            # runQuery() stores the query it ran (e.g. "dsl_query") in the
+            # dict, and addResult() explains the results with it, so every
+            # method gets its own copy
+            method_query = dict(precomputed_query)
+
             # ACTUAL RETRIEVAL HAPPENING - run query
             retrieval_results = self.retrieval_models[doc_method].runQuery(
-                precomputed_query,
+                method_query,
                 addExtraWeights(all_doc_methods[doc_method]["runtime_parameters"], self.exp),
                 test_guid=None,
                 max_results=self.exp.get("max_results_recall", MAX_RESULTS_RECALL))
 
             # print("Query:", precomputed_query["query_text"])
             # print(addExtraWeights(all_doc_methods[doc_method]["runtime_parameters"], self.exp))
+            explained = None
+            if retrieval_results:
+                explained = self.explainResults(method_query, doc_method, retrieval_results)
+            all_results.append((doc_method, method_query, retrieval_results, explained))
 
+        return meta, all_results
+
+    def addQueryResults(self, precomputed_query, all_doc_methods, meta, all_results):
+        """
+            Adds the results of runQueryForAllMethods() to the log. Always
+            runs on the main thread, in the order of the queries.
+        """
+        guid = precomputed_query["file_guid"]
+        self.logger.total_citations += meta["num_resolvable_citations"]
+        self.current_all_doc_methods = all_doc_methods
+
+        for doc_method, method_query, retrieval_results, explained in all_results:
             if not retrieval_results:  # the query was empty or something
-                self.addEmptyResult(guid, precomputed_query, doc_method)
+                self.addEmptyResult(guid, method_query, doc_method)
+            elif explained is None:
+                self.addResult(guid, method_query, doc_method, retrieval_results)
             else:
-                self.addResult(guid, precomputed_query, doc_method, retrieval_results)
+                self.addResult(guid, method_query, doc_method, retrieval_results, explained=explained)
 
         if self.exp.get("add_random_control_result", False):
             self.addRandomControlResult(guid, precomputed_query)
 
         self.logger.showProgressReport("Running queries")  # prints out info on how it's going
 
+    def processOneQuery(self, precomputed_query):
+        """
+            Runs the retrieval and evaluation for a single query
+        """
+        all_doc_methods = self.prepareQuery(precomputed_query)
+        if all_doc_methods is None:
+            return
+
+        meta, all_results = self.runQueryForAllMethods(precomputed_query, all_doc_methods)
+        self.addQueryResults(precomputed_query, all_doc_methods, meta, all_results)
+
     def processAllQueries(self):
         """
             MAIN LOOP over all precomputed queries
+
+            If exp["concurrent_queries"] > 1, keeps that many queries in
+            flight on a thread pool, each with the explainResults() of its
+            results. Results are still logged in order on the main thread. Only possible with a full_corpus index, as per-file
+            models have to be loaded in sequence.
         """
-        for precomputed_query in self.precomputed_queries:
-            self.processOneQuery(precomputed_query)
+        concurrent = None
+        if self.exp["full_corpus"]:
+            concurrent = createConcurrentRetrieval(self.exp)
+
+        if concurrent is None:
+            for precomputed_query in self.precomputed_queries:
+                self.processOneQuery(precomputed_query)
+            return
+
+        def prepareAll():
+            for precomputed_query in self.precomputed_queries:
+                all_doc_methods = self.prepareQuery(precomputed_query)
+                if all_doc_methods is not None:
+                    yield precomputed_query, all_doc_methods
+
+        def runOne(item):
+            precomputed_query, all_doc_methods = item
+            meta, all_results = self.runQueryForAllMethods(precomputed_query, all_doc_methods)
+            return precomputed_query, all_doc_methods, meta, all_results
+
+        with concurrent:
+            for precomputed_query, all_doc_methods, meta, all_results in concurrent.imap(runOne, prepareAll()):
+                self.addQueryResults(precomputed_query, all_doc_methods, meta, all_results)
 
     def annotateDocuments(self):
         """
@@ -350,11 +449,27 @@ class BaseTestingPipeline(object):
             for model in self.retrieval_models.items():
                 model.tie_breaker = self.exp["similiarity_tie_breaker"]
 
+        # e.g. {"maxsize": 20, "max_retries": 5}, see db.elastic_connection
+        if self.exp.get("es_connection_options"):
+            configureConnections(**self.exp["es_connection_options"])
+
         self.initializePipeline()
         self.loadQueriesAndFileList()
         self.startLogging()
         self.annotateDocuments()
         self.logger.setNumItems(len(self.precomputed_queries))
+        if self.exp.get("concurrent_queries", 1) > 1 and hasattr(cp.Corpus, "setConnectionPoolSize"):
+            cp.Corpus.setConnectionPoolSize(self.exp["concurrent_queries"])
+        self.explain_cache = createExplainCache(self.exp)
+        # the corpus caches are off by default, a pipeline only reads papers
+        cp.Corpus.setObjectCacheLimits(
+            scidoc_items=self.exp.get("scidoc_cache_items", DEFAULT_SCIDOC_CACHE_ITEMS),
+            scidoc_bytes=self.exp.get("scidoc_cache_bytes", DEFAULT_SCIDOC_CACHE_BYTES),
+            metadata_items=self.exp.get("metadata_cache_items", DEFAULT_METADATA_CACHE_ITEMS),
+            metadata_bytes=self.exp.get("metadata_cache_bytes", DEFAULT_METADATA_CACHE_BYTES))
+        # SciDocs and BOWs saved by the pipeline, e.g. "zlib-json", see db.record_codec
+        if self.exp.get("record_codec"):
+            cp.Corpus.setRecordCodec(self.exp["record_codec"])
         self.populateMethods()
 
         self.previous_guid = ""
@@ -9,7 +9,7 @@ from __future__ import print_function
 from __future__ import absolute_import
 import sys
 
-from .prebuild_functions import prebuildMulti
+from .prebuild_functions import prebuildMulti, prebuildInlinkContextBySource
 from multi.tasks import prebuildBOWTask
 from celery import group
 
@@ -79,9 +79,24 @@ class BasePrebuilder(object):
                 print("KeyboardInterrupt: Skipping to next stage")
                 pass
         else:
+            methods = list(self.exp["prebuild_bows"].keys())
+            if self.options.get("prebuild_ilc_by_source", False):
+                # inlink_context BOWs are built going over the citing documents
+                for method_name in [method_name for method_name in methods
+                                    if self.exp["prebuild_bows"][method_name]["function_name"] ==
+                                       "generateDocBOWInlinkContext"]:
+                    methods.remove(method_name)
+                    prebuildInlinkContextBySource(
+                        method_name,
+                        self.exp["prebuild_bows"][method_name]["parameters"],
+                        cp.Corpus.ALL_FILES[:maxfiles],
+                        self.options["overwrite_existing_bows"],
+                        self.exp.get("filter_options_ilc", {}),
+                    )
+
             progress = ProgressIndicator(True, numfiles, False)
             for guid in cp.Corpus.ALL_FILES[:maxfiles]:
-                for method_name in self.exp["prebuild_bows"]:
+                for method_name in methods:
 
                     prebuildMulti(
                         method_name,
@@ -212,7 +212,7 @@ def getNormalisedTermScores(precomputed_query, doc_list, retrieval_model):
     :param retrieval_model:
     :return: dict of dicts of term scores {match_guid: {term: score}}
     """
-    formulas = [retrieval_model.formulaFromExplanation(precomputed_query, doc_id) for doc_id in doc_list]
+    formulas = retrieval_model.formulasFromExplanations(precomputed_query, doc_list)
     raw_term_scores = listOfTermValuesInFormulas(formulas)
     formula_docfreq = getIDFfromFormulas(formulas)
     for term in raw_term_scores:
@@ -13,6 +13,7 @@ from celery.result import ResultSet
 
 import db.corpora as cp
 from evaluation.keyword_functions import annotateKeywords
+from evaluation.keyword_annotation import getNormalisedTermScores
 from db.result_store import ElasticResultStorer, ResultDiskReader, ResultIncrementalReader, OfflineResultReader
 from proc.general_utils import ensureDirExists
 from retrieval.base_retrieval import BaseRetrieval
@@ -86,13 +87,24 @@ class KeywordAnnotationPipeline(PrecomputedPipeline):
                 # print(guid,"done")
                 # progress.showProgressReport("Annotating documents")
 
-    def addResult(self, file_guid, precomputed_query, doc_method, retrieved_results):
+    def explainResults(self, precomputed_query, doc_method, retrieved_results):
+        """
+            Gets the term scores from the explanations of the results on the
+            worker thread, see BaseTestingPipeline.explainResults()
+        """
+        if self.use_celery:
+            return None
+        doc_list = [hit[1]["guid"] for hit in retrieved_results]
+        return getNormalisedTermScores(precomputed_query, doc_list, self.retrieval_models[doc_method])
+
+    def addResult(self, file_guid, precomputed_query, doc_method, retrieved_results, explained=None):
         """
             This is where we select the top keywords for a query/citation based on
             the retrieved results and the score of keywords for the document's match
 
             :param file_guid: guid of the file the citation originates from
             :param precomputed_query: dict with info about the query that has already been extracted
+            :param explained: what getNormalisedTermScores() returns, if available
         """
         doc_list = [hit[1]["guid"] for hit in retrieved_results]
 
@@ -146,7 +158,8 @@ class KeywordAnnotationPipeline(PrecomputedPipeline):
                              self.exp["keyword_selector"],
                              self.exp["keyword_selection_parameters"],
                              weights,
-                             self.annotator
+                             self.annotator,
+                             term_scores=explained
                              )
 
     def saveMissingFiles(self):
@@ -45,6 +45,16 @@ def addMissingFile(docfrom, precomputed_query, cit, missing_guid):
     MISSING_FILES.append(mfile)
 
 
+def getKeywordSelectionMode(keyword_selector):
+    """
+        Returns "offline" if the selector's last selectKeywords() scored the
+        keyword selections it tried from the formulas, "live" otherwise
+    """
+    if getattr(keyword_selector, "term_index", None):
+        return "offline"
+    return "live"
+
+
 def annotateContext(sentences, annotator, cit, docfrom, all_kws):
     # annotate all token features for this context
     sentences = annotator.annotate_context(sentences, cit, docfrom)
@@ -74,7 +84,8 @@ def annotateKeywords(precomputed_query,
                      keyword_selector_class,
                      keyword_selection_parameters,
                      weights,
-                     annotator
+                     annotator,
+                     term_scores=None
                      ):
     """
         Creates an annotated context.
@@ -84,6 +95,9 @@ def annotateKeywords(precomputed_query,
         3. Uses formulas to select the top keywords for that context
         4. Measures scores of selected keywords
         5. Packages it all together
+
+        :param term_scores: what getNormalisedTermScores() returns, if it was
+            already run for this query and doc_list
     """
     LOG_MISSING_FILES = False
 
@@ -121,9 +135,9 @@ def annotateKeywords(precomputed_query,
 
     keyword_selector = keyword_selector_class("")
 
-    norm_term_scores, formulas, match_formulas = getNormalisedTermScores(precomputed_query,
-                                                                         doc_list,
-                                                                         retrieval_model)
+    if term_scores is None:
+        term_scores = getNormalisedTermScores(precomputed_query, doc_list, retrieval_model)
+    norm_term_scores, formulas, match_formulas = term_scores
     docFreq, maxDocs = getDictOfDocFreq(formulas)
 
     selected_keywords = keyword_selector.selectKeywords(precomputed_query,
@@ -133,10 +147,16 @@ def annotateKeywords(precomputed_query,
                                                         cit,
                                                         weights,
                                                         norm_term_scores,
-                                                        docFreq
+                                                        docFreq,
+                                                        maxDocs=maxDocs,
+                                                        rawScores={"formulas": formulas,
+                                                                   "match_formulas": match_formulas}
                                                         )
 
     kw_data["best_kws"] = selected_keywords
+    # how the selector scored the candidate selections: "offline" from the
+    # formulas (see KeywordTermIndex) or "live". best_kws are measured live
+    kw_data["kw_selection_mode"] = getKeywordSelectionMode(keyword_selector)
     if len(kw_data["best_kws"]) == 0 and LOG_MISSING_FILES:
         addMissingFile(docfrom, precomputed_query, cit,
                        precomputed_query["match_guids"])  # for debugging purposes, keep a list of missing files
@@ -169,7 +189,8 @@ def runVariousKeywordSelections(precomputed_query,
                                 extraction_parameter,
                                 keyword_selection_parameters,
                                 weights,
-                                annotator
+                                annotator,
+                                term_scores=None
                                 ):
     """
         Like annotateKeywords() but it tests different KW selection classes with
@@ -214,9 +235,9 @@ def runVariousKeywordSelections(precomputed_query,
     #     print("aha")
 
     measureScores(doc_list, precomputed_query["match_guids"], kw_data)
-    norm_term_scores, formulas, match_formulas = getNormalisedTermScores(precomputed_query,
-                                                                         doc_list,
-                                                                         retrieval_model)
+    if term_scores is None:
+        term_scores = getNormalisedTermScores(precomputed_query, doc_list, retrieval_model)
+    norm_term_scores, formulas, match_formulas = term_scores
     docFreq, maxDocs = getDictOfDocFreq(formulas)
 
     raw_data = {
@@ -260,6 +281,7 @@ def runVariousKeywordSelections(precomputed_query,
                                                             )
 
         kw_data_copy["best_kws"] = selected_keywords
+        kw_data_copy["kw_selection_mode"] = getKeywordSelectionMode(keyword_selector)
 
         # print("Query:", precomputed_query["vis_text"], "\n\n")
         # print("Chosen terms:", selected_keywords, "\n\n")
@@ -341,13 +363,14 @@ def multiAnnotateKeywords(precomputed_query,
 
 def precomputeFormulas(retrieval_model, query, doc_list):
     """
-        It runs the .formulaFromExplanation() method of BaseRetrieval
+        It runs the .formulasFromExplanations() method of BaseRetrieval, which
+        explains all of doc_list in as few requests as the model allows
     """
     results = []
     ##    print("Computing explain formulas...")
     ##    progress=ProgressIndicator(True, numitems=len(doc_list), print_out=False)
-    for doc_id in doc_list:
-        formula = retrieval_model.formulaFromExplanation(query, doc_id)
+    formulas = retrieval_model.formulasFromExplanations(query, doc_list)
+    for doc_id, formula in zip(doc_list, formulas):
         # we assume that if a document was returned it must match
         results.append({"guid": doc_id, "formula": formula.formula})
     ##        progress.showProgressReport("Computing explain formulas -- %s" % doc_id)
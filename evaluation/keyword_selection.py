@@ -163,7 +163,7 @@ def getTermScores(precomputed_query, doc_list, retrieval_model):
     :param retrieval_model:
     :return: dict of dicts of term scores
     """
-    formulas = [retrieval_model.formulaFromExplanation(precomputed_query, doc_id) for doc_id in doc_list]
+    formulas = retrieval_model.formulasFromExplanations(precomputed_query, doc_list)
     term_values = listOfTermValuesInFormulas(formulas)
 
     all_term_scores = {}
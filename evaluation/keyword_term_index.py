@@ -0,0 +1,207 @@
+# Offline evaluation of keyword selections from precomputed explain formulas
+#
+# Copyright:   (c) Daniel Duma 2018
+# Author: Daniel Duma <danielduma@gmail.com>
+
+# For license information, see LICENSE.TXT
+
+from __future__ import print_function
+from __future__ import absolute_import
+
+import numpy as np
+
+from models.keyword_features import tokenWeight
+from proc.results_logging import measureScores
+from proc.structured_query import StructuredQuery
+from evaluation.keyword_annotation import termScoresInFormula, TERM_POSITION_IN_TUPLE
+from evaluation.keyword_annotation_measurement import getCountsInQuery
+
+
+def formulaIsAdditive(part):
+    """
+        True if the formula is a sum of per-term scores, i.e. if it has no
+        max/coord/product nodes that would make a term's contribution depend
+        on the other terms in the query
+    """
+    if isinstance(part, tuple) or isinstance(part, list):
+        return True
+    elif isinstance(part, dict):
+        if part.get("type") == "+":
+            return all([formulaIsAdditive(sub_part) for sub_part in part["parts"]])
+        elif part.get("type") == "const":
+            return True
+        elif "type" not in part:
+            # formula of a document that didn't match
+            return len(part.get("matches", [])) == 0
+    return False
+
+
+def normaliseTerm(term):
+    """
+        Phrases are reported by .explain() in quotes
+    """
+    return term.strip("\"")
+
+
+class KeywordTermIndex(object):
+    """
+        Term x document matrix of the score contribution of each query term to
+        each document, built once per citation context from the explain
+        formulas of the retrieved documents (which need save_terms=True).
+
+        With the bool/should DSL query that ElasticRetrieval builds, a
+        document's score is the sum over the query terms of
+        boost * count * field_weight * (idf * tf norm) and none of these
+        depend on the other terms in the query. So the score of any subset of
+        the keywords with any boosts can be computed locally by rescaling the
+        rows of the matrix, instead of running a new query.
+
+        Only the documents the formulas come from (the original top N plus the
+        cited documents) are ranked, so a document that was not in the
+        original results but would be retrieved by a smaller query is missed.
+        The field weights must be the same as those the formulas were
+        explained with.
+    """
+
+    def __init__(self, precomputed_query, formulas, guids):
+        """
+            :param precomputed_query: the query the formulas were explained for
+            :param formulas: list of StoredFormula or formula dicts
+            :param guids: guid of the document of each formula
+        """
+        self.precomputed_query = precomputed_query
+        self.guids = []
+        self.term_index = {}
+        self.is_additive = True
+
+        original_query = precomputed_query["structured_query"]
+        if not isinstance(original_query, StructuredQuery):
+            original_query = StructuredQuery(original_query)
+
+        # the multiplier each term was explained with
+        original_boosts = {}
+        for token in original_query:
+            original_boosts[token.token] = original_boosts.get(token.token, 0) + (token.boost or 0) * (token.count or 0)
+
+        contributions = []
+        seen_guids = set()
+        for formula, guid in zip(formulas, guids):
+            if guid in seen_guids:
+                continue
+            seen_guids.add(guid)
+
+            formula = getattr(formula, "formula", formula)
+            if not formulaIsAdditive(formula):
+                self.is_additive = False
+
+            doc_index = len(self.guids)
+            self.guids.append(guid)
+
+            for hit in termScoresInFormula(formula) or []:
+                # hits are (field, qw, fw[, tf, docFreq, maxDocs], term)
+                if len(hit) not in [4, TERM_POSITION_IN_TUPLE + 1]:
+                    raise ValueError("Formulas need the term of each hit, explain them with save_terms=True")
+
+                term = normaliseTerm(hit[-1])
+                original_boost = original_boosts.get(term, 0)
+                if original_boost == 0:
+                    continue
+
+                if term not in self.term_index:
+                    self.term_index[term] = len(self.term_index)
+                contributions.append((self.term_index[term], doc_index, hit[1] * hit[2] / float(original_boost)))
+
+        self.matrix = np.zeros((len(self.term_index), len(self.guids)))
+        if contributions:
+            rows, cols, values = zip(*contributions)
+            np.add.at(self.matrix, (np.array(rows), np.array(cols)), np.array(values))
+
+    def __len__(self):
+        return len(self.guids)
+
+    def computeScores(self, term_boosts):
+        """
+            Score of every document for a query made of these terms.
+
+            :param term_boosts: dict {term: boost * count}
+            :returns: numpy array, one score per guid in self.guids
+        """
+        rows = []
+        boosts = []
+        for term, boost in term_boosts.items():
+            row = self.term_index.get(term)
+            if row is not None and boost:
+                rows.append(row)
+                boosts.append(boost)
+
+        if not rows:
+            return np.zeros(len(self.guids))
+        return np.array(boosts).dot(self.matrix[rows])
+
+    def rankedGuids(self, term_boosts):
+        """
+            Returns the guids of the documents a query with these terms would
+            retrieve, in order of descending score. Ties keep the order of the
+            original results.
+        """
+        scores = self.computeScores(term_boosts)
+        order = np.argsort(-scores, kind="mergesort")
+        return [self.guids[index] for index in order if scores[index] > 0]
+
+    def measureKeywords(self, selected_keywords, use_weights=False):
+        """
+            Offline equivalent of runAndMeasureOneQuery() for a keyword
+            selection.
+
+            :param selected_keywords: tuples of (keyword, weight)
+            :param use_weights: if True, boost each keyword by its weight, as
+                for kw_selection_weight_scores
+            :returns: dict of scores, as filled in by measureScores()
+        """
+        kw_counts = getCountsInQuery(self.precomputed_query, selected_keywords)
+
+        term_boosts = {}
+        for kw in selected_keywords:
+            boost = tokenWeight(kw) if use_weights else 1
+            term_boosts[kw[0]] = term_boosts.get(kw[0], 0) + boost * kw_counts.get(kw[0], 0)
+
+        new_scores = {}
+        measureScores(self.rankedGuids(term_boosts), self.precomputed_query["match_guids"], new_scores)
+        return new_scores
+
+    def measureKeywordSelection(self, selected_keywords, kw_data):
+        """
+            Offline equivalent of runQueryAndMeasureKeywordSelection()
+
+            :param selected_keywords: tuples of (keyword, weight)
+            :param kw_data: dict the scores are added to
+        """
+        kw_data["kw_selection_scores"] = self.measureKeywords(selected_keywords, use_weights=False)
+        kw_data["kw_selection_weight_scores"] = self.measureKeywords(selected_keywords, use_weights=True)
+
+
+def buildKeywordTermIndex(precomputed_query, doc_list, raw_scores):
+    """
+        Builds a KeywordTermIndex from the rawScores that are passed to
+        .selectKeywords(). Returns None if the formulas can't be used to
+        evaluate keywords offline.
+
+        :param doc_list: guids of the retrieved documents
+        :param raw_scores: dict with "formulas" for doc_list and "match_formulas"
+            for precomputed_query["match_guids"]
+    """
+    if not raw_scores or not raw_scores.get("formulas"):
+        return None
+
+    formulas = list(raw_scores["formulas"]) + list(raw_scores.get("match_formulas", []))
+    guids = list(doc_list) + list(precomputed_query["match_guids"])
+
+    try:
+        index = KeywordTermIndex(precomputed_query, formulas, guids)
+    except ValueError as e:
+        print(e)
+        return None
+
+    if not index.is_additive:
+        return None
+    return index
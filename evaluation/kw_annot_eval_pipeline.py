@@ -55,13 +55,14 @@ class KeywordSelectionEvaluationPipeline(KeywordAnnotationPipeline):
             self.selectors[entry]["instance"] = self.selectors[entry]["class"](entry)
 
 
-    def addResult(self, file_guid, precomputed_query, doc_method, retrieved_results):
+    def addResult(self, file_guid, precomputed_query, doc_method, retrieved_results, explained=None):
         """
             This is where we select the top keywords for a query/citation based on
             the retrieved results and the score of keywords for the document's match
 
             :param file_guid: guid of the file the citation originates from
             :param precomputed_query: dict with info about the query that has already been extracted
+            :param explained: what getNormalisedTermScores() returns, if available
         """
         doc_list = [hit[1]["guid"] for hit in retrieved_results]
 
@@ -85,6 +86,9 @@ class KeywordSelectionEvaluationPipeline(KeywordAnnotationPipeline):
                                                                     self.exp.get("match_guid_expansion_max_add", 5),
                                                                     )
             precomputed_query["match_guids"].extend(expanded_guids)
+            if expanded_guids:
+                # the term scores must include the new match_guids
+                explained = None
 
         if self.use_celery:
             print("Adding subtask to queue...")
@@ -114,7 +118,8 @@ class KeywordSelectionEvaluationPipeline(KeywordAnnotationPipeline):
                                         self.exp["context_extraction_parameter"],
                                         self.selectors,
                                         weights,
-                                        self.annotator
+                                        self.annotator,
+                                        term_scores=explained
                                         )
 
             if SPECIAL_EXPORT:
@@ -48,13 +48,14 @@ class KeywordSelectionEvaluationPipeline(KeywordTrainingPipeline):
         if self.options.get("clear_existing_prr_results", False):
             self.writers["ALL"].clearResults()
 
-    def addResult(self, file_guid, precomputed_query, doc_method, retrieved_results):
+    def addResult(self, file_guid, precomputed_query, doc_method, retrieved_results, explained=None):
         """
             This is where we select the top keywords for a query/citation based on
             the retrieved results and the score of keywords for the document's match
 
             :param file_guid: guid of the file the citation originates from
             :param precomputed_query: dict with info about the query that has already been extracted
+            :param explained: what getNormalisedTermScores() returns, if available
         """
         doc_list = [hit[1]["guid"] for hit in retrieved_results]
 
@@ -99,7 +100,8 @@ class KeywordSelectionEvaluationPipeline(KeywordTrainingPipeline):
                                         self.exp["context_extraction_parameter"],
                                         self.exp["keyword_selection_parameters"],
                                         weights,
-                                        self.annotator
+                                        self.annotator,
+                                        term_scores=explained
                                         )
 
     def saveResultsAndCleanUp(self):
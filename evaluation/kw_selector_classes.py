@@ -14,6 +14,7 @@ from proc.structured_query import StructuredQuery
 numpy.warnings.filterwarnings('ignore')
 
 from evaluation.keyword_annotation_measurement import runQueryAndMeasureKeywordSelection
+from evaluation.keyword_term_index import buildKeywordTermIndex
 from evaluation.keyword_annotation import BaseKeywordSelector, filterTermScores, getDictOfTermScores, \
     addUpAllTermScores, getCountsInQueryForMatchingTerms
 
@@ -470,6 +471,12 @@ class MinimalSetSelector(BaseKeywordSelector):
 
         all_term_scores, terms, counts = getSortedTerms(norm_term_scores, precomputed_query)
 
+        # off by default: offline only ranks the documents in doc_list, a live
+        # query can also retrieve others
+        self.term_index = None
+        if parameters.get("offline_evaluation", False):
+            self.term_index = buildKeywordTermIndex(precomputed_query, doc_list, rawScores)
+
         rank = BIG_VALUE
         index = 0
         selected_terms = []
@@ -485,11 +492,14 @@ class MinimalSetSelector(BaseKeywordSelector):
 
             selected_kws = [(term[0], all_term_scores.get(term[0], 0)) for term in selected_terms]
 
-            runQueryAndMeasureKeywordSelection(precomputed_query,
-                                               selected_kws,
-                                               retrieval_model,
-                                               weights,
-                                               kw_data)
+            if self.term_index:
+                self.term_index.measureKeywordSelection(selected_kws, kw_data)
+            else:
+                runQueryAndMeasureKeywordSelection(precomputed_query,
+                                                   selected_kws,
+                                                   retrieval_model,
+                                                   weights,
+                                                   kw_data)
 
             for k in ["kw_selection_scores", "kw_selection_weight_scores"]:
                 if kw_data[k]["rank"] == -1:
@@ -520,6 +530,12 @@ class MultiMaximalSetSelector(BaseKeywordSelector):
         of all relevant documents together
     """
 
+    def __init__(self, name=""):
+        super(MultiMaximalSetSelector, self).__init__(name)
+        # if set, keyword selections are scored from the formulas instead of
+        # running a query for each
+        self.term_index = None
+
     def getQueryRank(self, precomputed_query, selected_kws, retrieval_model, weights):
         if len(selected_kws) == 0:
             return {"rank_kw": float(BIG_VALUE),
@@ -527,11 +543,14 @@ class MultiMaximalSetSelector(BaseKeywordSelector):
                     "rank_avg": float(BIG_VALUE)}
 
         scores = {}
-        runQueryAndMeasureKeywordSelection(precomputed_query,
-                                           selected_kws,
-                                           retrieval_model,
-                                           weights,
-                                           scores)
+        if self.term_index:
+            self.term_index.measureKeywordSelection(selected_kws, scores)
+        else:
+            runQueryAndMeasureKeywordSelection(precomputed_query,
+                                               selected_kws,
+                                               retrieval_model,
+                                               weights,
+                                               scores)
 
         for k in ["kw_selection_scores", "kw_selection_weight_scores"]:
             if scores[k]["rank"] == -1:
@@ -734,6 +753,11 @@ class MultiMaximalSetSelector(BaseKeywordSelector):
 
         terms = sorted(six.iteritems(all_term_scores), key=lambda x: x[1], reverse=True)
 
+        # off by default, see MinimalSetSelector
+        self.term_index = None
+        if parameters.get("offline_evaluation", False):
+            self.term_index = buildKeywordTermIndex(precomputed_query, doc_list, rawScores)
+
         opt_results = [
             # self.optimizeSciPy(precomputed_query, terms, weights, retrieval_model),
             # self.optimizeAdding(precomputed_query, terms, weights, retrieval_model),
@@ -9,6 +9,7 @@ from __future__ import print_function
 
 from __future__ import absolute_import
 import logging
+from collections import OrderedDict
 import db.corpora as cp
 from proc import doc_representation
 import six
@@ -88,6 +89,59 @@ def prebuildMulti(method_name, parameters, prebuild_function, doc, doctext, guid
     return all_bows
 
 
+# how many target documents are built together by prebuildInlinkContextBySource()
+ILC_BY_SOURCE_CHUNK_SIZE = 1000
+
+
+def prebuildInlinkContextBySource(method_name, parameters, guids, overwrite_existing_bows, filter_options,
+                                  chunk_size=ILC_BY_SOURCE_CHUNK_SIZE):
+    """
+        Builds the inlink_context BOWs of many documents, loading each citing
+        document once per chunk of targets instead of once per target. The
+        BOWs saved are the same prebuildMulti() saves with
+        generateDocBOWInlinkContext.
+
+        :param method_name: string identifying the doc representation method
+        :param parameters: parameters to the doc method
+        :param guids: guids of the documents to build BOWs for
+        :param overwrite_existing_bows: if False, only build BOWs that are not in the db already
+        :param filter_options: filter options for incoming_link_contexts
+        :param chunk_size: number of target documents whose contexts are
+            kept in memory at the same time
+    """
+    assert isinstance(parameters, list)
+
+    for start in range(0, len(guids), chunk_size):
+        to_build = OrderedDict()
+        for guid in guids[start:start + chunk_size]:
+            if not overwrite_existing_bows:
+                params = cp.Corpus.selectBOWParametersToPrebuild(guid, method_name, parameters)
+            else:
+                params = parameters
+            if len(params) > 0:
+                to_build[guid] = params
+
+        target_docs = OrderedDict()
+        docs = cp.Corpus.loadSciDocs(list(to_build.keys()), ignore_errors=["error_match_citation_with_reference"])
+        for guid, doc in zip(to_build.keys(), docs):
+            if not doc:
+                logging.error("Cannot load SciDoc for %s " % guid)
+                continue
+            target_docs[guid] = doc
+
+        # parameters needed by any of the targets, in their original order
+        chunk_params = [param for param in parameters
+                        if any(param in to_build[guid] for guid in target_docs)]
+        all_bows = doc_representation.generateInlinkContextsBySource(target_docs, chunk_params,
+                                                                     filter_options=filter_options)
+        for guid in target_docs:
+            for param in to_build[guid]:
+                param_dict = {"method": method_name, "parameter": param, }
+                cp.Corpus.savePrebuiltBOW(guid, param_dict, all_bows[guid][param])
+
+        print("Built %s BOWs for %d/%d documents" % (method_name, min(start + chunk_size, len(guids)), len(guids)))
+
+
 def main():
     pass
 
@@ -16,10 +16,14 @@ def addPrecomputeExplainFormulas(precomputed_query,
                                  retrieval_model,
                                  writers,
                                  experiment_id,
-                                 exp_random_zoning=False):
+                                 exp_random_zoning=False,
+                                 formulas=None):
     """
         Runs a precomputed query using the retrieval_model, computes the formula
         for each result
+
+        :param formulas: what precomputeFormulas() returns, if it was already
+            run for this query and doc_list
     """
     # !TODO remove this, it's a temporary fix
 ##    if precomputed_query.get("csc_type","Bac") in ["Bac"]:
@@ -31,7 +35,8 @@ def addPrecomputeExplainFormulas(precomputed_query,
 
     del retrieval_result["query_text"]
 
-    formulas=precomputeFormulas(retrieval_model, precomputed_query, doc_list)
+    if formulas is None:
+        formulas=precomputeFormulas(retrieval_model, precomputed_query, doc_list)
     retrieval_result["formulas"]=formulas
 
     for remove_key in ["dsl_query", "lucene_query"]:
@@ -56,13 +61,14 @@ def addPrecomputeExplainFormulas(precomputed_query,
 
 def precomputeFormulas(retrieval_model, query, doc_list):
     """
-        It runs the .formulaFromExplanation() method of BaseRetrieval
+        It runs the .formulasFromExplanations() method of BaseRetrieval, which
+        explains all of doc_list in as few requests as the model allows
     """
     results=[]
 ##    print("Computing explain formulas...")
 ##    progress=ProgressIndicator(True, numitems=len(doc_list), print_out=False)
-    for doc_id in doc_list:
-        formula=retrieval_model.formulaFromExplanation(query, doc_id)
+    formulas=retrieval_model.formulasFromExplanations(query, doc_list)
+    for doc_id, formula in zip(doc_list, formulas):
         # we assume that if a document was returned it must match
         results.append({"guid":doc_id,"formula":formula.formula})
 ##        progress.showProgressReport("Computing explain formulas -- %s" % doc_id)
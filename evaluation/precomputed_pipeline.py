@@ -16,7 +16,7 @@ from retrieval.base_retrieval import BaseRetrieval
 from celery.result import ResultSet
 
 from db.result_store import createResultStorers
-from .precompute_functions import addPrecomputeExplainFormulas
+from .precompute_functions import addPrecomputeExplainFormulas, precomputeFormulas
 from multi.tasks import precomputeFormulasTask
 
 
@@ -74,14 +74,11 @@ class PrecomputedPipeline(BaseTestingPipeline):
         assert self.exp["name"] != "", "Experiment needs a name!"
         self.createWriterInstances()
 
-    def addResult(self, file_guid, precomputed_query, doc_method, retrieved_results):
+    def mustProcess(self, precomputed_query, report=True):
         """
-            Overrides BaseTestingPipeline.addResult so that for each retrieval result
-            we actually run .explain() on each item and we store the precomputed
-            formula.
+            False if there are already enough results for the query's classes
         """
-        doc_list = [hit[1]["guid"] for hit in retrieved_results]
-
+        must_process = True
         for zone_type in ["csc_type", "az"]:
             if precomputed_query.get(zone_type, "") != "":
                 if self.writers[zone_type + "_" + precomputed_query[
@@ -90,10 +87,33 @@ class PrecomputedPipeline(BaseTestingPipeline):
                 else:
                     must_process = False
                     # TODO this is redundant now. Merge this into base_pipeline.py?
-                    print(u"Too many queries of type {} already".format(precomputed_query[zone_type]))
+                    if report:
+                        print(u"Too many queries of type {} already".format(precomputed_query[zone_type]))
         ##                  assert(False)
+        return must_process
+
+    def explainResults(self, precomputed_query, doc_method, retrieved_results):
+        """
+            Explains the results on the worker thread, see
+            BaseTestingPipeline.explainResults(). Result counts only grow, so
+            a query that must not be processed here won't be in addResult()
+        """
+        if self.use_celery or not self.mustProcess(precomputed_query, report=False):
+            return None
+        doc_list = [hit[1]["guid"] for hit in retrieved_results]
+        return precomputeFormulas(self.retrieval_models[doc_method], precomputed_query, doc_list)
+
+    def addResult(self, file_guid, precomputed_query, doc_method, retrieved_results, explained=None):
+        """
+            Overrides BaseTestingPipeline.addResult so that for each retrieval result
+            we actually run .explain() on each item and we store the precomputed
+            formula.
+
+            :param explained: formulas from explainResults(), if available
+        """
+        doc_list = [hit[1]["guid"] for hit in retrieved_results]
 
-        if not must_process:
+        if not self.mustProcess(precomputed_query):
             return
 
         if self.use_celery:
@@ -114,6 +134,7 @@ class PrecomputedPipeline(BaseTestingPipeline):
                                          self.retrieval_models[doc_method],
                                          self.writers,
                                          self.exp["experiment_id"],
+                                         formulas=explained,
                                          )
 
     def saveResultsAndCleanUp(self):
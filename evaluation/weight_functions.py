@@ -6,14 +6,28 @@
 # For license information, see LICENSE.TXT
 
 from __future__ import absolute_import
-import random
+import random, os, json
 from copy import deepcopy
 from multiprocessing import Pool, cpu_count
 
+import numpy as np
 from sklearn import model_selection
 
 from .pipeline_functions import getDictOfTestingMethods
 from retrieval.stored_formula import StoredFormula
+from retrieval.compiled_formula import CompiledFormulaSet
+from db.binary_result_store import BinaryResultReader
+
+# rank given to a correct result that was not retrieved, as in measureScores()
+BIG_RANK_VALUE=200
+
+# incremental scores closer than this, relative to the size of the terms
+# that add up to them, are treated as possible ties and scored exactly
+NEAR_TIE_TOLERANCE=1e-9
+
+# arrays of a CompiledRetrievalResults that are saved to disk
+COMPILED_RESULTS_ARRAYS=["offsets", "entry_query", "entry_formula", "num_matches", "num_found",
+                         "empty_queries", "padded_formulas", "query_method_index"]
 
 ##def runSingleFormula(result_tuple):
 ##    """
@@ -64,6 +78,396 @@ def runPrecomputedQuery(retrieval_results, parameters):
     return scores
 
 
+class IncrementalScorer(object):
+    """
+        Scores a CompiledFormulaSet for a sequence of weight vectors that differ
+        in only one or two weights from the previous one, as in the greedy
+        weight search.
+
+        Under sum nodes a formula is linear in the field weights, so its score
+        is coefficients . weights + bias. For those formulas changing a weight
+        only adds delta * coefficients[:, field] to the previous scores, which
+        is O(num_formulas) instead of re-running the whole program. Formulas
+        that are not linear (e.g. max of several fields) are re-evaluated each
+        time from their own, smaller, compiled set.
+    """
+    def __init__(self, formula_set, max_changed_fields=3, refresh_every=50):
+        """
+            :param max_changed_fields: if more weights than this change at once,
+                the scores are computed from scratch
+            :param refresh_every: recompute exactly after this many incremental
+                updates so that rounding errors don't build up
+        """
+        self.formula_set=formula_set
+        self.max_changed_fields=max_changed_fields
+        self.refresh_every=refresh_every
+
+        self.linear, self.coefficients, self.bias=formula_set.linearDecomposition()
+        self.nonzero_coefficients=(self.coefficients != 0).astype(np.int64)
+        self.abs_coefficients=np.abs(self.coefficients)
+        self.abs_coefficients[~self.linear]=0
+        self.nonlinear_index=np.flatnonzero(~self.linear)
+        self.nonlinear_set=None
+        if len(self.nonlinear_index) > 0:
+            self.nonlinear_set=formula_set.subset(self.nonlinear_index)
+
+        self.weights=None
+        self.scores=None
+        self.updates_since_refresh=0
+
+    def computeScoresFromScratch(self, weights):
+        """
+            Exact scores for a weight vector
+        """
+        scores=self.coefficients.dot(weights)+self.bias
+        self.active_fields=self.nonzero_coefficients.dot((weights != 0).astype(np.int64))
+        if self.nonlinear_set is not None:
+            scores[self.nonlinear_index]=self.nonlinear_set.computeScoreMatrix(weights)[0]
+        return scores
+
+    def computeScores(self, weights):
+        """
+            Returns the score of every formula for a weight vector, updating
+            the previous scores if only a few weights changed. The weights and
+            scores become the new starting point.
+        """
+        weights=np.asarray(weights, dtype=np.float64)
+        if self.weights is not None:
+            changed=np.flatnonzero(weights != self.weights)
+        else:
+            changed=None
+
+        if changed is None or len(changed) > self.max_changed_fields or self.updates_since_refresh >= self.refresh_every:
+            scores=self.computeScoresFromScratch(weights)
+            self.updates_since_refresh=0
+        elif len(changed) == 0:
+            return self.scores
+        else:
+            scores=self.scores+self.coefficients[:, changed].dot(weights[changed]-self.weights[changed])
+            # a formula whose fields all have weight 0 must score exactly its
+            # bias, otherwise rounding errors would break ties between them
+            for field in changed:
+                now_active=int(weights[field] != 0)-int(self.weights[field] != 0)
+                if now_active != 0:
+                    self.active_fields+=now_active*self.nonzero_coefficients[:, field]
+            inactive=(self.active_fields == 0) & self.linear
+            scores[inactive]=self.bias[inactive]
+            if self.nonlinear_set is not None:
+                scores[self.nonlinear_index]=self.nonlinear_set.computeScoreMatrix(weights)[0]
+            self.updates_since_refresh+=1
+
+        self.weights=weights.copy()
+        self.scores=scores
+        return scores
+
+    def tieTolerances(self, weights, scores):
+        """
+            coefficients . weights + bias doesn't round the same way as the
+            formula tree, so a linear formula's incremental score can be off
+            in the last bits. Returns, for each formula, a distance under which
+            its score can't be told apart from another one's.
+        """
+        magnitudes=self.abs_coefficients.dot(np.abs(weights))+np.abs(self.bias)
+        return NEAR_TIE_TOLERANCE*np.maximum(magnitudes, np.abs(scores))
+
+
+class CompiledRetrievalResults(object):
+    """
+        Holds a list of precomputed retrieval results with all of their formulas
+        compiled into a single CompiledFormulaSet, so that a whole training set
+        can be re-scored with new weights in one vectorized pass instead of
+        calling runPrecomputedQuery() on each result.
+    """
+    def __init__(self, retrieval_results=None, fields=None):
+        """
+            :param retrieval_results: list, ResultIncrementalReader,
+                BinaryResultReader or similar.
+                Results without "formulas" (errors reading them) are skipped,
+                as in WeightTrainer.measurePrecomputedResolution(). If None,
+                the instance is empty, ready for load()
+            :param fields: optional list of fields to fix the column order
+        """
+        self.formula_set=CompiledFormulaSet(fields)
+        self.results=[]
+        self.guids=[]
+        # score single weight vectors through an IncrementalScorer
+        self.use_incremental_scoring=True
+        self.incremental_scorer=None
+        if retrieval_results is None:
+            return
+
+        if isinstance(retrieval_results, BinaryResultReader):
+            # straight from the stored arrays, no formula dicts involved
+            self.results, self.guids, self.offsets, self.formula_set=retrieval_results.compileFormulas()
+            self.buildMatchIndex()
+            return
+
+        offsets=[0]
+        for result in retrieval_results:
+            if "formulas" not in result:
+                continue
+
+            self.results.append({key:result[key] for key in result if key != "formulas"})
+            for unique_result in result["formulas"]:
+                self.formula_set.addFormula(unique_result["formula"])
+                self.guids.append(unique_result["guid"])
+            offsets.append(len(self.guids))
+
+        self.offsets=np.array(offsets, dtype=np.int64)
+        self.formula_set.compile()
+        self.buildMatchIndex()
+
+    def save(self, path):
+        """
+            Saves everything to a directory: the formula arrays and match index
+            as .npy files, the result dicts and guids as JSON.
+        """
+        self.formula_set.save(os.path.join(path, "formulas"))
+        for name in COMPILED_RESULTS_ARRAYS:
+            np.save(os.path.join(path, name+".npy"), getattr(self, name))
+        json.dump({"results":self.results,
+                   "guids":self.guids,
+                   "query_methods":self.query_methods},
+                  open(os.path.join(path, "results.json"), "w"))
+
+    def load(self, path, mmap_mode="r"):
+        """
+            Loads a set saved with save(), memory-mapping the arrays so that
+            worker processes share them instead of each getting a copy.
+
+            :returns: self
+        """
+        self.formula_set=CompiledFormulaSet().load(os.path.join(path, "formulas"), mmap_mode=mmap_mode)
+        for name in COMPILED_RESULTS_ARRAYS:
+            setattr(self, name, np.load(os.path.join(path, name+".npy"), mmap_mode=mmap_mode))
+        data=json.load(open(os.path.join(path, "results.json"), "r"))
+        self.results=data["results"]
+        self.guids=data["guids"]
+        self.query_methods=data["query_methods"]
+        return self
+
+    def buildMatchIndex(self):
+        """
+            Finds the position of each of the match_guids of each result in
+            its list of formulas, and builds a padded (num_results, max_docs)
+            matrix of formula indices to compare each match against the rest of
+            its result list.
+
+            Assumes that guids are unique inside a result list, as they come
+            from a single search.
+        """
+        entry_query=[]
+        entry_formula=[]
+        self.num_matches=np.zeros(len(self.results), dtype=np.int64)
+        self.num_found=np.zeros(len(self.results), dtype=np.int64)
+
+        for index, result in enumerate(self.results):
+            start, end=self.offsets[index], self.offsets[index+1]
+            positions={}
+            for position in range(start, end):
+                positions.setdefault(self.guids[position], position)
+
+            match_guids=set(result["match_guids"])
+            self.num_matches[index]=len(match_guids)
+            for guid in match_guids:
+                if guid in positions:
+                    entry_query.append(index)
+                    entry_formula.append(positions[guid])
+                    self.num_found[index]+=1
+
+        self.entry_query=np.array(entry_query, dtype=np.int64)
+        self.entry_formula=np.array(entry_formula, dtype=np.int64)
+
+        doc_counts=np.diff(self.offsets)
+        self.empty_queries=doc_counts == 0
+        max_docs=int(doc_counts.max()) if len(doc_counts) > 0 else 0
+        # padding is -1, which points at an extra column of -inf scores
+        self.padded_formulas=np.full((len(self.results), max_docs), -1, dtype=np.int64)
+        for index in range(len(self.results)):
+            self.padded_formulas[index, :doc_counts[index]]=np.arange(self.offsets[index], self.offsets[index+1])
+
+        self.query_methods=[]
+        self.query_method_index=np.zeros(len(self.results), dtype=np.int64)
+        for index, result in enumerate(self.results):
+            if result["query_method"] not in self.query_methods:
+                self.query_methods.append(result["query_method"])
+            self.query_method_index[index]=self.query_methods.index(result["query_method"])
+
+    def __len__(self):
+        return len(self.results)
+
+    def __iter__(self):
+        for result in self.results:
+            yield result
+
+    def runQueries(self, parameters):
+        """
+            Generator. For each result, yields the result dict (without the
+            formulas) and the list of retrieved documents in the same format
+            runPrecomputedQuery() returns: [(score, {"guid":guid}), ...] sorted
+            by descending score, ties in original order.
+        """
+        all_scores=self.formula_set.computeScores(parameters)
+        for index, result in enumerate(self.results):
+            start, end=self.offsets[index], self.offsets[index+1]
+            scores=all_scores[start:end]
+            order=np.argsort(-scores, kind="stable")
+            retrieved=[(float(scores[i]),{"guid":self.guids[start+i]}) for i in order]
+            yield result, retrieved
+
+    def computeMatchRanks(self, score_matrix, max_batch_elements=20000000):
+        """
+            Computes the rank of every found match guid for each row of scores,
+            without sorting: rank = 1 + number of docs in the same result list
+            that score higher, or the same and come before it.
+
+            :param score_matrix: (K, num_formulas) array
+            :returns: (K, num_entries) array of ranks
+        """
+        num_rows=score_matrix.shape[0]
+        ranks=np.zeros((num_rows, len(self.entry_formula)), dtype=np.int64)
+        if len(self.entry_formula) == 0:
+            return ranks
+
+        extended=np.hstack([score_matrix, np.full((num_rows, 1), -np.inf)])
+        entries_per_batch=max(1, max_batch_elements // max(1, num_rows * self.padded_formulas.shape[1]))
+
+        for start in range(0, len(self.entry_formula), entries_per_batch):
+            end=start+entries_per_batch
+            own_index=self.entry_formula[start:end]
+            others_index=self.padded_formulas[self.entry_query[start:end]]
+
+            own=extended[:, own_index][:, :, None]
+            others=extended[:, others_index]
+            before=(others > own) | ((others == own) & (others_index < own_index[:, None])[None, :, :])
+            ranks[:, start:end]=1+before.sum(axis=2)
+        return ranks
+
+    def computeScoreMatrix(self, weight_matrix):
+        """
+            Scores every formula for each row of weight_matrix. A single row is
+            scored incrementally from the previous one if
+            use_incremental_scoring is set, and then the scores of any formulas
+            that may tie with a match are recomputed from their trees.
+        """
+        weight_matrix=np.atleast_2d(np.asarray(weight_matrix, dtype=np.float64))
+        if self.use_incremental_scoring and weight_matrix.shape[0] == 1:
+            if self.incremental_scorer is None:
+                self.incremental_scorer=IncrementalScorer(self.formula_set)
+            scores=self.incremental_scorer.computeScores(weight_matrix[0])
+            tolerances=self.incremental_scorer.tieTolerances(weight_matrix[0], scores)
+            return self.rescoreNearTies(scores, tolerances, weight_matrix[0])[None, :]
+        return self.formula_set.computeScoreMatrix(weight_matrix)
+
+    def findNearTies(self, scores, tolerances, max_batch_elements=20000000):
+        """
+            Finds the formulas whose score is within tolerance of the score of a
+            match in the same result list, other than the match itself, and
+            those matches. Only these can be ranked differently by scores that
+            are off by up to their tolerance.
+
+            :returns: array of formula indices
+        """
+        if len(self.entry_formula) == 0:
+            return np.zeros(0, dtype=np.int64)
+
+        extended=np.append(scores, -np.inf)
+        extended_tolerances=np.append(tolerances, 0)
+        entries_per_batch=max(1, max_batch_elements // max(1, self.padded_formulas.shape[1]))
+
+        near=[]
+        for start in range(0, len(self.entry_formula), entries_per_batch):
+            end=start+entries_per_batch
+            own_index=self.entry_formula[start:end]
+            others_index=self.padded_formulas[self.entry_query[start:end]]
+
+            own=extended[own_index][:, None]
+            # both scores can be off by their tolerance
+            tolerance=extended_tolerances[own_index][:, None]+extended_tolerances[others_index]
+            close=(np.abs(extended[others_index]-own) <= tolerance) & (others_index != own_index[:, None])
+            near.append(others_index[close])
+            near.append(own_index[close.any(axis=1)])
+        return np.unique(np.concatenate(near))
+
+    def rescoreNearTies(self, scores, tolerances, weights):
+        """
+            Replaces the incremental scores of the formulas that may tie with a
+            match by their scores from the formula tree, so that ties are
+            broken exactly as formula_set.computeScoreMatrix() would break them
+        """
+        near=self.findNearTies(scores, tolerances)
+        if len(near) == 0:
+            return scores
+
+        scores=scores.copy()
+        scores[near]=self.formula_set.subset(near).computeScoreMatrix(weights[None, :])[0]
+        return scores
+
+    def measureScoreMatrix(self, score_matrix):
+        """
+            Vectorized equivalent of ResultsLogger.measureScoreAndLog() +
+            computeAverageScores() over the whole set, for each row of scores.
+
+            :returns: dict of {metric: (K, num_results) array}
+        """
+        num_rows=score_matrix.shape[0]
+        ranks=self.computeMatchRanks(score_matrix)
+        num_matches=self.num_matches[self.entry_query][None, :]
+        within=ranks <= num_matches
+
+        # see measureScores(): when there are several correct answers, any of
+        # them in the first citation_multi positions counts as rank 1
+        idcg=1/np.log(2)
+        entry_scores={"mrr":np.where(within, 1.0, 1/ranks.astype(np.float64)),
+                      "ndcg":np.where(within, 1.0, (1/np.log(1+ranks.astype(np.float64)))/idcg),
+                      "precision":within.astype(np.float64),
+                      "rank":np.where(within, 1, ranks).astype(np.float64)}
+
+        divisor=np.maximum(self.num_matches, 1).astype(np.float64)
+        metrics={}
+        for metric in entry_scores:
+            totals=np.zeros((num_rows, len(self.results)), dtype=np.float64)
+            np.add.at(totals, (slice(None), self.entry_query), entry_scores[metric])
+            if metric == "rank":
+                # matches that were not retrieved count as BIG_VALUE
+                totals+=BIG_RANK_VALUE*(self.num_matches-self.num_found)
+                totals=np.floor(totals/divisor)
+            else:
+                totals=totals/divisor
+            totals[:, self.empty_queries]=0
+            metrics[metric]=totals
+        return metrics
+
+    def measureWeightMatrix(self, weight_matrix, doc_method="", citation_az="*"):
+        """
+            Scores the whole set for K weight vectors in one pass.
+
+            :param weight_matrix: (K, num_fields) array in the order of
+                self.formula_set.fields, or a list of K {field: weight} dicts
+            :returns: a list with one entry per weight vector, each the same
+                list of per-query_method dicts that
+                WeightTrainer.measurePrecomputedResolution() returns
+        """
+        if isinstance(weight_matrix, list) and (len(weight_matrix) == 0 or isinstance(weight_matrix[0], dict)):
+            weight_matrix=self.formula_set.weightMatrix(weight_matrix)
+
+        score_matrix=self.computeScoreMatrix(weight_matrix)
+        metrics=self.measureScoreMatrix(score_matrix)
+
+        all_results=[[] for _ in range(score_matrix.shape[0])]
+        for method_index, query_method in enumerate(self.query_methods):
+            selection=self.query_method_index == method_index
+            num_data_points=float(selection.sum())
+            sums={metric:metrics[metric][:, selection].sum(axis=1) for metric in metrics}
+            for row in range(score_matrix.shape[0]):
+                data_line={"query_method":query_method,"doc_method":doc_method,"citation_az":citation_az}
+                for metric in ["mrr", "ndcg", "precision", "rank"]:
+                    data_line["avg_"+metric]=float(sums[metric][row]/num_data_points)
+                data_line["precision_total"]=float(sums["precision"][row])
+                all_results[row].append(data_line)
+        return all_results
+
+
 def main():
     pass
 
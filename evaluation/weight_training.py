@@ -10,6 +10,7 @@ from __future__ import print_function
 from __future__ import absolute_import
 import  gc, random, os
 from collections import defaultdict
+from multiprocessing import Pool, cpu_count
 from sklearn import model_selection
 import pandas as pd
 
@@ -17,12 +18,16 @@ import db.corpora as cp
 from proc.results_logging import ResultsLogger
 ##from proc.nlp_functions import AZ_ZONES_LIST, CORESC_LIST, RANDOM_ZONES_7, RANDOM_ZONES_11
 from .base_pipeline import getDictOfTestingMethods
-from .weight_functions import runPrecomputedQuery, addExtraWeights
+from .weight_functions import runPrecomputedQuery, addExtraWeights, CompiledRetrievalResults
 from db.result_store import ElasticResultStorer, ResultIncrementalReader, ResultDiskReader
+from db.binary_result_store import BinaryResultReader, getBinaryResultsPath, convertJsonCacheToBinary
 from six.moves import range
 
 GLOBAL_FILE_COUNTER=0
 
+# weight changes tried at each step of the search
+WEIGHT_MOVEMENTS=[-1,6,-2]
+
 class WeightTrainer(object):
     """
         This class encapsulates all of the weight wrangling
@@ -41,132 +46,32 @@ class WeightTrainer(object):
         """
         all_doc_methods=getDictOfTestingMethods(self.exp["doc_methods"])
         annotated_boost_methods=[x for x in all_doc_methods if all_doc_methods[x]["type"] in ["annotated_boost"]]
+        runtime_parameters={method:all_doc_methods[method]["runtime_parameters"] for method in annotated_boost_methods}
 
         initialization_methods=[1]
-    ##    initialization_methods=[1,"random"]
-        MIN_WEIGHT=0
     ##    self.exp["movements"]=[-1,3]
-        self.exp["movements"]=[-1,6,-2]
+        self.exp["movements"]=WEIGHT_MOVEMENTS
 
         best_weights={}
-
-        numfolds=self.exp.get("cross_validation_folds",2)
+        results_compare=[]
 
         print("Processing zones ",self.exp["train_weights_for"])
 
         for query_type in self.exp["train_weights_for"]:
             best_weights[query_type]={}
-            results_compare=[]
 
-            retrieval_results=self.loadPrecomputedFormulas(query_type)
-            if len(retrieval_results) == 0:
-                print("No precomputed formulas for ", query_type)
+            train_set, num_results=self.loadFoldSet(query_type, split_fold)
+            if train_set is None:
                 continue
 
-            if len(retrieval_results) < numfolds:
-                print("Number of results is smaller than number of folds for zone type ", query_type)
-                continue
-
-            cv = model_selection.KFold(n_splits=numfolds, shuffle=False, random_state=None)
-            cv = zip(cv.split(retrieval_results))
-
-            traincv, testcv=cv[split_fold]
-            if isinstance(retrieval_results, ResultIncrementalReader):
-                train_set=retrieval_results.subset(traincv)
-            elif isinstance(retrieval_results, list):
-                train_set=[retrieval_results[i] for i in traincv]
-            else:
-                raise ValueError("Unkown class of results")
-##            train_set=retrieval_results.subset(traincv)
-##            train_set=[retrieval_results[i] for i in traincv]
             if len(train_set) == 0:
                 print("Training set len is 0!")
                 return defaultdict(lambda:1)
 
-            print("Training for citations in ",query_type,"zones:",len(train_set),"/",len(retrieval_results))
+            print("Training for citations in ",query_type,"zones:",len(train_set),"/",num_results)
+            train_set=self.compileResults(train_set)
             for method in annotated_boost_methods:
-                res={}
-
-                for weight_initalization in initialization_methods:
-                    if weight_initalization==1:
-    ##                    counter.initWeights(all_doc_methods[method]["runtime_parameters"])
-                        weights={x:1 for x in all_doc_methods[method]["runtime_parameters"]}
-                    elif weight_initalization=="random":
-                        weights={x:random.randint(-10,10) for x in all_doc_methods[method]["runtime_parameters"]}
-    ##                    counter.weights={x:random.randint(-10,10) for x in all_doc_methods[method]["runtime_parameters"]}
-
-                    all_doc_methods[method]["runtime_parameters"]=weights
-                    print("Computing initial score...")
-                    scores=self.measurePrecomputedResolution(train_set, method, addExtraWeights(weights, self.exp), query_type)
-
-                    score_baseline=scores[0][self.exp["metric"]]
-                    previous_score=score_baseline
-                    first_baseline=score_baseline
-                    score_progression=[score_baseline]
-
-                    global GLOBAL_FILE_COUNTER
-##                    drawWeights(self.exp,weights,query_type+"_weights_"+str(GLOBAL_FILE_COUNTER))
-##                    drawScoreProgression(self.exp,score_progression,query_type+"_"+str(GLOBAL_FILE_COUNTER))
-                    GLOBAL_FILE_COUNTER+=1
-
-                    overall_improvement = score_baseline
-                    passes=0
-
-                    print("Finding best weights...")
-                    while passes < 3 or overall_improvement > 0:
-                        for direction in self.exp["movements"]: # [-1,6,-2]
-                            print("Direction: ", direction)
-                            for index in range(len(weights)):
-##                                print("Weight: ", index)
-                                weight_name=list(weights.keys())[index]
-                                prev_weight=weights[weight_name]
-                                # hard lower limit of 0 for weights
-                                weights[weight_name]=max(MIN_WEIGHT,weights[weight_name]+direction)
-
-                                scores=self.measurePrecomputedResolution(train_set,method,addExtraWeights(weights, self.exp), query_type)
-                                this_score=scores[0][self.exp["metric"]]
-
-                                if this_score <= previous_score:
-                                    weights[weight_name]=prev_weight
-                                else:
-                                    previous_score=this_score
-
-                        overall_improvement=this_score-score_baseline
-                        score_baseline=this_score
-                        score_progression.append(this_score)
-
-                        # This is to export the graphs as weights are trained
-##                        drawWeights(self.exp,weights,query_type+"_weights_"+str(GLOBAL_FILE_COUNTER))
-##                        drawScoreProgression(self.exp,{self.exp["metric"]:score_progression},query_type+"_"+str(GLOBAL_FILE_COUNTER))
-                        GLOBAL_FILE_COUNTER+=1
-
-                        passes+=1
-
-                    scores=self.measurePrecomputedResolution(train_set, method, addExtraWeights(weights, self.exp), query_type)
-                    this_score=scores[0][self.exp["metric"]]
-
-    ##                if split_fold is not None:
-    ##                    split_set_str="_s"+str(split_fold)
-    ##                else:
-    ##                    split_set_str=""
-
-    ##                print "Weight inialization:",weight_initalization
-                    improvement=100*((this_score-first_baseline)/float(first_baseline)) if first_baseline > 0 else 0
-                    print ("   Weights found, with score: {:.5f}".format(this_score)," Improvement: {:.2f}%".format(improvement))
-                    best_weights[query_type][method]=addExtraWeights(weights, self.exp)
-                    print ("   ",list(weights.values()))
-
-                    if self.exp.get("smooth_weights",None):
-                        # this is to smooth a bit the weights in case they're too crazy
-                        for weight in best_weights[query_type][method]:
-                            amount=abs(min(1,best_weights[query_type][method][weight]) / float(3))
-                            if best_weights[query_type][method][weight] > 1:
-                                best_weights[query_type][method][weight] -= amount
-                            elif best_weights[query_type][method][weight] < 1:
-                                best_weights[query_type][method][weight] += amount
-
-                    res[weight_initalization]=this_score
-
+                best_weights[query_type][method], res=self.trainMethodWeights(train_set, method, query_type, runtime_parameters)
                 results_compare.append(res)
 
 ##        better=0
@@ -193,14 +98,166 @@ class WeightTrainer(object):
 
         return best_weights
 
+    def trainMethodWeights(self, train_set, method, query_type, runtime_parameters):
+        """
+            Finds the best weights for a single doc_method on a training set.
+
+            :param train_set: list, reader or CompiledRetrievalResults
+            :param runtime_parameters: dict of {method: runtime_parameters},
+                the weights start from these keys. Updated with the weights found.
+            :returns: tuple (method_weights, res) where res is a dict of
+                {weight_initialization: score}
+        """
+        initialization_methods=[1]
+    ##    initialization_methods=[1,"random"]
+        MIN_WEIGHT=0
+        method_weights={}
+        res={}
+
+        for weight_initalization in initialization_methods:
+            if weight_initalization==1:
+    ##                    counter.initWeights(runtime_parameters[method])
+                weights={x:1 for x in runtime_parameters[method]}
+            elif weight_initalization=="random":
+                weights={x:random.randint(-10,10) for x in runtime_parameters[method]}
+    ##                    counter.weights={x:random.randint(-10,10) for x in runtime_parameters[method]}
+
+            runtime_parameters[method]=weights
+            print("Computing initial score...")
+            scores=self.measurePrecomputedResolution(train_set, method, addExtraWeights(weights, self.exp), query_type)
+
+            score_baseline=scores[0][self.exp["metric"]]
+            previous_score=score_baseline
+            first_baseline=score_baseline
+            score_progression=[score_baseline]
+
+            global GLOBAL_FILE_COUNTER
+##                    drawWeights(self.exp,weights,query_type+"_weights_"+str(GLOBAL_FILE_COUNTER))
+##                    drawScoreProgression(self.exp,score_progression,query_type+"_"+str(GLOBAL_FILE_COUNTER))
+            GLOBAL_FILE_COUNTER+=1
+
+            overall_improvement = score_baseline
+            passes=0
+
+            print("Finding best weights...")
+            weight_search=self.exp.get("weight_search", "greedy")
+            if weight_search == "greedy":
+                while passes < 3 or overall_improvement > 0:
+                    for direction in self.exp["movements"]: # [-1,6,-2]
+                        print("Direction: ", direction)
+                        for index in range(len(weights)):
+##                                print("Weight: ", index)
+                            weight_name=list(weights.keys())[index]
+                            prev_weight=weights[weight_name]
+                            # hard lower limit of 0 for weights
+                            weights[weight_name]=max(MIN_WEIGHT,weights[weight_name]+direction)
+
+                            scores=self.measurePrecomputedResolution(train_set,method,addExtraWeights(weights, self.exp), query_type)
+                            this_score=scores[0][self.exp["metric"]]
+
+                            if this_score <= previous_score:
+                                weights[weight_name]=prev_weight
+                            else:
+                                previous_score=this_score
+
+                    overall_improvement=this_score-score_baseline
+                    score_baseline=this_score
+                    score_progression.append(this_score)
+
+                    # This is to export the graphs as weights are trained
+##                        drawWeights(self.exp,weights,query_type+"_weights_"+str(GLOBAL_FILE_COUNTER))
+##                        drawScoreProgression(self.exp,{self.exp["metric"]:score_progression},query_type+"_"+str(GLOBAL_FILE_COUNTER))
+                    GLOBAL_FILE_COUNTER+=1
+
+                    passes+=1
+            else:
+                score_progression.extend(self.batchWeightSearch(train_set, method, weights, query_type,
+                                                                score_baseline, weight_search, MIN_WEIGHT))
+
+            scores=self.measurePrecomputedResolution(train_set, method, addExtraWeights(weights, self.exp), query_type)
+            this_score=scores[0][self.exp["metric"]]
+
+    ##                if split_fold is not None:
+    ##                    split_set_str="_s"+str(split_fold)
+    ##                else:
+    ##                    split_set_str=""
+
+    ##                print "Weight inialization:",weight_initalization
+            improvement=100*((this_score-first_baseline)/float(first_baseline)) if first_baseline > 0 else 0
+            print ("   Weights found, with score: {:.5f}".format(this_score)," Improvement: {:.2f}%".format(improvement))
+            method_weights=addExtraWeights(weights, self.exp)
+            print ("   ",list(weights.values()))
+
+            if self.exp.get("smooth_weights",None):
+                # this is to smooth a bit the weights in case they're too crazy
+                for weight in method_weights:
+                    amount=abs(min(1,method_weights[weight]) / float(3))
+                    if method_weights[weight] > 1:
+                        method_weights[weight] -= amount
+                    elif method_weights[weight] < 1:
+                        method_weights[weight] += amount
+
+            res[weight_initalization]=this_score
+
+        return method_weights, res
+
+    def loadFoldSet(self, query_type, split_fold, test_set=False):
+        """
+            Loads the precomputed results for a query type and selects the
+            training set (or testing set) of the given cross-validation fold.
+
+            :returns: tuple (fold_set, num_results). fold_set is None if there
+                are not enough results to split into folds
+        """
+        numfolds=self.exp.get("cross_validation_folds",2)
+
+        retrieval_results=self.loadPrecomputedFormulas(query_type)
+        if len(retrieval_results) == 0:
+            print("No precomputed formulas for ", query_type)
+            return None, 0
+
+        if len(retrieval_results) < numfolds:
+            print("Number of results is smaller than number of folds for zone type ", query_type)
+            return None, len(retrieval_results)
+
+        cv = model_selection.KFold(n_splits=numfolds, shuffle=False, random_state=None)
+        cv = list(cv.split(range(len(retrieval_results))))
+
+        traincv, testcv=cv[split_fold]
+        selection=testcv if test_set else traincv
+        if isinstance(retrieval_results, ResultIncrementalReader):
+            fold_set=retrieval_results.subset(selection)
+        elif isinstance(retrieval_results, list):
+            fold_set=[retrieval_results[i] for i in selection]
+        else:
+            raise ValueError("Unkown class of results")
+        return fold_set, len(retrieval_results)
 
     def loadPrecomputedFormulas(self, query_type):
         """
             Loads the previously computed retrieval results, including query, etc.
+
+            If exp_dir/cache/<table>.prrbin exists it is read instead of the
+            per-result .json cache. With exp["binary_results_cache"] it is
+            created from the .json cache first.
         """
-        prr=ElasticResultStorer(self.exp["name"],"prr_"+self.exp["queries_classification"]+"_"+query_type, cp.Corpus.endpoint)
-        reader=ResultDiskReader(prr, cache_dir=os.path.join(self.exp["exp_dir"], "cache"), max_results=self.exp.get("max_per_class_results",1000))
+        cache_dir=os.path.join(self.exp["exp_dir"], "cache")
+        table_name="prr_"+self.exp["queries_classification"]+"_"+query_type
+        max_results=self.exp.get("max_per_class_results",1000)
+
+        binary_path=getBinaryResultsPath(cache_dir, table_name)
+        if os.path.exists(binary_path):
+            return BinaryResultReader(binary_path, max_results=max_results)
+
+        prr=ElasticResultStorer(self.exp["name"],table_name, cp.Corpus.endpoint)
+        reader=ResultDiskReader(prr, cache_dir=cache_dir, max_results=max_results)
         reader.bufsize=30
+
+        if self.exp.get("binary_results_cache", False):
+            # download everything once and keep it in a single binary file
+            reader.cacheAllItems()
+            convertJsonCacheToBinary(cache_dir, table_name, res_ids=reader.res_ids)
+            return BinaryResultReader(binary_path, max_results=max_results)
         return reader
 
 ##        return prr.readResults(250)
@@ -228,23 +285,11 @@ class WeightTrainer(object):
             better_zones_details=[]
 
             for query_type in self.exp["train_weights_for"]:
-                retrieval_results=self.loadPrecomputedFormulas(query_type)
-                if len(retrieval_results) == 0:
-                    continue
-
-                if len(retrieval_results) < numfolds:
-                    print("Number of results is smaller than number of folds for zone type ", query_type)
+                test_set, num_results=self.loadFoldSet(query_type, split_fold, test_set=True)
+                if test_set is None:
                     continue
 
-                cv = model_selection.KFold( n_splits=numfolds, shuffle=False, random_state=None)
-                cv=[k for k in cv] # run the generator
-                traincv, testcv=cv[split_fold]
-                if isinstance(retrieval_results, ResultIncrementalReader):
-                    test_set=retrieval_results.subset(testcv)
-                elif isinstance(retrieval_results, list):
-                    test_set=[retrieval_results[i] for i in testcv]
-                else:
-                    raise ValueError("Unkown class of results")
+                test_set=self.compileResults(test_set)
 
                 for method in weights[query_type]:
                     weights_baseline=addExtraWeights({x:1 for x in self.all_doc_methods[method]["runtime_parameters"]}, self.exp)
@@ -259,7 +304,7 @@ class WeightTrainer(object):
                             "type":"baseline",
                             "improvement":None,
                             "pct_improvement":None,
-                            "num_data_points":len(retrieval_results)}
+                            "num_data_points":num_results}
                     for metric in metrics:
                         result[metric]=scores[0][metric]
                     for weight in weights[query_type][method]:
@@ -271,7 +316,7 @@ class WeightTrainer(object):
         ##            print "Score with trained weights:",this_score
                     impro=this_score-baseline_score
                     pct_impro=100*(impro/baseline_score) if baseline_score !=0 else 0
-                    improvements.append((impro*len(test_set))/len(retrieval_results))
+                    improvements.append((impro*len(test_set))/num_results)
 
                     result={"query_type":query_type,
                             "fold":split_fold,
@@ -280,7 +325,7 @@ class WeightTrainer(object):
                             "type":"weight",
                             "improvement":impro,
                             "pct_improvement":pct_impro,
-                            "num_data_points":len(retrieval_results)}
+                            "num_data_points":num_results}
                     if impro > 0:
                         better_zones.append(query_type)
                         better_zones_details.append((query_type,pct_impro))
@@ -312,6 +357,34 @@ class WeightTrainer(object):
         fold_data=pd.DataFrame(fold_results)
         fold_data.to_csv(self.exp["exp_dir"]+self.exp["name"]+"_folds_"+xtra+".csv")
 
+    def iterPrecomputedQueries(self, retrieval_results, parameters):
+        """
+            Generator. Recomputes the formulas of each result with the given
+            parameters, yields (result, retrieved)
+        """
+        for result in retrieval_results:
+            # select only the method we're testing for
+            if "formulas" not in result:
+                # there was an error reading this result
+                continue
+
+            yield result, runPrecomputedQuery(result["formulas"],parameters)
+
+    def compileResults(self, retrieval_results, force_compile=False):
+        """
+            Compiles the formulas of a training/testing set once so that each
+            new set of weights can be scored in a single vectorized pass.
+            If exp["compile_formulas"] is False, the results are returned as they
+            are and every formula is recomputed through StoredFormula.
+            Unless exp["incremental_scoring"] is False, single weight changes
+            are scored incrementally (see IncrementalScorer).
+        """
+        if not force_compile and not self.exp.get("compile_formulas", True):
+            return retrieval_results
+        compiled=CompiledRetrievalResults(retrieval_results)
+        compiled.use_incremental_scoring=self.exp.get("incremental_scoring", True)
+        return compiled
+
     def measurePrecomputedResolution(self, retrieval_results, method, parameters, citation_az="*"):
         """
             This is kind of like measureCitationResolution:
@@ -321,22 +394,21 @@ class WeightTrainer(object):
 
             All we need to do is adjust the weights on the already available
             explanation formulas.
+
+            :param retrieval_results: list/reader of results or a
+                CompiledRetrievalResults, which is much faster to re-score
         """
+        if isinstance(retrieval_results, CompiledRetrievalResults):
+            # all formulas are scored and measured at once
+            return retrieval_results.measureWeightMatrix([parameters], method, citation_az)[0]
+
         logger=ResultsLogger(False, dump_straight_to_disk=False) # init all the logging/counting
         logger.startCounting() # for timing the process, start now
 
         logger.setNumItems(len(retrieval_results),print_out=False)
 
         # for each query-result: (results are packed inside each query for each method)
-        for result in retrieval_results:
-            # select only the method we're testing for
-            if "formulas" not in result:
-                # there was an error reading this result
-                continue
-
-            formulas=result["formulas"]
-            retrieved=runPrecomputedQuery(formulas,parameters)
-
+        for result, retrieved in self.iterPrecomputedQueries(retrieval_results, parameters):
             result_dict={"file_guid":result["file_guid"],
                          "citation_id":result["citation_id"],
                          "doc_position":result["doc_position"],
@@ -374,6 +446,138 @@ class WeightTrainer(object):
 
         return results
 
+    def measurePrecomputedResolutionBatch(self, retrieval_results, method, list_of_parameters, citation_az="*"):
+        """
+            Like measurePrecomputedResolution() but for many sets of parameters.
+            If the results are compiled, all of them are measured in a single
+            pass over the formulas.
+
+            :param list_of_parameters: list of K {field: weight} dicts
+            :returns: list of K results, each what measurePrecomputedResolution()
+                would return for those parameters
+        """
+        if isinstance(retrieval_results, CompiledRetrievalResults):
+            return retrieval_results.measureWeightMatrix(list_of_parameters, method, citation_az)
+
+        return [self.measurePrecomputedResolution(retrieval_results, method, parameters, citation_az)
+                for parameters in list_of_parameters]
+
+    def weightCandidates(self, weights, weight_search, min_weight=0):
+        """
+            Generates the candidate weight dicts to try from the current weights.
+
+            "batch": every single-weight movement in exp["movements"], as
+            the greedy search tries, but all scored together.
+            "random": exp["random_search_samples"] random combinations of
+            movements applied to all the weights at once.
+        """
+        candidates=[]
+        if weight_search == "batch":
+            for direction in self.exp["movements"]:
+                for weight_name in weights:
+                    candidate=dict(weights)
+                    candidate[weight_name]=max(min_weight,weights[weight_name]+direction)
+                    if candidate[weight_name] != weights[weight_name]:
+                        candidates.append(candidate)
+        elif weight_search == "random":
+            movements=list(self.exp["movements"])+[0]
+            for _ in range(self.exp.get("random_search_samples",100)):
+                candidates.append({weight_name:max(min_weight,weights[weight_name]+random.choice(movements))
+                                   for weight_name in weights})
+        else:
+            raise ValueError("Unknown weight search strategy: %s" % weight_search)
+        return candidates
+
+    def batchWeightSearch(self, train_set, method, weights, query_type, score_baseline, weight_search, min_weight=0):
+        """
+            Finds good weights by scoring many candidates at each step with
+            measurePrecomputedResolutionBatch() and moving to the best one.
+            Stops when no candidate improves on the current score ("batch") or
+            after exp["random_search_patience"] steps without improvement
+            ("random").
+
+            :param weights: dict of weights, updated in place
+            :returns: the progression of the score, one value per step
+        """
+        previous_score=score_baseline
+        score_progression=[]
+        patience=self.exp.get("random_search_patience",3) if weight_search == "random" else 1
+        steps_without_improvement=0
+        max_steps=self.exp.get("max_weight_search_steps",1000)
+
+        for _ in range(max_steps):
+            candidates=self.weightCandidates(weights, weight_search, min_weight)
+            if len(candidates) == 0:
+                break
+
+            all_scores=self.measurePrecomputedResolutionBatch(train_set, method,
+                                                              [addExtraWeights(candidate, self.exp) for candidate in candidates],
+                                                              query_type)
+            candidate_scores=[scores[0][self.exp["metric"]] for scores in all_scores]
+            best=max(range(len(candidates)), key=lambda index:candidate_scores[index])
+
+            if candidate_scores[best] > previous_score:
+                weights.update(candidates[best])
+                previous_score=candidate_scores[best]
+                steps_without_improvement=0
+            else:
+                steps_without_improvement+=1
+                if steps_without_improvement >= patience:
+                    break
+
+            score_progression.append(previous_score)
+
+        return score_progression
+
+    def trainWeightsInParallel(self, num_processes):
+        """
+            Like calling dynamicWeightValues() for each fold, but every
+            (fold, query_type, method) is a separate job run by a pool of
+            processes.
+
+            Each training set is compiled once and saved to
+            exp_dir/cache/compiled/, and the workers memory-map it from there,
+            so the formula arrays are shared between processes instead of being
+            pickled to each of them.
+
+            :returns: dict of {fold: {query_type: {method: weights}}}
+        """
+        self.exp["movements"]=WEIGHT_MOVEMENTS
+        all_doc_methods=getDictOfTestingMethods(self.exp["doc_methods"])
+        annotated_boost_methods=[x for x in all_doc_methods if all_doc_methods[x]["type"] in ["annotated_boost"]]
+        numfolds=self.exp.get("cross_validation_folds",2)
+
+        best_weights={}
+        jobs=[]
+        for split_fold in range(numfolds):
+            best_weights[split_fold]={}
+            for query_type in self.exp["train_weights_for"]:
+                best_weights[split_fold][query_type]={}
+
+                train_set, num_results=self.loadFoldSet(query_type, split_fold)
+                if train_set is None or len(train_set) == 0:
+                    continue
+
+                print("Compiling fold",split_fold,"training set for",query_type,":",len(train_set),"/",num_results)
+                compiled_path=os.path.join(self.exp["exp_dir"], "cache", "compiled",
+                                           "prr_%s_%s_f%d" % (self.exp["queries_classification"], query_type, split_fold))
+                self.compileResults(train_set, force_compile=True).save(compiled_path)
+                for method in annotated_boost_methods:
+                    jobs.append((self.exp, self.options, split_fold, query_type, method, compiled_path))
+                gc.collect()
+
+        print("Running",len(jobs),"training jobs in",num_processes,"processes")
+        pool=Pool(num_processes)
+        try:
+            for split_fold, query_type, method, method_weights in pool.imap_unordered(trainWeightsJob, jobs):
+                print("Finished fold",split_fold,query_type,method)
+                best_weights[split_fold][query_type][method]=method_weights
+        finally:
+            pool.close()
+            pool.join()
+
+        return best_weights
+
     def trainWeights(self):
         """
             Run the final stage of the weight training pipeline.
@@ -389,16 +593,40 @@ class WeightTrainer(object):
 
         numfolds=self.exp.get("cross_validation_folds",2)
 
-        # First we find the highest weights for each fold's training set
-        for split_fold in range(numfolds):
-            print("\nFold #"+str(split_fold))
-            best_weights[split_fold]=self.dynamicWeightValues(split_fold)
-            gc.collect()
+        num_processes=options.get("num_training_processes",1)
+        if num_processes != 1:
+            # all folds, query types and methods are trained concurrently
+            best_weights=self.trainWeightsInParallel(num_processes or cpu_count())
+        else:
+            # First we find the highest weights for each fold's training set
+            for split_fold in range(numfolds):
+                print("\nFold #"+str(split_fold))
+                best_weights[split_fold]=self.dynamicWeightValues(split_fold)
+                gc.collect()
 
         # Then we actually test them against the
         print("Now applying and testing weights...\n")
         self.measureScoresOfWeights(best_weights)
 
+def trainWeightsJob(job):
+    """
+        Runs a single (fold, query_type, method) training job of
+        WeightTrainer.trainWeightsInParallel() in a worker process.
+
+        :param job: tuple (exp, options, split_fold, query_type, method,
+            compiled_path), where compiled_path is the directory of the saved
+            CompiledRetrievalResults of the training set
+    """
+    exp, options, split_fold, query_type, method, compiled_path=job
+    trainer=WeightTrainer(exp, options)
+    train_set=CompiledRetrievalResults().load(compiled_path, mmap_mode="r")
+    train_set.use_incremental_scoring=exp.get("incremental_scoring", True)
+
+    all_doc_methods=getDictOfTestingMethods(exp["doc_methods"])
+    runtime_parameters={method:all_doc_methods[method]["runtime_parameters"]}
+    method_weights, res=trainer.trainMethodWeights(train_set, method, query_type, runtime_parameters)
+    return split_fold, query_type, method, method_weights
+
 def main():
     logger=ResultsLogger(False,False)
 ##    logger.addResolutionResultDict
@@ -77,43 +77,44 @@ class CorpusImporter(object):
         progress=ProgressIndicator(True, self.num_files_to_process, dot_every_xitems=20)
         tasks=[]
 
-        for fn in ALL_INPUT_FILES[FILES_TO_PROCESS_FROM:FILES_TO_PROCESS_TO]:
-            corpus_id=self.generate_corpus_id(fn)
-            match=cp.Corpus.getMetadataByField("metadata.filename",os.path.basename(fn))
-            if not match or import_options.get("reload_xml_if_doc_in_collection",False):
-                if self.use_celery:
-                        match_id=match["guid"] if match else None
-                        tasks.append(importXMLTask.apply_async(
-                          args=[
-                                os.path.join(inputdir,fn),
-                                corpus_id,
-                                self.import_id,
-                                self.collection_id,
-                                import_options,
-                                match_id
-                                ],
-                                queue="import_xml"
-                                ))
-                else:
-                    # main loop over all files
-                    filename=cp.Corpus.paths.inputXML+fn
-                    corpus_id=self.generate_corpus_id(fn)
-
-                    match=cp.Corpus.getMetadataByField("metadata.filename",os.path.basename(fn))
-                    if not match:
-                        try:
-                            doc=convertXMLAndAddToCorpus(
-                                os.path.join(inputdir,fn),
-                                corpus_id,
-                                self.import_id,
-                                self.collection_id,
-                                import_options
-                                )
-                        except ValueError:
-                            logging.exception("ERROR: Couldn't convert %s" % fn)
-                            continue
-
-                        progress.showProgressReport("Importing -- latest file %s" % fn)
+        with cp.Corpus.bulkWriting():
+            for fn in ALL_INPUT_FILES[FILES_TO_PROCESS_FROM:FILES_TO_PROCESS_TO]:
+                corpus_id=self.generate_corpus_id(fn)
+                match=cp.Corpus.getMetadataByField("metadata.filename",os.path.basename(fn))
+                if not match or import_options.get("reload_xml_if_doc_in_collection",False):
+                    if self.use_celery:
+                            match_id=match["guid"] if match else None
+                            tasks.append(importXMLTask.apply_async(
+                              args=[
+                                    os.path.join(inputdir,fn),
+                                    corpus_id,
+                                    self.import_id,
+                                    self.collection_id,
+                                    import_options,
+                                    match_id
+                                    ],
+                                    queue="import_xml"
+                                    ))
+                    else:
+                        # main loop over all files
+                        filename=cp.Corpus.paths.inputXML+fn
+                        corpus_id=self.generate_corpus_id(fn)
+
+                        match=cp.Corpus.getMetadataByField("metadata.filename",os.path.basename(fn))
+                        if not match:
+                            try:
+                                doc=convertXMLAndAddToCorpus(
+                                    os.path.join(inputdir,fn),
+                                    corpus_id,
+                                    self.import_id,
+                                    self.collection_id,
+                                    import_options
+                                    )
+                            except ValueError:
+                                logging.exception("ERROR: Couldn't convert %s" % fn)
+                                continue
+
+                            progress.showProgressReport("Importing -- latest file %s" % fn)
 
 
 
@@ -130,17 +131,36 @@ class CorpusImporter(object):
 
         tasks=[]
 
-        for doc_id in ALL_GUIDS[FILES_TO_PROCESS_FROM:FILES_TO_PROCESS_TO]:
-            if self.use_celery:
-                tasks.append(updateReferencesTask.apply_async(
-                    args=[doc_id, import_options],
-                    kwargs={},
-                    queue="update_references"
-                    ))
-            else:
-                doc_meta=updatePaperInCollectionReferences(doc_id, import_options)
-                filename=doc_meta["filename"] if doc_meta else "<ERROR>"
-                progress.showProgressReport("Updating references -- latest paper "+filename)
+        # all the papers are in the DB by now, so an in-memory index of them
+        # can be built once and used to match every reference. Celery workers
+        # only do this if use_reference_index is set, see updateReferencesTask
+        if not self.use_celery and import_options.get("use_reference_index", True):
+            print("Building reference matching index...")
+            cp.Corpus.useIndexedReferenceMatcher(fuzzy=import_options.get("fuzzy_reference_matching", False))
+
+        # updatePaperInCollectionReferences() keeps a loaded citation graph up
+        # to date, so it is saved at the end instead of rebuilt. Celery workers
+        # don't share it: the links stamp makes the next load rebuild it
+        if not self.use_celery:
+            print("Loading citation graph...")
+            cp.Corpus.loadCitationGraph()
+        cp.Corpus.markLinksChanged(graph_updated=not self.use_celery)
+
+        with cp.Corpus.bulkWriting():
+            for doc_id in ALL_GUIDS[FILES_TO_PROCESS_FROM:FILES_TO_PROCESS_TO]:
+                if self.use_celery:
+                    tasks.append(updateReferencesTask.apply_async(
+                        args=[doc_id, import_options],
+                        kwargs={},
+                        queue="update_references"
+                        ))
+                else:
+                    doc_meta=updatePaperInCollectionReferences(doc_id, import_options)
+                    filename=doc_meta["filename"] if doc_meta else "<ERROR>"
+                    progress.showProgressReport("Updating references -- latest paper "+filename)
+
+        if not self.use_celery:
+            cp.Corpus.saveCitationGraph()
 
     def listAllFiles(self, start_dir, file_mask):
         """
@@ -215,6 +235,7 @@ class CorpusImporter(object):
             cp.Corpus.bulkDelete(imported_guids, "scidocs")
             cp.Corpus.bulkDelete(imported_guids, "papers")
             cp.Corpus.bulkDelete(resolvable_bags, "cache")
+            cp.Corpus.markLinksChanged()
 
     def importCorpus(self, root_input_dir, file_mask="*.xml", import_options={}, maxfiles=10000000000):
         """
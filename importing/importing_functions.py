@@ -46,6 +46,10 @@ def convertXMLAndAddToCorpus(file_path, corpus_id, import_id, collection_id,
     """
         Reads the input XML and saves a SciDoc
     """
+    # e.g. "zlib-json" to save it compressed, see db.record_codec
+    if import_options.get("record_codec"):
+        cp.Corpus.setRecordCodec(import_options["record_codec"])
+
     update_existing=False
     if not existing_guid:
         existing_guid=cp.Corpus.getMetadataByField("metadata.corpus_id", corpus_id)
@@ -76,10 +80,12 @@ def convertXMLAndAddToCorpus(file_path, corpus_id, import_id, collection_id,
     if doc.metadata.get("corpus_id", "") == "":
         doc.metadata["corpus_id"]=corpus_id
 
-    cp.Corpus.saveSciDoc(doc)
+    # the SciDoc and the metadata go in the same bulk request
+    with cp.Corpus.bulkWriting():
+        cp.Corpus.saveSciDoc(doc)
 
-    if not update_existing:
-        addSciDocToDB(doc, import_id, collection_id)
+        if not update_existing:
+            addSciDocToDB(doc, import_id, collection_id)
 
     return doc
 
@@ -113,23 +119,26 @@ def updatePaperInCollectionReferences(doc_id, import_options):
     if import_options.get("force_import_id", None):
         doc_meta["import_id"]=import_options["force_import_id"]
 
-    for ref in in_collection_references:
-        match_meta=cp.Corpus.getMetadataByGUID(ref)
-        if match_meta:
-            if match_meta["guid"] not in doc_meta["outlinks"]:
-                doc_meta["outlinks"].append(match_meta["guid"])
-            if doc_meta["guid"] not in match_meta["inlinks"]:
-                match_meta["inlinks"].append(doc_meta["guid"])
-                cp.Corpus.updatePaper(match_meta)
-        else:
-            logging.warning("Bizarre: record for GUID %s is missing after matching first" % ref)
-
-##    assert len(resolvable) == 0
-
-    cp.Corpus.updatePaper(doc_meta, op_type="update")
-    if import_options.get("list_missing_references", False):
-        for ref in missing_references:
-            cp.Corpus.addMissingPaper(copyDictExceptKeys(ref,["xml"]))
+    all_match_meta=cp.Corpus.getMetadataByGUIDs(in_collection_references)
+    with cp.Corpus.bulkWriting():
+        for ref, match_meta in zip(in_collection_references, all_match_meta):
+            if match_meta:
+                if match_meta["guid"] not in doc_meta["outlinks"]:
+                    doc_meta["outlinks"].append(match_meta["guid"])
+                if doc_meta["guid"] not in match_meta["inlinks"]:
+                    cp.Corpus.appendInlink(match_meta["guid"], doc_meta["guid"])
+            else:
+                logging.warning("Bizarre: record for GUID %s is missing after matching first" % ref)
+
+    ##    assert len(resolvable) == 0
+
+        # inlinks are left out so that we don't overwrite those appended by
+        # other papers since doc_meta was loaded
+        cp.Corpus.updatePaper(copyDictExceptKeys(doc_meta,["inlinks"]), op_type="update")
+        cp.Corpus.updateCitationGraph(doc_meta["guid"], doc_meta["outlinks"], doc_meta.get("year"))
+        if import_options.get("list_missing_references", False):
+            for ref in missing_references:
+                cp.Corpus.addMissingPaper(copyDictExceptKeys(ref,["xml"]))
     return doc_meta
 
 
@@ -49,6 +49,8 @@ def checkCorpusConnection(local_corpus_dir="",
         print("Celery tasks connecting to",corpus_endpoint)
         cp.useElasticCorpus()
         cp.Corpus.connectCorpus(local_corpus_dir, corpus_endpoint)
+        # other workers update the same papers' metadata while importing
+        cp.Corpus.setObjectCacheLimits(metadata_items=0)
         sleep(random() / float(100))
 
 
@@ -97,6 +99,10 @@ def updateReferencesTask(self, doc_id, import_options):
         Updates one paper's in-collection references, etc.
     """
     try:
+        # can't be the default here: a worker may get this task while
+        # other workers are still importing papers
+        if import_options.get("use_reference_index", False):
+            cp.Corpus.useIndexedReferenceMatcher(fuzzy=import_options.get("fuzzy_reference_matching", False))
         updatePaperInCollectionReferences(doc_id, import_options)
     except:
         logging.exception("Exception in updateReferencesTask")
@@ -226,7 +226,8 @@ def addILCMetadata(context, docfrom, doc_target):
 def extractILCWindow(docfrom, doc_target, ref_id, doctext, parameters, all_contexts):
     """
     This function deals with extracting ILC using window-of-tokens.
-    Returns list of contexts it's extracted.
+    Adds the contexts it's extracted to all_contexts. Returns the text of
+    docfrom, which is formatted again if its citations had to be fixed.
 
     :param docfrom:
     :param doc_target:
@@ -268,6 +269,7 @@ def extractILCWindow(docfrom, doc_target, ref_id, doctext, parameters, all_conte
             for generated_context in contexts:
                 context = addILCMetadata({"text": generated_context["text"]}, docfrom, doc_target)
                 all_contexts[generated_context["params"][0]].append(context)  # ["params"][0] is wleft
+    return doctext
 
 
 def extractILCSentences(docfrom, doc_target, ref_id, parameters, all_contexts):
@@ -294,6 +296,40 @@ def extractILCSentences(docfrom, doc_target, ref_id, parameters, all_contexts):
                 all_contexts[generated_context["params"]].append(context)  # ["params"][0] is wleft
 
 
+# how many citing documents are loaded in one go when building ILC BOWs
+INLINK_DOCS_BATCH_SIZE = 50
+
+
+def iterInlinkDocuments(inlink_guids, meta_to, filter_options, batch_size=INLINK_DOCS_BATCH_SIZE):
+    """
+        Yields (inlink_guid, meta_from, docfrom) for each citing document that
+        shouldn't be ignored. Metadata and SciDocs are fetched in bulk, a batch
+        of documents at a time.
+
+        :param inlink_guids: guids of the citing documents
+        :param meta_to: metadata of the cited document
+        :param filter_options: dict with options for filtering
+    """
+    all_metadata = cp.Corpus.getMetadataByGUIDs(inlink_guids)
+    to_load = []
+    for inlink_guid, meta_from in zip(inlink_guids, all_metadata):
+        if meta_from is None:
+            print("ERROR: Cannot find metadata for %s" % inlink_guid)
+            continue
+        if shouldIgnoreCitation(meta_from, meta_to, filter_options):
+            continue
+        to_load.append((inlink_guid, meta_from))
+
+    for start in range(0, len(to_load), batch_size):
+        batch = to_load[start:start + batch_size]
+        docs = cp.Corpus.loadSciDocs([inlink_guid for inlink_guid, meta_from in batch])
+        for (inlink_guid, meta_from), docfrom in zip(batch, docs):
+            if docfrom is None:
+                print("ERROR: Cannot load SciDoc %s" % inlink_guid)
+                continue
+            yield inlink_guid, meta_from, docfrom
+
+
 def generateDocBOWInlinkContext(doc_target, parameters, doctext=None, filter_options={}, force_rebuild=False):
     """
         Create a BOW from all the inlink contexts of a given document.
@@ -318,22 +354,16 @@ def generateDocBOWInlinkContext(doc_target, parameters, doctext=None, filter_opt
     # print("Window parameters", window_parameters)
     # print("Sentence parameters", sentence_parameters)
 
-    doc_metadata = cp.Corpus.getMetadataByGUID(doc_target_guid)
-    # print("Building VSM representations for ", doc_metadata["guid"], ":", len(doc_metadata["inlinks"]),
+    inlinks = cp.Corpus.getInlinks(doc_target_guid)
+    # print("Building VSM representations for ", doc_target_guid, ":", len(inlinks),
     #       "incoming links")
 
-    set_inlinks = set(doc_metadata["inlinks"])
-    if len(doc_metadata["inlinks"]) > len(set_inlinks):
+    set_inlinks = set(inlinks)
+    if len(inlinks) > len(set_inlinks):
         print("ARGH I listed the inlinks more than once!")
 
     meta_to = doc_target.metadata
-    for inlink_guid in doc_metadata["inlinks"]:
-        meta_from = cp.Corpus.getMetadataByGUID(inlink_guid)
-        if shouldIgnoreCitation(meta_from, meta_to, filter_options):
-            continue
-
-        # loads from cache if exists, XML otherwise
-        docfrom = cp.Corpus.loadSciDoc(inlink_guid)
+    for inlink_guid, meta_from, docfrom in iterInlinkDocuments(inlinks, meta_to, filter_options):
         # important! the doctext here has to be that of the docfrom, NOT doc_incoming
         doctext = docfrom.formatTextForExtraction(docfrom.getFullDocumentText())
         ref_id = identifyReferenceLinkIndex(docfrom, doc_target_guid)
@@ -359,6 +389,100 @@ def generateDocBOWInlinkContext(doc_target, parameters, doctext=None, filter_opt
     return all_contexts
 
 
+def listReferenceLinkIndexes(docfrom):
+    """
+        Returns {guid: ref_id} for all the in-collection documents docfrom
+        cites, the same ids identifyReferenceLinkIndex() would return one
+        guid at a time
+
+        :param docfrom: full SciDoc
+    """
+    res = {}
+    for ref in docfrom["references"]:
+        match = cp.Corpus.matcher.matchReference(ref)
+        if match and match["guid"] not in res:
+            res[match["guid"]] = ref["id"]
+    return res
+
+
+def generateInlinkContextsBySource(target_docs, parameters, filter_options={}, batch_size=INLINK_DOCS_BATCH_SIZE):
+    """
+        Generates the same contexts as generateDocBOWInlinkContext() for many
+        target documents at once, going over the citing documents instead:
+        each citing document is loaded and formatted once, and the contexts of
+        all its citations to any of the targets are extracted in one pass.
+
+        :param target_docs: dict {guid: SciDoc} of the documents to generate
+            inlink_context BOWs for
+        :param parameters: iterable with parameters for ILC. Either numbers or strings
+        :param filter_options: dict with options for filtering
+        :return: dict {guid: all_contexts}, where all_contexts is what
+            generateDocBOWInlinkContext() returns for that document
+    """
+    window_parameters = [param for param in parameters if not isinstance(param, six.string_types)]
+    sentence_parameters = [param for param in parameters if isinstance(param, six.string_types)]
+
+    # citing guid -> guids of the targets it cites
+    inlinks = OrderedDict()
+    citing = OrderedDict()
+    for target_guid in target_docs:
+        inlinks[target_guid] = cp.Corpus.getInlinks(target_guid)
+        for inlink_guid in inlinks[target_guid]:
+            targets = citing.setdefault(inlink_guid, [])
+            if target_guid not in targets:
+                targets.append(target_guid)
+
+    to_load = []
+    all_metadata = cp.Corpus.getMetadataByGUIDs(list(citing.keys()))
+    for inlink_guid, meta_from in zip(citing.keys(), all_metadata):
+        if meta_from is None:
+            print("ERROR: Cannot find metadata for %s" % inlink_guid)
+            continue
+        targets = [target_guid for target_guid in citing[inlink_guid]
+                   if not shouldIgnoreCitation(meta_from, target_docs[target_guid].metadata, filter_options)]
+        if targets:
+            to_load.append((inlink_guid, targets))
+
+    # (target guid, citing guid) -> contexts extracted from that citing document
+    pair_contexts = {}
+    for start in range(0, len(to_load), batch_size):
+        batch = to_load[start:start + batch_size]
+        docs = cp.Corpus.loadSciDocs([inlink_guid for inlink_guid, targets in batch])
+        for (inlink_guid, targets), docfrom in zip(batch, docs):
+            if docfrom is None:
+                print("ERROR: Cannot load SciDoc %s" % inlink_guid)
+                continue
+
+            doctext = docfrom.formatTextForExtraction(docfrom.getFullDocumentText())
+            ref_ids = listReferenceLinkIndexes(docfrom)
+            for target_guid in targets:
+                doc_target = target_docs[target_guid]
+                ref_id = ref_ids.get(target_guid)
+                if not ref_id:
+                    print("ERROR: Cannot match in-collection document %s with reference in file %s" % (
+                        target_guid, docfrom.metadata["guid"]))
+
+                contexts = {param: [] for param in parameters}
+                if len(window_parameters) > 0:
+                    doctext = extractILCWindow(docfrom, doc_target, ref_id, doctext, window_parameters, contexts)
+
+                if len(sentence_parameters) > 0:
+                    extractILCSentences(docfrom, doc_target, ref_id, sentence_parameters, contexts)
+                pair_contexts[(target_guid, inlink_guid)] = contexts
+
+    # the contexts of each target are in the order of its inlinks
+    res = {}
+    for target_guid in target_docs:
+        all_contexts = {param: [] for param in parameters}
+        for inlink_guid in inlinks[target_guid]:
+            contexts = pair_contexts.get((target_guid, inlink_guid))
+            if contexts:
+                for param in contexts:
+                    all_contexts[param].extend(contexts[param])
+        res[target_guid] = all_contexts
+    return res
+
+
 def generateDocBOW_ILC_Annotated(doc_target, parameters, doctext=None, filter_options={}, force_rebuild=False):
     """
         Create a BOW from all the inlink contexts of a given document.
@@ -377,16 +501,13 @@ def generateDocBOW_ILC_Annotated(doc_target, parameters, doctext=None, filter_op
         all_contexts[param] = []
 
     doc_metadata = cp.Corpus.getMetadataByGUID(doc_target_guid)
-    print("Building VSM representations for ", doc_metadata["guid"], ":", len(doc_metadata["inlinks"]),
+    inlinks = cp.Corpus.getInlinks(doc_target_guid)
+    print("Building VSM representations for ", doc_metadata["guid"], ":", len(inlinks),
           "incoming links")
 
-    for inlink_guid in doc_metadata["inlinks"]:
-        incoming_citation_metadata = cp.Corpus.getMetadataByGUID(inlink_guid)
-        if shouldIgnoreCitation(incoming_citation_metadata, doc_metadata, filter_options):
-            continue
-
-        # loads from cache if exists, XML otherwise
-        docfrom = cp.Corpus.loadSciDoc(inlink_guid)
+    for inlink_guid, incoming_citation_metadata, docfrom in iterInlinkDocuments(inlinks,
+                                                                                 doc_metadata,
+                                                                                 filter_options):
         ##        cp.Corpus.annotateDoc(docfrom,["AZ"])
 
         ref_id = identifyReferenceLinkIndex(docfrom, doc_target_guid)
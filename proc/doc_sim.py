@@ -52,7 +52,7 @@ class DocSimilarity(object):
                                                    "missing_files.txt")
 
     def saveGuidDict(self):
-        self.all_guids = self.corpus.listPapers()
+        self.all_guids = list(self.corpus.iterPapers())
 
         count_model = CountVectorizer(vocabulary=self.all_guids,
                                       ngram_range=(1, 1))
@@ -135,6 +135,15 @@ class DocSimilarity(object):
         self.saveDiceMatrix()
         return self.dice
 
+    def iterSciDocs(self, guids, batch_size=50):
+        """
+            Yields (guid, SciDoc) for each guid, loading the SciDocs in bulk
+        """
+        for start in range(0, len(guids), batch_size):
+            batch = guids[start:start + batch_size]
+            for guid, doc in zip(batch, self.corpus.loadSciDocs(batch)):
+                yield guid, doc
+
     def generateCocitationMatrix(self):
         """
         Fills and exports the co-occurrence matrix in resolvable citations
@@ -149,8 +158,9 @@ class DocSimilarity(object):
             oc = defaultdict(lambda: 0)
 
         missing_guids = []
-        for guid in tqdm(self.all_guids):
-            doc = self.corpus.loadSciDoc(guid)
+        for guid, doc in tqdm(self.iterSciDocs(self.all_guids), total=len(self.all_guids)):
+            if doc is None:
+                continue
             resolvable = self.corpus.loadOrGenerateResolvableCitations(
                 doc, force_recompute=self.force_regenerate_resolvable_citations)
             resolvable = resolvable["resolvable"]
@@ -98,9 +98,32 @@ global_stemmer = SnowballStemmer("english")
 
 USING_STEMMING = False
 
+# if True, tokenizeText() uses regexTokenize() instead of NLTK's word_tokenize.
+# Validate it on the corpus first with compareTokenizers()
+USING_REGEX_TOKENIZER = False
+
+# if True, formatSentenceForIndexing() keeps the tokens of each sentence in the
+# sentence dict, see tokenizeSentence()
+CACHE_SENTENCE_TOKENS = False
+
+# token -> stem, shared by all the calls to stemTokens()
+stem_cache = {}
+
 rx_sentences_to_add = re.compile(r"(?:(?:(\d)up)_?(?:(\d)down)?(_withinpara)?)|(paragraph)|(1only)", re.IGNORECASE)
 rx_word_boundaries = re.compile('\w+', re.IGNORECASE)
 
+# regexTokenize(): the same splits NLTK's word tokenizer makes, in fewer passes
+rx_opening_double_quotes = re.compile(r'(^|[\s(\[{<])(?:"|\'\')')
+rx_double_quotes = re.compile(r'"|\'\'')
+rx_opening_single_quote = re.compile(r"(?i)(?<!\w)'(?!(?:re|ve|ll|m|t|s|d|n)\b)(?=\w)")
+rx_split_punctuation = re.compile(r"\.{2,}|--|`+|[;@#$%&?!*\[\](){}<>\u2012-\u2015\u00ab\u00bb\u201c\u201d\u2018\u2019\u201e]|[:,](?!\d)")
+# a period that ends a sentence: followed by the end of the text or by a new
+# sentence starting with a capital letter or a number
+rx_final_period = re.compile(r"(?<=[^.\s])\.(?=[\])}>\"']*(?:$|\s+[\"'`(\[{]*[A-Z0-9]))")
+rx_contractions = re.compile(r"(?<=[^'\s])('[sSmMdD]|'ll|'LL|'re|'RE|'ve|'VE|n't|N'T|')(?=\s|$)")
+rx_fused_words = re.compile(r"(?i)\b(?:can(?=not\b)|d(?='ye\b)|gim(?=me\b)|gon(?=na\b)|got(?=ta\b)|lem(?=me\b)|"
+                            r"more(?='n\b)|wan(?=na\s))")
+
 
 # helper functions
 def removeCitations(s):
@@ -127,6 +150,42 @@ def sentenceSplit(text):
     return sent_tokenize(text)
 
 
+def regexTokenize(text):
+    """
+        Fast approximation of NLTK's word_tokenize: splits punctuation,
+        quotes, contractions and sentence-final periods the same way, but
+        doesn't run the Punkt sentence splitter, so a period after an
+        abbreviation followed by a capitalized word is split too.
+    """
+    text = rx_opening_double_quotes.sub(r"\1 `` ", text)
+    text = rx_double_quotes.sub(" '' ", text)
+    text = rx_opening_single_quote.sub("' ", text)
+    text = rx_split_punctuation.sub(r" \g<0> ", text)
+    text = rx_final_period.sub(" . ", text)
+    text = rx_contractions.sub(r" \1", text)
+    text = rx_fused_words.sub(r"\g<0> ", text)
+    return text.split()
+
+
+def compareTokenizers(texts, max_differences=20):
+    """
+        Tokenizes each text with word_tokenize and regexTokenize
+
+        :returns: (fraction of texts tokenized identically, list of up to
+            max_differences (text, word_tokenize tokens, regexTokenize tokens))
+    """
+    same = 0
+    differences = []
+    for text in texts:
+        expected = word_tokenize(text)
+        tokens = regexTokenize(text)
+        if tokens == expected:
+            same += 1
+        elif len(differences) < max_differences:
+            differences.append((text, expected, tokens))
+    return same / float(max(len(texts), 1)), differences
+
+
 def tokenizeText(text, no_stemming=False):
     """
         Doesn't remove stopwords. Automatically stems if USING_STEMMING is True.
@@ -135,12 +194,15 @@ def tokenizeText(text, no_stemming=False):
 
         Returns: list of tokens (strings is assumed, may be dict)
     """
-    try:
-        tokens = word_tokenize(text)
-    except:
-        import nltk
-        nltk.download("punkt")
-        tokens = word_tokenize(text)
+    if USING_REGEX_TOKENIZER:
+        tokens = regexTokenize(text)
+    else:
+        try:
+            tokens = word_tokenize(text)
+        except:
+            import nltk
+            nltk.download("punkt")
+            tokens = word_tokenize(text)
 
     if USING_STEMMING and not no_stemming:
         return stemTokens(tokens)
@@ -201,6 +263,32 @@ def getFirstNumberFromString(text):
     return int(match.group(1))
 
 
+def tokenizeSentence(s, no_stemming=False):
+    """
+        Returns the tokens of a sentence dict's text, without citations or
+        XML. If CACHE_SENTENCE_TOKENS is True, they are kept in s["_tokens"]
+        for as long as the text doesn't change.
+    """
+    stemming = USING_STEMMING and not no_stemming
+    key = ("stemmed" if stemming else "plain") + ("_regex" if USING_REGEX_TOKENIZER else "")
+    if CACHE_SENTENCE_TOKENS:
+        cached = s.get("_tokens")
+        if cached and cached.get("text") == s["text"] and key in cached:
+            return cached[key]
+
+    text = removeCitations(s["text"])
+    text = cleanXML(text)
+    tokens = tokenizeText(text, no_stemming)
+
+    if CACHE_SENTENCE_TOKENS:
+        cached = s.get("_tokens")
+        if not cached or cached.get("text") != s["text"]:
+            cached = {"text": s["text"]}
+            s["_tokens"] = cached
+        cached[key] = tokens
+    return tokens
+
+
 def formatSentenceForIndexing(s, no_stemming=False):
     """
         Fixes all the contents of the sentence, returns a sentence that's easy
@@ -208,10 +296,7 @@ def formatSentenceForIndexing(s, no_stemming=False):
 
         FIXME: DEPRECATED
     """
-    text = s["text"]
-    text = removeCitations(text)
-    text = cleanXML(text)
-    tokens = tokenizeText(text, no_stemming)
+    tokens = tokenizeSentence(s, no_stemming)
     tokens = removeStopwords(tokens)
     text = unTokenize(tokens)
     return text
@@ -320,7 +405,11 @@ def stemTokens(tokens):
         ##        if new_token != token:
         ##            res.append(new_token)
         if token not in [CITATION_PLACEHOLDER, CIT_MARKER]:
-            res.append(global_stemmer.stem(token))
+            stem = stem_cache.get(token)
+            if stem is None:
+                stem = global_stemmer.stem(token)
+                stem_cache[token] = stem
+            res.append(stem)
         else:
             res.append(token)
     return res
@@ -15,6 +15,7 @@ from proc.results_logging import ProgressIndicator
 import db.corpora as cp
 from proc.doc_representation import getDictOfLuceneIndeces
 from .index_functions import addBOWsToIndex
+from .parallel_index_builder import ParallelIndexBuilder, getCheckpointPath, DEFAULT_BATCH_SIZE
 
 from proc.nlp_functions import CORESC_LIST
 
@@ -68,7 +69,7 @@ class BaseIndexer(object):
             ##                if match:
             ##                    ref_guid=match["guid"]
             # even newer way: just use the precomputed metadata.outlinks
-            outlinks = cp.Corpus.getMetadataByGUID(guid)["outlinks"]
+            outlinks = cp.Corpus.getOutlinks(guid)
             for ref_guid in outlinks:
                 addBOWsToIndex(ref_guid, indexNames, 9999, fwriters)
                 # TODO integrate this block below into addBOWsToIndex
@@ -136,20 +137,23 @@ class BaseIndexer(object):
 
         missing_bows = []
         if not self.use_celery:
-            progress = ProgressIndicator(True, numfiles, print_out=False)
-            for guid in ALL_GUIDS[options.get("index_start_at", 0):]:
-                try:
-                    addBOWsToIndex(guid, indexNames, index_max_year, fwriters)
-                except:
-                    missing_bows.append(guid)
-                    continue
-
-                progress.showProgressReport("Adding papers to index")
-                # print(guid)
-                # progress.showProgressReport(guid)
-            for fwriter in fwriters:
-                fwriters[fwriter].close()
-            progress.close()
+            checkpoint_path = None
+            if exp.get("exp_dir"):
+                checkpoint_path = getCheckpointPath(exp["exp_dir"], indexNames)
+            builder = ParallelIndexBuilder(indexNames,
+                                           fwriters,
+                                           index_max_year,
+                                           num_workers=options.get("index_workers", 1),
+                                           batch_size=options.get("index_batch_size", DEFAULT_BATCH_SIZE),
+                                           checkpoint_path=checkpoint_path)
+            if options.get("force_recreate_indexes", False):
+                builder.clearCheckpoint()
+            builder.build(ALL_GUIDS[options.get("index_start_at", 0):])
+            missing_bows = builder.missing
+            if missing_bows:
+                print("Couldn't load BOWs for %d papers" % len(missing_bows))
+            if builder.failed:
+                print("Couldn't add %d papers to the index" % len(builder.failed))
         else:
             print("Queueing up files for import...")
             # progress = ProgressIndicator(True, len(ALL_GUIDS), print_out=False)
@@ -163,15 +167,17 @@ class BaseIndexer(object):
 
             jobs = group(all_tasks)
 
-            result = jobs.apply_async(queue="add_to_index", exchange="add_to_index", route_name="add_to_index")
-            print("Waiting for tasks to complete...")
             try:
-                result.join()
-            except KeyboardInterrupt:
-                print("KeyboardInterrupt: Skipping to next stage")
-                pass
-            for fwriter in fwriters:
-                fwriters[fwriter].close()
+                result = jobs.apply_async(queue="add_to_index", exchange="add_to_index", route_name="add_to_index")
+                print("Waiting for tasks to complete...")
+                try:
+                    result.join()
+                except KeyboardInterrupt:
+                    print("KeyboardInterrupt: Skipping to next stage")
+                    pass
+            finally:
+                for fwriter in fwriters:
+                    fwriters[fwriter].close()
         # print("All missing BOWs:\n", missing_bows)
     # -------------------------------------------------------------------------------
     #  Methods to be overriden in descendant classes
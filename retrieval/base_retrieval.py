@@ -110,6 +110,19 @@ class BaseRetrieval(object):
         """
         raise NotImplementedError
 
+    def formulasFromExplanations(self, query, doc_ids):
+        """
+            Returns a StoredFormula for each of doc_ids, in the same order.
+            Descendant classes that can explain many documents in one go
+            should override this, by default it calls .formulaFromExplanation()
+            for each document.
+
+            :param query: same as for .formulaFromExplanation()
+            :param doc_ids: list of ids of documents to explain
+            :returns: list of StoredFormula
+        """
+        return [self.formulaFromExplanation(query, doc_id) for doc_id in doc_ids]
+
 
 def main():
     pass
@@ -0,0 +1,419 @@
+# CompiledFormulaSet: flattened, vectorized evaluation of stored explain formulas
+#
+# Copyright:   (c) Daniel Duma 2018
+# Author: Daniel Duma <danielduma@gmail.com>
+
+# For license information, see LICENSE.TXT
+
+from __future__ import absolute_import
+import json, os
+import numpy as np
+from six.moves import range
+
+from retrieval.stored_formula import StoredFormula
+
+# opcodes for the nodes of a compiled formula
+OP_HIT = 0
+OP_CONST = 1
+OP_SUM = 2
+OP_PROD = 3
+OP_MAX = 4
+
+OPERATION_OPCODES = {"+": OP_SUM, "*": OP_PROD, "max": OP_MAX}
+OPCODE_UFUNCS = [(OP_SUM, np.add), (OP_PROD, np.multiply), (OP_MAX, np.maximum)]
+
+# value that a node with no parts evaluates to
+EMPTY_NODE_VALUES = {OP_SUM: 0.0, OP_PROD: 1.0, OP_MAX: 0.0}
+
+
+class CompiledFormulaSet(object):
+    """
+        Flattens any number of StoredFormula trees into NumPy arrays so that
+        they can all be scored at once for a given set of field weights.
+
+        Every node of every formula is stored in pre-order in a few parallel
+        arrays (opcode, parent, depth, value, field). For hits, the value is the
+        qw * fw product, so the score of a hit is just value * weight[field].
+        Scoring is a gather-multiply for all the hits followed by one
+        ufunc.reduceat per (depth, opcode), from the deepest level up to the
+        roots.
+    """
+
+    def __init__(self, fields=None):
+        """
+            :param fields: optional list of field names, fixes the order of
+                the columns of the weight vectors. Fields not in this list are
+                appended as they are found in the formulas.
+        """
+        self.fields = []
+        self.field_index = {}
+        for field in fields or []:
+            self.getFieldIndex(field)
+
+        self._op = []
+        self._parent = []
+        self._depth = []
+        self._value = []
+        self._field = []
+        self._roots = []
+
+        self.compiled = False
+        # max number of node values to hold in memory at once when scoring
+        # many weight vectors: the matrix is evaluated in chunks of rows
+        self.max_batch_elements = 20000000
+
+    def __len__(self):
+        if self.compiled:
+            return len(self.roots)
+        return len(self._roots)
+
+    def getFieldIndex(self, field):
+        """
+            Returns the column of the weight vector for a field, adding it if
+            it is new
+        """
+        index = self.field_index.get(field)
+        if index is None:
+            index = len(self.fields)
+            self.fields.append(field)
+            self.field_index[field] = index
+        return index
+
+    def addNode(self, op, parent, depth, value=0.0, field=-1):
+        """
+            Appends a node to the flat arrays, returns its index
+        """
+        self._op.append(op)
+        self._parent.append(parent)
+        self._depth.append(depth)
+        self._value.append(value)
+        self._field.append(field)
+        return len(self._op) - 1
+
+    def addPart(self, part, parent, depth):
+        """
+            Recursively flattens a part of a formula, in the same way that
+            StoredFormula.computeScore() walks it
+        """
+        if isinstance(part, tuple) or isinstance(part, list):
+            # (field, qw, fw, ...)
+            self.addNode(OP_HIT, parent, depth, float(part[1]) * float(part[2]), self.getFieldIndex(part[0]))
+
+        elif isinstance(part, dict):
+            if "type" not in part:
+                # formula of a document that did not match: {"coord": 0, "matches": []}
+                self.addNode(OP_CONST, parent, depth, float(part.get("coord", 0)))
+            elif part["type"] in OPERATION_OPCODES:
+                op = OPERATION_OPCODES[part["type"]]
+                if len(part["parts"]) == 0:
+                    self.addNode(OP_CONST, parent, depth, EMPTY_NODE_VALUES[op])
+                else:
+                    index = self.addNode(op, parent, depth)
+                    for sub_part in part["parts"]:
+                        self.addPart(sub_part, index, depth + 1)
+            elif part["type"] in ["const", "coord"]:
+                assert (part["value"] is not None)
+                self.addNode(OP_CONST, parent, depth, float(part["value"]))
+            else:
+                raise ValueError("Unexpected operation type: %s" % part["type"])
+        else:
+            raise ValueError("Unexpected type %s" % type(part))
+
+    def addFormula(self, formula):
+        """
+            Adds a formula to the set. Must be called before compile().
+
+            :param formula: StoredFormula or the raw formula dict as stored
+            :returns: index of the formula in the set
+        """
+        if isinstance(formula, StoredFormula):
+            formula = formula.formula
+
+        self.compiled = False
+        self._roots.append(len(self._op))
+        self.addPart(formula, -1, 0)
+        return len(self._roots) - 1
+
+    def addFormulas(self, formulas):
+        """
+            Adds a list of formulas, returns the index of the first one
+        """
+        first = len(self._roots)
+        for formula in formulas:
+            self.addFormula(formula)
+        return first
+
+    def compile(self):
+        """
+            Converts the node lists to arrays and builds the evaluation program:
+            a list of (ufunc, children, segment_starts, parents), one per
+            (depth, opcode), ordered from the deepest level up.
+
+            In pre-order, the children at any given depth appear sorted by
+            parent, so each group of siblings is a contiguous segment that
+            ufunc.reduceat can collapse in one go.
+        """
+        return self.setArrays(np.array(self._op, dtype=np.int8),
+                              np.array(self._parent, dtype=np.int64),
+                              np.array(self._depth, dtype=np.int32),
+                              np.array(self._value, dtype=np.float64),
+                              np.array(self._field, dtype=np.int32),
+                              np.array(self._roots, dtype=np.int64))
+
+    def setArrays(self, op, parent, depth, value, field, roots):
+        """
+            Sets the flat node arrays directly, e.g. when they come from a
+            BinaryResultReader instead of being built with addFormula(), and
+            builds the program.
+
+            :param parent: index of the parent of each node, -1 for roots
+            :param roots: index of the root node of each formula
+            :returns: self
+        """
+        self.op = op
+        self.parent = parent
+        self.depth = depth
+        self.value = value
+        self.field = field
+        self.roots = roots
+        self.buildProgram()
+        return self
+
+    def buildProgram(self):
+        """
+            Builds the evaluation program from the flat node arrays
+        """
+        self.hit_nodes = np.flatnonzero(self.op == OP_HIT)
+        self.hit_fields = self.field[self.hit_nodes]
+        self.hit_values = self.value[self.hit_nodes]
+
+        self.const_nodes = np.flatnonzero(self.op == OP_CONST)
+        self.const_values = self.value[self.const_nodes]
+
+        self.program = []
+        max_depth = int(self.depth.max()) if len(self.depth) > 0 else 0
+        for depth in range(max_depth, 0, -1):
+            children = np.flatnonzero(self.depth == depth)
+            parents = self.parent[children]
+            parent_ops = self.op[parents]
+            for opcode, ufunc in OPCODE_UFUNCS:
+                mask = parent_ops == opcode
+                if not mask.any():
+                    continue
+                op_children = children[mask]
+                op_parents = parents[mask]
+                starts = np.flatnonzero(np.concatenate(([True], op_parents[1:] != op_parents[:-1])))
+                self.program.append((ufunc, op_children, starts, op_parents[starts]))
+
+        self.compiled = True
+
+    def formulaDegrees(self):
+        """
+            Finds, for each formula, whether its score is constant (0), linear
+            (1) or non-linear (2) in the field weights. Hits are linear, sums
+            keep the highest degree of their parts, products add them up and
+            max is only linear if all but one of its parts are missing.
+
+            :returns: array of degrees, one per formula
+        """
+        if not self.compiled:
+            self.compile()
+
+        degrees = np.zeros(len(self.op), dtype=np.int64)
+        degrees[self.hit_nodes] = 1
+        for ufunc, children, starts, parents in self.program:
+            child_degrees = degrees[children]
+            if ufunc is np.add:
+                degrees[parents] = np.maximum.reduceat(child_degrees, starts)
+            elif ufunc is np.multiply:
+                degrees[parents] = np.minimum(np.add.reduceat(child_degrees, starts), 2)
+            else:
+                # max of a single part is that part, max of several parts is
+                # only linear if they are all constant
+                num_parts = np.diff(np.append(starts, len(children)))
+                non_constant = np.add.reduceat((child_degrees > 0).astype(np.int64), starts)
+                degrees[parents] = np.where(num_parts == 1, child_degrees[starts], np.where(non_constant > 0, 2, 0))
+        return degrees[self.roots]
+
+    def linearDecomposition(self):
+        """
+            Every formula that is linear in the field weights can be scored as
+            coefficients . weights + bias. This finds the coefficients and bias
+            by scoring the formulas with all weights at 0 and then with each
+            weight at 1 in turn.
+
+            :returns: tuple (linear, coefficients, bias): a boolean mask of the
+                linear formulas, a (num_formulas, num_fields) matrix and a
+                vector. Rows of non-linear formulas are meaningless.
+        """
+        num_fields = len(self.fields)
+        unit_weights = np.vstack([np.zeros((1, num_fields)), np.eye(num_fields)])
+        scores = self.computeScoreMatrix(unit_weights)
+        bias = scores[0]
+        coefficients = (scores[1:] - bias).T.copy()
+        return self.formulaDegrees() <= 1, coefficients, bias
+
+    def subset(self, formula_indices):
+        """
+            Returns a new CompiledFormulaSet with only some of the formulas,
+            keeping the same field columns
+        """
+        if not self.compiled:
+            self.compile()
+
+        formula_indices = np.asarray(formula_indices, dtype=np.int64)
+        ends = np.append(self.roots[1:], len(self.op))
+        starts = self.roots[formula_indices]
+        lengths = ends[formula_indices] - starts
+        new_starts = (np.cumsum(lengths) - lengths).astype(np.int64)
+        shifts = np.repeat(starts - new_starts, lengths)
+        node_index = np.arange(int(lengths.sum()), dtype=np.int64) + shifts
+
+        parent = self.parent[node_index] - shifts
+        depth = np.asarray(self.depth[node_index])
+        parent[depth == 0] = -1
+
+        new = CompiledFormulaSet(self.fields)
+        return new.setArrays(self.op[node_index], parent, depth, self.value[node_index], self.field[node_index],
+                             new_starts)
+
+    def save(self, path):
+        """
+            Saves the compiled arrays and program as .npy files in a directory,
+            so that other processes can load() them memory-mapped instead of
+            receiving a pickled copy.
+        """
+        if not self.compiled:
+            self.compile()
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+        ufuncs = [ufunc for _, ufunc in OPCODE_UFUNCS]
+        # position of each step's ufunc in OPCODE_UFUNCS
+        program_ops = np.array([ufuncs.index(step[0]) for step in self.program], dtype=np.int8)
+        arrays = {"op": self.op,
+                  "parent": self.parent,
+                  "depth": self.depth,
+                  "value": self.value,
+                  "field": self.field,
+                  "roots": self.roots,
+                  "hit_nodes": self.hit_nodes,
+                  "hit_fields": self.hit_fields,
+                  "hit_values": self.hit_values,
+                  "const_nodes": self.const_nodes,
+                  "const_values": self.const_values,
+                  "program_ops": program_ops,
+                  }
+        for index, name in enumerate(["children", "starts", "parents"]):
+            parts = [step[index + 1] for step in self.program]
+            arrays["program_" + name] = np.concatenate(parts) if parts else np.zeros(0, dtype=np.int64)
+            arrays["program_" + name + "_offsets"] = np.cumsum([0] + [len(part) for part in parts]).astype(np.int64)
+
+        for name in arrays:
+            np.save(os.path.join(path, name + ".npy"), arrays[name])
+        json.dump({"fields": self.fields}, open(os.path.join(path, "fields.json"), "w"))
+
+    def load(self, path, mmap_mode="r"):
+        """
+            Loads a set previously saved with save(). With mmap_mode="r" the
+            arrays are memory-mapped read-only, so any number of processes can
+            share the same pages.
+
+            :returns: self
+        """
+        def loadArray(name):
+            return np.load(os.path.join(path, name + ".npy"), mmap_mode=mmap_mode)
+
+        self.fields = []
+        self.field_index = {}
+        for field in json.load(open(os.path.join(path, "fields.json"), "r"))["fields"]:
+            self.getFieldIndex(field)
+
+        for name in ["op", "parent", "depth", "value", "field", "roots",
+                     "hit_nodes", "hit_fields", "hit_values", "const_nodes", "const_values"]:
+            setattr(self, name, loadArray(name))
+
+        program_ops = loadArray("program_ops")
+        program_parts = []
+        for name in ["children", "starts", "parents"]:
+            values = loadArray("program_" + name)
+            offsets = loadArray("program_" + name + "_offsets")
+            program_parts.append([values[offsets[i]:offsets[i + 1]] for i in range(len(program_ops))])
+
+        self.program = [(OPCODE_UFUNCS[program_ops[i]][1],
+                         program_parts[0][i],
+                         program_parts[1][i],
+                         program_parts[2][i]) for i in range(len(program_ops))]
+        self.compiled = True
+        return self
+
+    def weightVector(self, field_parameters=None):
+        """
+            Converts a dict of {field: weight} to a vector in the order of
+            self.fields. If no parameters are given every weight is 1, as in
+            StoredFormula.computeScore()
+        """
+        if not field_parameters:
+            return np.ones(len(self.fields), dtype=np.float64)
+        return np.array([float(field_parameters[field]) for field in self.fields], dtype=np.float64)
+
+    def weightMatrix(self, list_of_parameters):
+        """
+            Stacks a list of {field: weight} dicts into a (K, num_fields) matrix
+        """
+        if len(list_of_parameters) == 0:
+            return np.zeros((0, len(self.fields)), dtype=np.float64)
+        return np.vstack([self.weightVector(parameters) for parameters in list_of_parameters])
+
+    def evaluateNodes(self, weight_matrix):
+        """
+            Runs the program for a (K, num_fields) matrix of weights, returns
+            the (K, num_nodes) matrix of values of every node
+        """
+        values = np.zeros((weight_matrix.shape[0], len(self.op)), dtype=np.float64)
+        values[:, self.const_nodes] = self.const_values
+        values[:, self.hit_nodes] = weight_matrix[:, self.hit_fields] * self.hit_values
+        for ufunc, children, starts, parents in self.program:
+            values[:, parents] = ufunc.reduceat(values[:, children], starts, axis=1)
+        return values
+
+    def computeScoreMatrix(self, weight_matrix):
+        """
+            Scores every formula for each of the K rows of weight_matrix.
+
+            :param weight_matrix: (K, num_fields) array-like, columns in the
+                order of self.fields
+            :returns: (K, num_formulas) array of scores
+        """
+        if not self.compiled:
+            self.compile()
+
+        weight_matrix = np.atleast_2d(np.asarray(weight_matrix, dtype=np.float64))
+        assert weight_matrix.shape[1] == len(self.fields), "Weight matrix must have one column per field"
+
+        rows_per_batch = max(1, self.max_batch_elements // max(1, len(self.op)))
+        scores = np.empty((weight_matrix.shape[0], len(self.roots)), dtype=np.float64)
+        for start in range(0, weight_matrix.shape[0], rows_per_batch):
+            end = start + rows_per_batch
+            scores[start:end] = self.evaluateNodes(weight_matrix[start:end])[:, self.roots]
+        return scores
+
+    def computeScores(self, field_parameters=None):
+        """
+            Scores every formula with a single dict of {field: weight}.
+            Equivalent to calling StoredFormula.computeScore(None,
+            field_parameters) on each formula.
+
+            :returns: 1-d array of scores, one per formula
+        """
+        if not self.compiled:
+            self.compile()
+        return self.computeScoreMatrix(self.weightVector(field_parameters))[0]
+
+
+def main():
+    pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+# Runs retrieval calls concurrently on a bounded thread pool
+#
+# Copyright:   (c) Daniel Duma 2018
+# Author: Daniel Duma <danielduma@gmail.com>
+
+# For license information, see LICENSE.TXT
+
+from __future__ import absolute_import
+import logging
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from elasticsearch.exceptions import ConnectionError, ConnectionTimeout, TransportError
+
+DEFAULT_MAX_RETRIES = 3
+DEFAULT_RETRY_BACKOFF = 1.0  # seconds, doubled after every retry
+
+# HTTP status codes that mean the cluster is busy, not that the request is wrong
+RETRY_STATUS_CODES = [429, 502, 503, 504]
+
+
+def isRetriableError(e):
+    """
+        True if the exception is a connection error or an ES "too busy" error,
+        i.e. it's worth trying the same request again after a while
+    """
+    if isinstance(e, (ConnectionError, ConnectionTimeout)):
+        return True
+    if isinstance(e, TransportError) and getattr(e, "status_code", None) in RETRY_STATUS_CODES:
+        return True
+    return False
+
+
+def callWithRetries(function, args=(), kwargs=None, max_retries=DEFAULT_MAX_RETRIES, backoff=DEFAULT_RETRY_BACKOFF):
+    """
+        Calls function(*args, **kwargs). If it raises a retriable error, waits
+        and tries again, doubling the wait each time, up to max_retries times.
+    """
+    if kwargs is None:
+        kwargs = {}
+
+    retries = 0
+    while True:
+        try:
+            return function(*args, **kwargs)
+        except Exception as e:
+            if retries >= max_retries or not isRetriableError(e):
+                raise
+            wait = backoff * (2 ** retries)
+            logging.warning("Retriable error (%s), retrying in %.1f seconds" % (str(e), wait))
+            time.sleep(wait)
+            retries += 1
+
+
+class ConcurrentRetrieval(object):
+    """
+        Keeps up to max_workers blocking calls (ES queries, explains, gets) in
+        flight at the same time on a thread pool. Every call is retried with
+        exponential backoff on connection and "too busy" errors.
+
+        The Elasticsearch client is thread-safe, so one client can be shared
+        by all the threads, as long as its connection pool has at least
+        max_workers connections per host (see ElasticCorpus.connection_pool_size)
+    """
+
+    def __init__(self, max_workers, max_retries=DEFAULT_MAX_RETRIES, backoff=DEFAULT_RETRY_BACKOFF):
+        self.max_workers = max(1, max_workers)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers)
+
+    def submit(self, function, *args, **kwargs):
+        """
+            Schedules function(*args, **kwargs), returns a Future
+        """
+        return self.executor.submit(callWithRetries, function, args, kwargs, self.max_retries, self.backoff)
+
+    def imap(self, function, items):
+        """
+            Like map(function, items) but with up to max_workers calls running
+            at the same time. Results are yielded in the same order as items.
+            Items are consumed lazily, so at most 2 * max_workers results are
+            waiting at any one time.
+        """
+        pending = deque()
+        for item in items:
+            pending.append(self.submit(function, item))
+            if len(pending) >= 2 * self.max_workers:
+                yield pending.popleft().result()
+
+        while pending:
+            yield pending.popleft().result()
+
+    def map(self, function, items):
+        """
+            Same as imap, but returns a list
+        """
+        return list(self.imap(function, items))
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown()
+
+
+def createConcurrentRetrieval(exp):
+    """
+        Returns a ConcurrentRetrieval configured from the experiment dict, or
+        None if exp["concurrent_queries"] is not set or <= 1.
+    """
+    max_workers = exp.get("concurrent_queries", 1) or 1
+    if max_workers <= 1:
+        return None
+
+    return ConcurrentRetrieval(max_workers,
+                               max_retries=exp.get("query_max_retries", DEFAULT_MAX_RETRIES),
+                               backoff=exp.get("query_retry_backoff", DEFAULT_RETRY_BACKOFF))
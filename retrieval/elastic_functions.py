@@ -1,9 +1,10 @@
 import json
 
-import requests
 from elasticsearch import ConnectionError
 import six
 
+from db.elastic_connection import getHTTPSession
+
 def getElasticURL(endpoint, index_name, doc_type):
     """
         Builds the url string for a given index_name and doc_type using the
@@ -25,7 +26,7 @@ def getElasticTotalDocs(endpoint, index_name, doc_type):
         Returns total number of documents in an index
     """
     url = getElasticURL(endpoint, index_name, doc_type)
-    r = requests.get(url + "_count", {"query": {"match_all": {}}})
+    r = getHTTPSession().get(url + "_count", params={"query": {"match_all": {}}})
     data = json.loads(r.text)
     docs_in_index = int(data["count"])
     return docs_in_index
@@ -56,7 +57,7 @@ def getElasticTermScores(endpoint, token_string, index_name, field_names, doc_ty
         "dfs": True,
         "doc": doc
     }
-    r = requests.post(url, data=json.dumps(request))
+    r = getHTTPSession().post(url, data=json.dumps(request), headers={"Content-Type": "application/json"})
     data = json.loads(r.text)
 
     res = {}
@@ -9,11 +9,11 @@ from __future__ import absolute_import
 from __future__ import print_function
 import json
 
-from elasticsearch import Elasticsearch
+from db.elastic_connection import getElasticClient
 from .base_index import BaseIndexer
 from retrieval.elastic_retrieval import ES_TYPE_DOC
 from . import index_functions
-from .elastic_writer import BufferedElasticWriter
+from .elastic_writer import BufferedElasticWriter, SESSION_BUFFER_SIZE
 
 DEFAULT_TIMEOUT = 360
 
@@ -27,8 +27,7 @@ class ElasticIndexer(BaseIndexer):
         """
         """
         super(self.__class__, self).__init__(use_celery)
-        self.es = Elasticsearch([endpoint], timeout=DEFAULT_TIMEOUT, max_retries=5)
-        self.es.retry_on_timeout = True
+        self.es = getElasticClient(endpoint, timeout=DEFAULT_TIMEOUT, max_retries=5)
         info = self.es.info()
         # print(info)
         self.es_version = int(info["version"]["number"][0])
@@ -77,7 +76,7 @@ class ElasticIndexer(BaseIndexer):
         """
             Returns an IndexWriter object created for the actual_dir specified
         """
-        res = BufferedElasticWriter(actual_dir, self.es)
+        res = BufferedElasticWriter(actual_dir, self.es, bufsize=SESSION_BUFFER_SIZE, session_mode=True)
         return res
 
 
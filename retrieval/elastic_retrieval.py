@@ -9,10 +9,10 @@ from __future__ import print_function
 from __future__ import absolute_import
 import logging, sys
 
-from elasticsearch import Elasticsearch
 from elasticsearch.exceptions import ConnectionError, TransportError
 
 import db.corpora as cp
+from db.elastic_connection import getElasticClient
 from .base_retrieval import BaseRetrieval, SPECIAL_FIELDS_FOR_TESTS, MAX_RESULTS_RECALL
 from .stored_formula import StoredFormula
 from proc.structured_query import StructuredQuery
@@ -23,6 +23,8 @@ import json
 
 ES_TYPE_DOC = "doc"
 QUERY_TIMEOUT = 500  # this is in seconds!
+EXPLAIN_BATCH_SIZE = 500  # max number of documents to explain per search request
+NO_MATCH_EXPLANATION = {"matched": False, "explanation": {"value": 0.0, "description": "no matching term", "details": []}}
 
 
 class ElasticRetrieval(BaseRetrieval):
@@ -39,7 +41,7 @@ class ElasticRetrieval(BaseRetrieval):
             if cp.Corpus.__class__.__name__ == "ElasticCorpus":
                 self.es = cp.Corpus.es
             else:
-                self.es = Elasticsearch(timeout=QUERY_TIMEOUT)
+                self.es = getElasticClient(timeout=QUERY_TIMEOUT)
 
         if not cp.Corpus.isIndexOpen(self.index_name):
             try:
@@ -59,6 +61,9 @@ class ElasticRetrieval(BaseRetrieval):
         self.save_terms = save_terms
         self.default_field = "text"
         self.tie_breaker = 0
+        self.explain_batch_size = EXPLAIN_BATCH_SIZE
+        # optional ExplainCache, see setExplainCache()
+        self.explain_cache = None
         if not multi_match_type:
             self.multi_match_type = "best_fields"
         else:
@@ -306,6 +311,13 @@ class ElasticRetrieval(BaseRetrieval):
             :param doc_id: id of document to run .explain() for
             :returns:
         """
+        if self.explain_cache:
+            explanation = self.explain_cache.get(self.index_name, query["dsl_query"], doc_id)
+            if explanation:
+                formula = StoredFormula()
+                formula.fromElasticExplanation(explanation, self.save_terms)
+                return formula
+
         explanation = None
         retries = 0
         while retries < 1:
@@ -330,9 +342,94 @@ class ElasticRetrieval(BaseRetrieval):
 
         formula = StoredFormula()
         if explanation:
+            if self.explain_cache:
+                self.explain_cache.set(self.index_name, query["dsl_query"], doc_id, explanation)
             formula.fromElasticExplanation(explanation, self.save_terms)
         return formula
 
+    def setExplainCache(self, explain_cache):
+        """
+            Sets an ExplainCache. Explanations are then looked up in it
+            before asking Elasticsearch, and added to it.
+        """
+        self.explain_cache = explain_cache
+
+    def explainDocuments(self, query, doc_ids):
+        """
+            Gets the explanations for a list of documents in a single search
+            request with "explain" on. The ids are applied as a post_filter so
+            they restrict the hits without changing the scores or the
+            structure of the explanations.
+
+            :param query: StructuredQuery dict, with a "dsl_query" key
+            :param doc_ids: list of ids of documents to explain
+            :returns: dict {doc_id: explanation}, in the same format as
+                returned by .explain(). Documents that don't match the query
+                are not in the dict.
+        """
+        res = self.es.search(
+            body={"query": query["dsl_query"],
+                  "post_filter": {"ids": {"values": list(doc_ids)}},
+                  "explain": True,
+                  "_source": False,
+                  },
+            size=len(doc_ids),
+            index=self.index_name,
+            doc_type=ES_TYPE_DOC,
+            request_timeout=QUERY_TIMEOUT,
+        )
+
+        explanations = {}
+        for hit in res["hits"]["hits"]:
+            explanations[hit["_id"]] = {"matched": True, "explanation": hit["_explanation"]}
+        return explanations
+
+    def formulasFromExplanations(self, query, doc_ids):
+        """
+            Same as calling .formulaFromExplanation() for each document, but
+            takes one round trip for every explain_batch_size documents instead
+            of one per document. If a batch fails it falls back to explaining
+            its documents one by one. Explanations already in the
+            explain_cache are not requested again.
+
+            :param query: StructuredQuery dict, with a "dsl_query" key
+            :param doc_ids: list of ids of documents to explain
+            :returns: list of StoredFormula, one for each of doc_ids
+        """
+        explanations = {}
+        if self.explain_cache:
+            explanations = self.explain_cache.getMany(self.index_name, query["dsl_query"], doc_ids)
+
+        to_explain = [doc_id for doc_id in doc_ids if doc_id not in explanations]
+        failed = set()
+        for start in range(0, len(to_explain), self.explain_batch_size):
+            batch = to_explain[start:start + self.explain_batch_size]
+            try:
+                new_explanations = self.explainDocuments(query, batch)
+            except Exception as e:
+                logging.warning("Batch explain failed, explaining documents one by one: %s" % str(e))
+                failed.update(batch)
+                continue
+
+            for doc_id in batch:
+                # a document that doesn't match gets the same formula as
+                # from a non-matching .explain()
+                new_explanations.setdefault(doc_id, NO_MATCH_EXPLANATION)
+            if self.explain_cache:
+                self.explain_cache.setMany(self.index_name, query["dsl_query"], new_explanations)
+            explanations.update(new_explanations)
+
+        formulas = []
+        for doc_id in doc_ids:
+            if doc_id in failed:
+                formulas.append(self.formulaFromExplanation(query, doc_id))
+                continue
+
+            formula = StoredFormula()
+            formula.fromElasticExplanation(explanations[doc_id], self.save_terms)
+            formulas.append(formula)
+        return formulas
+
 
 class ElasticRetrievalBoost(ElasticRetrieval):
     """
@@ -7,8 +7,26 @@
 
 from __future__ import absolute_import
 from .elastic_retrieval import ES_TYPE_DOC
-from elasticsearch.helpers import bulk
-import time, datetime
+from .concurrent_retrieval import callWithRetries, DEFAULT_MAX_RETRIES, DEFAULT_RETRY_BACKOFF, RETRY_STATUS_CODES
+from elasticsearch.helpers import bulk, parallel_bulk
+import time, datetime, logging
+
+DEFAULT_CHUNK_BYTES = 10 * 1024 * 1024
+DEFAULT_THREAD_COUNT = 4
+SESSION_BUFFER_SIZE = 2000  # documents buffered before sending them
+SESSION_CHUNK_SIZE = 500  # max documents per _bulk request
+# key in the index mapping's _meta where the settings to restore are kept
+# while a session is open
+SESSION_META_KEY = "indexing_session_settings"
+
+
+def isRetriableStatus(status):
+    """
+        True if a bulk item failed because of the cluster or the connection
+        rather than the document. Errors that aren't HTTP responses (e.g. a
+        timeout) have a non-numeric status.
+    """
+    return not isinstance(status, int) or status in RETRY_STATUS_CODES
 
 
 class ElasticWriter(object):
@@ -64,17 +82,46 @@ class ElasticWriter(object):
 class BufferedElasticWriter(object):
     """
         Like ElasticWriter but writes out using the bulk API
+
+        With session_mode=True the writer is meant for building a whole index
+        in one go: refresh and replicas are turned off once, on the first
+        flush, documents are sent by several threads in chunks of up to
+        chunk_bytes, only the documents that failed are retried, with
+        backoff, and close() restores the settings, refreshes and force-merges
+        the index once.
+
+        Without session_mode, every flush turns refresh off and on again and
+        force-merges the index, as it always did.
     """
 
-    def __init__(self, index_name, es_instance, bufsize=100):
+    def __init__(self, index_name, es_instance, bufsize=100, session_mode=False, chunk_bytes=DEFAULT_CHUNK_BYTES,
+                 thread_count=DEFAULT_THREAD_COUNT, max_retries=DEFAULT_MAX_RETRIES, backoff=DEFAULT_RETRY_BACKOFF,
+                 max_num_segments=None):
         """
-
+            :param bufsize: documents are sent when this many are buffered
+            :param session_mode: see the class docstring
+            :param chunk_bytes: max size of each _bulk request, session mode
+            :param thread_count: number of parallel _bulk requests, session mode
+            :param max_retries: times a failed document is retried, session mode
+            :param max_num_segments: for the force merge on close, session mode
         """
         self.es = es_instance
         self.index_name = index_name
         self.buffer = []
         self.bufsize = bufsize
 
+        self.session_mode = session_mode
+        self.chunk_bytes = chunk_bytes
+        self.thread_count = thread_count
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_num_segments = max_num_segments
+        self.session_started = False
+        self.saved_settings = None
+        self.num_written = 0
+        self.errors = []
+        self.start_time = None
+
     def createIndex(self, index_name):
         """
             This is done somewhere else in fact
@@ -96,24 +143,157 @@ class BufferedElasticWriter(object):
             ignore_unavailable=True
         )
 
+    def loadSessionRecord(self):
+        """
+            Returns the settings saved in the index by a session that hasn't
+            ended, or None
+        """
+        try:
+            mappings = self.es.indices.get_mapping(index=self.index_name).get(self.index_name, {}).get("mappings", {})
+        except Exception as e:
+            logging.warning("Can't read the mapping of %s: %s" % (self.index_name, e))
+            return None
+        # before ES 7 the mappings are under the doc type
+        meta = mappings.get("_meta") or mappings.get(ES_TYPE_DOC, {}).get("_meta") or {}
+        return meta.get(SESSION_META_KEY)
+
+    def saveSessionRecord(self, settings):
+        """
+            Keeps the settings to restore in the index itself, so that they
+            survive a build that stops without close(). None clears them.
+        """
+        try:
+            self.es.indices.put_mapping(index=self.index_name, doc_type=ES_TYPE_DOC,
+                                        body={"_meta": {SESSION_META_KEY: settings}})
+        except Exception as e:
+            logging.warning("Can't save the session settings of %s: %s" % (self.index_name, e))
+
+    def startSession(self):
+        """
+            Turns off refresh and replicas until close(), remembering their
+            values so they can be restored.
+
+            If an earlier session on this index never ended, its settings are
+            still off: the values it saved in the index are the ones to
+            restore. If those can't be found, the defaults are restored instead.
+        """
+        self.saved_settings = self.loadSessionRecord()
+        if self.saved_settings is None:
+            settings = self.es.indices.get_settings(index=self.index_name)
+            index_settings = settings.get(self.index_name, {}).get("settings", {}).get("index", {})
+            self.saved_settings = {"refresh_interval": index_settings.get("refresh_interval"),
+                                   "number_of_replicas": index_settings.get("number_of_replicas")}
+            if str(self.saved_settings["refresh_interval"]) == "-1":
+                # left like this by a session that didn't end; None resets a
+                # setting to its default
+                logging.warning("Refresh is off in %s, its settings will be reset to the defaults" %
+                                self.index_name)
+                self.saved_settings = {"refresh_interval": None, "number_of_replicas": None}
+            self.saveSessionRecord(self.saved_settings)
+
+        self.es.indices.put_settings(index=self.index_name,
+                                     body={"index": {"refresh_interval": "-1", "number_of_replicas": 0}})
+        self.session_started = True
+        self.start_time = time.time()
+
+    def endSession(self):
+        """
+            Restores the settings changed by startSession(), then refreshes and
+            force-merges the index
+        """
+        # None resets a setting to its default
+        self.es.indices.put_settings(index=self.index_name, body={"index": self.saved_settings})
+        self.saveSessionRecord(None)
+        self.es.indices.refresh(index=self.index_name)
+
+        kwargs = {"index": self.index_name}
+        if self.max_num_segments:
+            kwargs["max_num_segments"] = self.max_num_segments
+        try:
+            callWithRetries(self.es.indices.forcemerge, kwargs=kwargs, max_retries=self.max_retries,
+                            backoff=self.backoff)
+        except Exception as e:
+            print(datetime.datetime.now(), "Exception running forcemerge():", e)
+
+        self.session_started = False
+        took = time.time() - self.start_time
+        print("Indexed %d documents in %s in %.1f s (%.1f docs/s), %d errors" % (
+            self.num_written, self.index_name, took, self.num_written / took if took > 0 else 0, len(self.errors)))
+
+    def makeAction(self, doc):
+        id = doc["metadata"]["guid"]
+        return {
+            '_index': self.index_name,
+            '_type': ES_TYPE_DOC,
+            '_id': id,
+            # '_routing': 5,
+            # 'pipeline': 'my-ingest-pipeline',
+            '_source': doc
+            # {
+            #     "body": doc
+            # }
+        }
+
+    def sendActions(self, actions):
+        """
+            Sends the actions with parallel _bulk requests, returns a list of
+            (action, error info) for those that failed
+        """
+        by_id = {action["_id"]: action for action in actions}
+        failed = []
+        for ok, info in parallel_bulk(self.es, actions,
+                                      thread_count=self.thread_count,
+                                      chunk_size=SESSION_CHUNK_SIZE,
+                                      max_chunk_bytes=self.chunk_bytes,
+                                      raise_on_error=False,
+                                      raise_on_exception=False):
+            if ok:
+                self.num_written += 1
+            else:
+                item = list(info.values())[0]
+                failed.append((by_id.get(item.get("_id")), item))
+        return failed
+
+    def writeSession(self, actions):
+        """
+            Writes the actions, retrying only the documents that failed with
+            a retriable error (busy cluster, connection lost)
+        """
+        failed = self.sendActions(actions)
+
+        retries = 0
+        while failed:
+            retriable = []
+            for action, item in failed:
+                if action is not None and isRetriableStatus(item.get("status")) and retries < self.max_retries:
+                    retriable.append((action, item))
+                else:
+                    logging.warning("Error indexing %s in %s: %s" % (item.get("_id"), self.index_name,
+                                                                     item.get("error")))
+                    self.errors.append(item)
+
+            if not retriable:
+                break
+
+            wait = self.backoff * (2 ** retries)
+            logging.warning("%d documents failed, retrying them in %.1f seconds" % (len(retriable), wait))
+            time.sleep(wait)
+            retries += 1
+            failed = self.sendActions([action for action, item in retriable])
+
     def flushBuffer(self):
-        actions = []
+        actions = [self.makeAction(doc) for doc in self.buffer]
+        self.buffer = []
 
-        self.setIndexRefresh("-1")
+        if self.session_mode:
+            if not actions:
+                return
+            if not self.session_started:
+                self.startSession()
+            self.writeSession(actions)
+            return
 
-        for doc in self.buffer:
-            id = doc["metadata"]["guid"]
-            actions.append({
-                '_index': self.index_name,
-                '_type': ES_TYPE_DOC,
-                '_id': id,
-                # '_routing': 5,
-                # 'pipeline': 'my-ingest-pipeline',
-                '_source': doc
-                # {
-                #     "body": doc
-                # }
-            })
+        self.setIndexRefresh("-1")
 
         success = False
         while not success:
@@ -141,8 +321,6 @@ class BufferedElasticWriter(object):
             print(e)
             time.sleep(5)
 
-        self.buffer = []
-
     def addDocument(self, doc):
         """
             Emulate LuceneIndexWriter.addDocument for elastic
@@ -160,6 +338,8 @@ class BufferedElasticWriter(object):
             Make sure to flush the buffer
         """
         self.flushBuffer()
+        if self.session_started:
+            self.endSession()
 
 
 def main():
@@ -0,0 +1,221 @@
+# Persistent cache of .explain() results
+#
+# Copyright:   (c) Daniel Duma 2018
+# Author: Daniel Duma <danielduma@gmail.com>
+
+# For license information, see LICENSE.TXT
+
+from __future__ import absolute_import
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+DEFAULT_MAX_MEMORY_ITEMS = 100000
+DEFAULT_MAX_DISK_ITEMS = 10000000
+EXPLAIN_CACHE_FILENAME = "explain_cache.sqlite"
+# last_used is only rewritten for rows that weren't used in this long, in
+# seconds. It is only used to pick what to evict, so it needn't be exact
+LAST_USED_UPDATE_INTERVAL = 3600
+
+
+def hashQuery(dsl_query):
+    """
+        Canonical hash of a DSL query: the same query always gives the same
+        hash, regardless of the order of the keys in its dicts
+    """
+    text = json.dumps(dsl_query, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+class ExplainCache(object):
+    """
+        Stores the explanations returned by Elasticsearch, keyed by
+        (index name, hash of the DSL query, document id).
+
+        Recently used explanations are kept in memory, up to max_memory_items,
+        evicting the least recently used ones. If cache_dir is given, all
+        explanations are also stored in an SQLite file there, up to
+        max_disk_items, so other runs and experiments can reuse them.
+
+        The raw explanation is stored, not the StoredFormula, so it doesn't
+        matter if the retrieval model saves terms or not. Thread-safe.
+
+        Note that if an index is rebuilt under the same name, the cache for
+        it must be cleared with .clear(index_name).
+    """
+
+    def __init__(self, cache_dir=None, max_memory_items=DEFAULT_MAX_MEMORY_ITEMS,
+                 max_disk_items=DEFAULT_MAX_DISK_ITEMS):
+        self.max_memory_items = max_memory_items
+        self.max_disk_items = max_disk_items
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        self.db = None
+        if cache_dir:
+            if not os.path.exists(cache_dir):
+                os.makedirs(cache_dir)
+            self.db = sqlite3.connect(os.path.join(cache_dir, EXPLAIN_CACHE_FILENAME), check_same_thread=False)
+            self.db.execute("CREATE TABLE IF NOT EXISTS explanations "
+                            "(key TEXT PRIMARY KEY, index_name TEXT, explanation TEXT, last_used REAL)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS explanations_last_used ON explanations (last_used)")
+            self.db.commit()
+            # upper bound of the number of rows, see _evictFromDisk()
+            self.disk_count = self._countDiskItems()
+
+    @staticmethod
+    def makeKey(index_name, query_hash, doc_id):
+        return "%s|%s|%s" % (index_name, query_hash, doc_id)
+
+    def _rememberInMemory(self, key, explanation):
+        self.memory[key] = explanation
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_memory_items:
+            self.memory.popitem(last=False)
+
+    def getMany(self, index_name, dsl_query, doc_ids):
+        """
+            Returns a dict {doc_id: explanation} with the cached explanations
+            for this query. Documents not in the cache are not in the dict.
+        """
+        query_hash = hashQuery(dsl_query)
+        result = {}
+        missing = []
+        with self.lock:
+            for doc_id in doc_ids:
+                key = self.makeKey(index_name, query_hash, doc_id)
+                if key in self.memory:
+                    self.memory.move_to_end(key)
+                    result[doc_id] = self.memory[key]
+                else:
+                    missing.append((doc_id, key))
+
+            if self.db and missing:
+                now = time.time()
+                to_touch = []
+                # SQLite has a limit on the number of variables per statement
+                for start in range(0, len(missing), 500):
+                    batch = missing[start:start + 500]
+                    keys = [key for doc_id, key in batch]
+                    rows = self.db.execute("SELECT key, explanation, last_used FROM explanations WHERE key IN (%s)" %
+                                           ",".join(["?"] * len(keys)), keys).fetchall()
+                    found = {key: (explanation, last_used) for key, explanation, last_used in rows}
+                    for doc_id, key in batch:
+                        if key in found:
+                            explanation = json.loads(found[key][0])
+                            result[doc_id] = explanation
+                            self._rememberInMemory(key, explanation)
+                    to_touch.extend([key for key, (explanation, last_used) in found.items()
+                                     if (last_used or 0) < now - LAST_USED_UPDATE_INTERVAL])
+                if to_touch:
+                    self.db.executemany("UPDATE explanations SET last_used=? WHERE key=?",
+                                        [(now, key) for key in to_touch])
+                    self.db.commit()
+
+            self.hits += len(result)
+            self.misses += len(doc_ids) - len(result)
+        return result
+
+    def get(self, index_name, dsl_query, doc_id):
+        """
+            Returns the cached explanation or None
+        """
+        return self.getMany(index_name, dsl_query, [doc_id]).get(doc_id)
+
+    def setMany(self, index_name, dsl_query, explanations):
+        """
+            Stores explanations for this query
+
+            :param explanations: dict {doc_id: explanation}
+        """
+        query_hash = hashQuery(dsl_query)
+        now = time.time()
+        rows = []
+        with self.lock:
+            for doc_id, explanation in explanations.items():
+                key = self.makeKey(index_name, query_hash, doc_id)
+                self._rememberInMemory(key, explanation)
+                rows.append((key, index_name, json.dumps(explanation), now))
+
+            if self.db and rows:
+                self.db.executemany("INSERT OR REPLACE INTO explanations VALUES (?, ?, ?, ?)", rows)
+                self.db.commit()
+                # replaced rows are counted too, so this can only overestimate
+                self.disk_count += len(rows)
+                if self.disk_count > self.max_disk_items:
+                    self._evictFromDisk()
+
+    def set(self, index_name, dsl_query, doc_id, explanation):
+        self.setMany(index_name, dsl_query, {doc_id: explanation})
+
+    def _countDiskItems(self):
+        return self.db.execute("SELECT COUNT(*) FROM explanations").fetchone()[0]
+
+    def _evictFromDisk(self):
+        """
+            If over max_disk_items, deletes the least recently used tenth.
+
+            Only called when the running count says so: the table is only
+            counted again here, as it may have fewer rows (replaced keys) or
+            more (other processes using the same file).
+        """
+        self.disk_count = self._countDiskItems()
+        if self.disk_count <= self.max_disk_items:
+            return
+
+        to_delete = self.disk_count - self.max_disk_items + self.max_disk_items // 10
+        cursor = self.db.execute("DELETE FROM explanations WHERE key IN "
+                                 "(SELECT key FROM explanations ORDER BY last_used LIMIT ?)", (to_delete,))
+        self.db.commit()
+        self.disk_count -= cursor.rowcount
+
+    def clear(self, index_name=None):
+        """
+            Deletes all cached explanations, or only those for one index
+        """
+        with self.lock:
+            if index_name is None:
+                self.memory.clear()
+            else:
+                prefix = index_name + "|"
+                for key in [key for key in self.memory if key.startswith(prefix)]:
+                    del self.memory[key]
+
+            if self.db:
+                if index_name is None:
+                    self.db.execute("DELETE FROM explanations")
+                else:
+                    self.db.execute("DELETE FROM explanations WHERE index_name=?", (index_name,))
+                self.db.commit()
+                self.disk_count = self._countDiskItems()
+
+    def close(self):
+        if self.db:
+            self.db.close()
+            self.db = None
+
+
+def createExplainCache(exp):
+    """
+        Returns an ExplainCache configured from the experiment dict, or None if
+        exp["use_explain_cache"] is not set.
+
+        exp["explain_cache_dir"] sets the directory for the on-disk cache,
+        defaulting to <exp_dir>/cache/explain.
+    """
+    if not exp.get("use_explain_cache", False):
+        return None
+
+    cache_dir = exp.get("explain_cache_dir")
+    if not cache_dir and exp.get("exp_dir"):
+        cache_dir = os.path.join(exp["exp_dir"], "cache", "explain")
+
+    return ExplainCache(cache_dir,
+                        max_memory_items=exp.get("explain_cache_memory_items", DEFAULT_MAX_MEMORY_ITEMS),
+                        max_disk_items=exp.get("explain_cache_disk_items", DEFAULT_MAX_DISK_ITEMS))
@@ -117,6 +117,96 @@ def addBOWsToIndex(guid, indexNames, index_max_year, fwriters=None, full_corpus=
             addLoadedBOWsToIndex(fwriters[indexName], guid, bows, index_data, append_fields=append_fields)
 
 
+def loadManyOrEach(load_many, load_one, ids):
+    """
+        Calls load_many(ids). If that fails, loads each id with load_one(),
+        so that one bad record only loses itself. Records that can't be
+        loaded are None.
+    """
+    try:
+        return load_many(ids)
+    except Exception as e:
+        logging.warning("Bulk load failed, loading %d records one by one: %s" % (len(ids), e))
+
+    res = []
+    for id in ids:
+        try:
+            res.append(load_one(id))
+        except Exception:
+            logging.exception("Error loading %s" % id)
+            res.append(None)
+    return res
+
+
+def addBOWsBatchToIndex(guids, indexNames, index_max_year, fwriters):
+    """
+        Batch version of addBOWsToIndex: the metadata and the prebuilt BOWs of
+        all the guids are loaded with one bulk request per index instead of
+        one request each, and nothing is checked against the index.
+
+        An error with one paper doesn't stop the others: like a paper whose
+        BOWs are missing, it is returned as missing.
+
+        :param fwriters: dict of writers (or anything with addDocument()) for
+            each index
+        :returns: list of guids for which some BOW couldn't be loaded or added
+    """
+    missing = []
+    all_meta = loadManyOrEach(cp.Corpus.getMetadataByGUIDs, cp.Corpus.getMetadataByGUID, guids)
+    papers = []
+    for guid, meta in zip(guids, all_meta):
+        if not meta:
+            logging.error("Error: can't load metadata for paper %s" % guid)
+            missing.append(guid)
+            continue
+        try:
+            year = int(meta["year"]) if index_max_year else None
+        except (KeyError, TypeError, ValueError):
+            logging.error("Error: paper %s has no valid year: %r" % (guid, meta.get("year")))
+            missing.append(guid)
+            continue
+        papers.append((guid, meta, year))
+
+    for indexName in indexNames:
+        index_data = indexNames[indexName]
+        append_fields = index_data.get("append_fields", [])
+
+        if index_data["type"] in ["standard_multi", "inlink_context"]:
+            to_load = [guid for guid, meta, year in papers
+                       if not index_max_year or year <= int(index_max_year)]
+            bow_ids = [cp.Corpus.cachedDataIDString("bow", guid, index_data) for guid in to_load]
+            all_bows = loadManyOrEach(cp.Corpus.loadCachedJsonMany, cp.Corpus.loadCachedJson, bow_ids)
+            for guid, bow_filename, bows in zip(to_load, bow_ids, all_bows):
+                if bows is None:
+                    print("ERROR: Couldn't load BOW ", bow_filename)
+                    missing.append(guid)
+                    continue
+                try:
+                    addLoadedBOWsToIndex(fwriters[indexName], guid, bows, dict(index_data),
+                                         append_fields=append_fields)
+                except Exception:
+                    logging.exception("Error adding BOW %s" % bow_filename)
+                    missing.append(guid)
+
+        elif index_data["type"] == "ilc_mashup":
+            for guid, meta, year in papers:
+                try:
+                    bows = doc_representation.mashupBOWinlinkMethods(guid, [guid], index_max_year, index_data,
+                                                                     full_corpus=True)
+                    if not bows:
+                        print("ERROR: Couldn't load prebuilt BOWs for mashup with inlink_context and ",
+                              index_data["method"], ", parameters:", index_data["parameter"],
+                              index_data.get("ilc_parameter", ""))
+                        missing.append(guid)
+                        continue
+                    addLoadedBOWsToIndex(fwriters[indexName], guid, bows, index_data, append_fields=append_fields)
+                except Exception:
+                    logging.exception("Error adding mashup BOWs of %s" % guid)
+                    missing.append(guid)
+
+    return list(dict.fromkeys(missing))
+
+
 # def addOrBuildBOWToIndex(writer, guid, index_data, full_corpus=False, filter_options={},  append_fields=[]):
 #     """
 #         Loads JSON file with BOW data to doc in index, NOT filtering for anything
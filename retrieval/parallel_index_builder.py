@@ -0,0 +1,245 @@
+# Builds the general retrieval indexes with a pool of worker processes
+#
+# Copyright:   (c) Daniel Duma 2018
+# Author: Daniel Duma <danielduma@gmail.com>
+
+# For license information, see LICENSE.TXT
+
+"""
+    The GUIDs are split in batches that a pool of processes turns into index
+    documents: each worker loads the metadata and prebuilt BOWs of a whole
+    batch in bulk. The documents come back to the main process, which writes
+    them with one bulk writer per index, so index settings are only changed
+    once and requests to the index are not multiplied by the number of
+    workers.
+
+    Every few batches the writers are flushed and the GUIDs written so far
+    are appended to a checkpoint file, so a build that is interrupted can be
+    restarted where it stopped. GUIDs whose BOWs couldn't be loaded or whose
+    documents the index rejected are left out of it, so they are tried again.
+"""
+
+from __future__ import print_function
+from __future__ import absolute_import
+import hashlib
+import io
+import json
+import logging
+import multiprocessing
+import os
+import time
+
+import db.corpora as cp
+from retrieval.index_functions import addBOWsBatchToIndex
+
+DEFAULT_BATCH_SIZE = 50
+DEFAULT_CHECKPOINT_EVERY = 20  # batches
+REPORT_EVERY_SECONDS = 30
+
+
+class DocumentCollector(object):
+    """
+        Stands in for an index writer in the worker processes: keeps the
+        documents so they can be sent back to the main process
+    """
+
+    def __init__(self):
+        self.docs = []
+
+    def addDocument(self, doc):
+        self.docs.append(doc)
+
+
+def initWorker():
+    """
+        Each worker needs its own connection to the DB, not the sockets it
+        inherited from the main process
+    """
+    cp.Corpus.connectToDB(suppress_error=True)
+
+
+def buildBatchDocuments(args):
+    """
+        Runs in a worker: returns (guids, {index_name: [documents]}, missing
+        guids) for a batch of guids. If the batch fails as a whole, all its
+        guids are missing, so that the build goes on.
+    """
+    guids, indexNames, index_max_year = args
+    collectors = {indexName: DocumentCollector() for indexName in indexNames}
+    try:
+        missing = addBOWsBatchToIndex(guids, indexNames, index_max_year, collectors)
+    except Exception:
+        logging.exception("Error building the documents of a batch of %d papers" % len(guids))
+        return guids, {}, list(guids)
+    return guids, {indexName: collectors[indexName].docs for indexName in collectors}, missing
+
+
+def getCheckpointPath(checkpoint_dir, indexNames):
+    """
+        Checkpoint file for building this set of indexes
+    """
+    key = hashlib.md5(json.dumps(sorted(indexNames.keys())).encode("utf-8")).hexdigest()[:10]
+    return os.path.join(checkpoint_dir, "index_checkpoint_%s.txt" % key)
+
+
+class ParallelIndexBuilder(object):
+    """
+        Adds the prebuilt BOWs of many papers to the indexes, using
+        num_workers processes to load them
+    """
+
+    def __init__(self, indexNames, fwriters, index_max_year=None, num_workers=None, batch_size=DEFAULT_BATCH_SIZE,
+                 checkpoint_path=None, checkpoint_every=DEFAULT_CHECKPOINT_EVERY):
+        """
+            :param indexNames: a fully expanded dict of doc_methods
+            :param fwriters: dict with a writer for each index
+            :param num_workers: number of processes. With 1, everything runs
+                in this process. Defaults to the number of CPUs.
+            :param checkpoint_path: file where the guids already added are
+                recorded. None disables checkpoints.
+            :param checkpoint_every: flush the writers and save the
+                checkpoint every this many batches
+        """
+        self.indexNames = indexNames
+        self.fwriters = fwriters
+        self.index_max_year = index_max_year
+        self.num_workers = num_workers or multiprocessing.cpu_count()
+        self.batch_size = batch_size
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint_every = checkpoint_every
+
+        self.num_guids = 0
+        self.num_docs = 0
+        self.missing = []
+        self.failed = []
+
+    def loadCheckpoint(self):
+        """
+            Returns the set of guids already added to the indexes
+        """
+        if not self.checkpoint_path or not os.path.exists(self.checkpoint_path):
+            return set()
+        with io.open(self.checkpoint_path, "r", encoding="utf-8") as f:
+            return set([line.strip() for line in f if line.strip()])
+
+    def collectFailed(self):
+        """
+            Takes the errors of the writers that keep them (BufferedElasticWriter
+            in session mode) and returns the set of guids of the documents that
+            failed
+        """
+        failed = set()
+        for writer in self.fwriters.values():
+            errors = getattr(writer, "errors", None)
+            if not errors:
+                continue
+            # documents are indexed with the guid as _id, see makeAction()
+            failed.update([item.get("_id") for item in errors])
+            writer.errors = []
+        self.failed.extend(sorted(failed - set(self.failed)))
+        return failed
+
+    def saveCheckpoint(self, guids):
+        """
+            Flushes the writers, then records the guids as added, except those
+            that any of the writers failed to add
+        """
+        for writer in self.fwriters.values():
+            flush = getattr(writer, "flushBuffer", None) or getattr(writer, "commit", None)
+            if flush:
+                flush()
+
+        failed = self.collectFailed()
+        guids = [guid for guid in guids if guid not in failed]
+
+        if not self.checkpoint_path or not guids:
+            return
+        checkpoint_dir = os.path.dirname(self.checkpoint_path)
+        if checkpoint_dir and not os.path.exists(checkpoint_dir):
+            os.makedirs(checkpoint_dir)
+        with io.open(self.checkpoint_path, "a", encoding="utf-8") as f:
+            for guid in guids:
+                f.write(u"%s\n" % guid)
+
+    def clearCheckpoint(self):
+        if self.checkpoint_path and os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
+
+    def iterBatches(self, guids):
+        for start in range(0, len(guids), self.batch_size):
+            yield (guids[start:start + self.batch_size], self.indexNames, self.index_max_year)
+
+    def reportProgress(self, total, start_time):
+        took = time.time() - start_time
+        print("Indexed %d/%d papers, %d documents in %.0f s: %.1f papers/s, %.1f docs/s" % (
+            self.num_guids, total, self.num_docs, took,
+            self.num_guids / took if took else 0, self.num_docs / took if took else 0))
+
+    def build(self, guids):
+        """
+            Adds all the guids that aren't in the checkpoint to the indexes,
+            then closes the writers
+
+            :returns: list of guids that weren't added: those whose BOWs
+                couldn't be loaded (self.missing) and then those the index
+                rejected (self.failed)
+        """
+        done = self.loadCheckpoint()
+        to_add = [guid for guid in guids if guid not in done]
+        if done:
+            print("Resuming from checkpoint: %d papers already indexed" % (len(guids) - len(to_add)))
+        print("Adding %d papers with %d workers" % (len(to_add), self.num_workers))
+
+        start_time = time.time()
+        last_report = start_time
+        pending = []
+        num_batches = 0
+
+        pool = None
+        if self.num_workers > 1:
+            pool = multiprocessing.Pool(self.num_workers, initializer=initWorker)
+            results = pool.imap_unordered(buildBatchDocuments, self.iterBatches(to_add))
+        else:
+            results = map(buildBatchDocuments, self.iterBatches(to_add))
+
+        try:
+            for batch_guids, docs, missing in results:
+                for indexName in docs:
+                    for doc in docs[indexName]:
+                        self.fwriters[indexName].addDocument(doc)
+                    self.num_docs += len(docs[indexName])
+
+                self.missing.extend(missing)
+                self.num_guids += len(batch_guids)
+                # papers with missing BOWs are tried again when resuming
+                missing = set(missing)
+                pending.extend([guid for guid in batch_guids if guid not in missing])
+                num_batches += 1
+
+                if num_batches % self.checkpoint_every == 0:
+                    self.saveCheckpoint(pending)
+                    pending = []
+
+                if time.time() - last_report >= REPORT_EVERY_SECONDS:
+                    self.reportProgress(len(to_add), start_time)
+                    last_report = time.time()
+
+            self.saveCheckpoint(pending)
+        except BaseException:
+            # don't wait for the batches still queued
+            if pool is not None:
+                pool.terminate()
+            raise
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+            # ends the writers' sessions, restoring the index settings, even
+            # if the build stops
+            for writer in self.fwriters.values():
+                writer.close()
+
+        self.reportProgress(len(to_add), start_time)
+        if self.failed:
+            print("%d papers were rejected by the index, they will be retried when resuming" % len(self.failed))
+        return self.missing + self.failed
@@ -22,6 +22,63 @@ SENTENCE_TYPES = ["s", "fig-caption", "s-li"]
 PARAGRAPH_TYPES = ["p", "footnote", "p-li"]
 SECTION_TYPES = ["section"]
 
+# an author mention may be followed by a year, e.g. "Smith et al., 2005"
+AUTHOR_MENTION_SUFFIX = r"(?:\s*\,?\s*\d+\w?)?"
+rx_author_in_parenthesis = re.compile(r"\(\s*\_\_author\s*\.\)?")
+rx_word_before_citation = re.compile(r"(\w)" + re.escape(CIT_MARKER))
+rx_author_before_year = re.compile(re.escape(AUTHOR_MARKER) + r"\s*\(\d+\w?\)")
+
+# how many texts formatted for extraction each SciDoc keeps
+EXTRACTION_CACHE_SIZE = 100
+
+
+def firstLiteralChar(regex):
+    """
+        Returns the character any match of the regex must start with, or None
+        if it can't be known without parsing it
+    """
+    if regex.startswith(r"\b"):
+        regex = regex[2:]
+    if not regex:
+        return None
+    if regex[0] == "\\":
+        if len(regex) > 1 and not regex[1].isalnum():
+            return regex[1]
+        return None
+    if regex[0] in "()[].^$*+?{|":
+        return None
+    return regex[0]
+
+
+def compileAuthorMentionsRegex(author_strings):
+    """
+        Returns one regex that matches a mention of any of the authors, or
+        None if there are none. Longer alternatives go first, so that "Smith
+        and Jones" is matched whole instead of just "Smith".
+
+        :param author_strings: list of regexes, as in known_author_strings
+    """
+    alternatives = []
+    first_chars = set()
+    for author_regex in sorted(author_strings, key=lambda x: (-len(x), x)):
+        try:
+            re.compile(author_regex)
+        except Exception as e:
+            print(e)
+            continue
+        alternatives.append("(?:%s)" % author_regex)
+        first_chars.add(firstLiteralChar(author_regex))
+
+    if not alternatives:
+        return None
+
+    # the alternatives are only tried where one of them could start, which
+    # is much faster than trying each of them at every position
+    prefix = ""
+    if None not in first_chars:
+        prefix = "(?=[%s])" % "".join([re.escape(char) for char in sorted(first_chars)])
+    return re.compile("%s(?:%s)%s" % (prefix, "|".join(alternatives), AUTHOR_MENTION_SUFFIX))
+
 
 class SciDoc(object):
     """
@@ -73,7 +130,7 @@ class SciDoc(object):
         # global variables to keep track of importing/exporting
         self.glob = {}
         self.ignore_errors = ignore_errors if ignore_errors else []
-        self.known_author_strings = None
+        self.clearExtractionCache()
 
         if data:
             if isinstance(data, six.string_types):
@@ -139,6 +196,16 @@ class SciDoc(object):
             self.abstract = self.allsections[0]
 
         self.updateReferences()
+        self.clearExtractionCache()
+
+    def clearExtractionCache(self):
+        """
+            Forgets the author gazetteer and the texts formatted by
+            formatTextForExtraction(), e.g. after the references have changed
+        """
+        self.known_author_strings = None
+        self.author_mentions_regex = None
+        self.extraction_cache = {}
 
     @property
     def metadata(self):
@@ -506,24 +573,29 @@ class SciDoc(object):
         :return: text ready for extraction
         """
 
-        if not self.known_author_strings:
+        cached = self.extraction_cache.get(text)
+        if cached is not None:
+            return cached
+
+        if self.known_author_strings is None:
             self.prepareGazetteer()
 
+        original_text = text
         # text = re.sub(r"<CIT.+?/>", CIT_MARKER, text)
         text = replaceXMLCitationsWithUnderscoreCitations(text)
         text = cleanXML(text)
 
-        for author_regex in self.known_author_strings:
-            try:
-                text = re.sub(author_regex + "(\s*\,?\s*\d+\w?)?", AUTHOR_MARKER + " ", text)
-                text = re.sub(author_regex + "(\s*\(\d+\w?\))?", AUTHOR_MARKER + " ", text)
-            except Exception as e:
-                print(e)
+        if self.author_mentions_regex:
+            text = self.author_mentions_regex.sub(AUTHOR_MARKER + " ", text)
 
-        text = re.sub("\(\s*\_\_author\s*\.\)?", "( " + AUTHOR_MARKER + " )", text)
-        text = re.sub("(\w)" + re.escape(CIT_MARKER), r"\1 " + CIT_MARKER, text)
-        text = re.sub(re.escape(AUTHOR_MARKER) + "\s*\(\d+\w?\)", AUTHOR_MARKER + " ", text)
+        text = rx_author_in_parenthesis.sub("( " + AUTHOR_MARKER + " )", text)
+        text = rx_word_before_citation.sub(r"\1 " + CIT_MARKER, text)
+        text = rx_author_before_year.sub(AUTHOR_MARKER + " ", text)
         # text = re.sub(re.escape(CIT_MARKER+CIT_MARKER), CIT_MARKER+" "+CIT_MARKER, text)
+
+        if len(self.extraction_cache) >= EXTRACTION_CACHE_SIZE:
+            self.extraction_cache = {}
+        self.extraction_cache[original_text] = text
         return text
 
     def prepareGazetteer(self):
@@ -554,6 +626,7 @@ class SciDoc(object):
 
         inline_ref_mentions = set([ref for ref in inline_ref_mentions if re.search("[A-Z]", ref)])
         self.known_author_strings = list(inline_ref_mentions)
+        self.author_mentions_regex = compileAuthorMentionsRegex(self.known_author_strings)
 
     def countMultiCitations(self, newSent):
         """
@@ -0,0 +1,350 @@
+# Benchmarks for the precomputed formula / weight training code path
+#
+# Copyright:   (c) Daniel Duma 2018
+# Author: Daniel Duma <danielduma@gmail.com>
+
+# For license information, see LICENSE.TXT
+
+"""
+    Times the steps of weight training on synthetic data of realistic shape:
+    11 CoreSC fields, 200 documents per query, 1k-50k queries.
+
+        python -m scripts.benchmark_weight_training benchmark.json -sizes 1000,10000,50000
+
+    Before timing anything, checks that incremental scoring measures the same
+    as scoring every formula through StoredFormula, on a mix of linear and
+    "max of" formulas (-check_only to run just that).
+
+    Results are written as JSON, one entry per (benchmark, size), so runs
+    before and after a change can be compared.
+"""
+
+from __future__ import print_function
+from __future__ import absolute_import
+
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+from retrieval.stored_formula import StoredFormula
+from proc.results_logging import measureScores
+from evaluation.weight_functions import runPrecomputedQuery, CompiledRetrievalResults
+from evaluation.weight_training import WeightTrainer
+
+CORESC_FIELDS = ["Bac", "Con", "Exp", "Goa", "Hyp", "Met", "Mod", "Mot", "Obj", "Obs", "Res"]
+DOCS_PER_QUERY = 200
+TERMS_PER_QUERY = 12
+MAX_DOCS = 500000
+
+# distinct formulas generated; the results reuse them so that 50k queries
+# x 200 documents still fit in memory
+FORMULA_POOL_SIZE = 20000
+
+
+def makeHitExplanation(field, term, doc, qw, idf, freq, field_norm):
+    """
+        One term-in-field explanation, as returned by ES with classic similarity
+    """
+    tf = freq ** 0.5
+    fw = tf * idf * field_norm
+    return {"value": qw * fw,
+            "description": "weight(%s:%s in %d) [PerFieldSimilarity], result of:" % (field, term, doc),
+            "details": [
+                {"value": qw * fw,
+                 "description": "score(doc=%d,freq=%.1f), product of:" % (doc, freq),
+                 "details": [
+                     {"value": qw,
+                      "description": "queryWeight, product of:",
+                      "details": [
+                          {"value": idf,
+                           "description": "idf(docFreq=%d, maxDocs=%d)" % (int(MAX_DOCS / np.exp(idf - 1)), MAX_DOCS),
+                           "details": []},
+                          {"value": qw / idf, "description": "queryNorm", "details": []}]},
+                     {"value": fw,
+                      "description": "fieldWeight in %d, product of:" % doc,
+                      "details": [
+                          {"value": tf, "description": "tf(freq=%.1f), with freq of:" % freq, "details": []},
+                          {"value": idf, "description": "idf(docFreq=1, maxDocs=%d)" % MAX_DOCS, "details": []},
+                          {"value": field_norm, "description": "fieldNorm(doc=%d)" % doc, "details": []}]}
+                 ]}
+            ]}
+
+
+def makeExplanation(rng, doc=0):
+    """
+        Explanation of a bool/should query of TERMS_PER_QUERY terms over the
+        CoreSC fields for a document that matches some of them
+    """
+    details = []
+    for term_num in range(TERMS_PER_QUERY):
+        if rng.random() < 0.5:
+            continue
+        for field in rng.sample(CORESC_FIELDS, rng.randint(1, 4)):
+            details.append(makeHitExplanation(field, "term%d" % term_num, doc,
+                                              qw=rng.uniform(0.01, 0.3),
+                                              idf=rng.uniform(1.0, 12.0),
+                                              freq=float(rng.randint(1, 8)),
+                                              field_norm=rng.choice([0.125, 0.25, 0.5, 1.0])))
+    if not details:
+        details.append(makeHitExplanation(rng.choice(CORESC_FIELDS), "term0", doc, 0.1, 2.0, 1.0, 0.5))
+
+    explanation = {"value": sum([d["value"] for d in details]), "description": "sum of:", "details": details}
+    if rng.random() < 0.5:
+        # coord factor when not all clauses match
+        explanation = {"value": explanation["value"] * 0.5, "description": "product of:",
+                       "details": [explanation, {"value": 0.5, "description": "coord(1/2)", "details": []}]}
+    return {"matched": True, "explanation": explanation}
+
+
+def makeMaxExplanation(rng, explanation):
+    """
+        "max of" a sum explanation and a copy with some of its hits dropped, as
+        a dis_max query gives. With weights >= 0 the first one always wins, so
+        the score is exactly that of the original, linear, explanation.
+    """
+    inner = explanation["explanation"]
+    if inner["description"].startswith("product of"):
+        inner = inner["details"][0]
+    details = inner["details"]
+    weaker = rng.sample(details, max(1, len(details) // 2))
+    weaker = {"value": sum([d["value"] for d in weaker]), "description": "sum of:", "details": weaker}
+    return {"matched": True,
+            "explanation": {"value": inner["value"], "description": "max of:", "details": [inner, weaker]}}
+
+
+def makeFormulaPool(rng, size, max_fraction=0.0):
+    """
+        :param max_fraction: fraction of the formulas that are the "max of" a
+            sum and a part of it instead of a sum, see makeMaxExplanation()
+    """
+    explanations = [makeExplanation(rng, doc) for doc in range(size)]
+    for index in range(int(size * max_fraction)):
+        explanations.append(makeMaxExplanation(rng, explanations[index]))
+    formulas = []
+    for explanation in explanations:
+        formula = StoredFormula()
+        formula.fromElasticExplanation(explanation, save_terms=True)
+        formulas.append(formula.formula)
+    return explanations, formulas
+
+
+def makeRetrievalResults(rng, formula_pool, num_queries, docs_per_query=DOCS_PER_QUERY):
+    """
+        Precomputed retrieval results in the format stored by
+        PrecomputedPipeline, with 1-3 cited documents each
+    """
+    results = []
+    for query_num in range(num_queries):
+        formulas = [{"guid": "doc%d" % doc_num, "formula": rng.choice(formula_pool)}
+                    for doc_num in range(docs_per_query)]
+        num_matches = rng.choice([1, 1, 1, 2, 3])
+        match_guids = ["doc%d" % doc_num for doc_num in rng.sample(range(docs_per_query), num_matches)]
+        results.append({"file_guid": "file%d" % (query_num // 20),
+                        "citation_id": "cit%d" % query_num,
+                        "doc_position": 0,
+                        "query_method": "sentence",
+                        "doc_method": "az_annotated",
+                        "az": rng.choice(CORESC_FIELDS),
+                        "cfc": "",
+                        "csc_type": rng.choice(CORESC_FIELDS),
+                        "match_guids": match_guids,
+                        "citation_multi": num_matches,
+                        "formulas": formulas})
+    return results
+
+
+def timeIt(function, repeats=1):
+    """
+        Returns the best time of `repeats` runs of function(), in seconds
+    """
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        took = time.perf_counter() - start
+        if best is None or took < best:
+            best = took
+    return best
+
+
+class SyntheticWeightTrainer(WeightTrainer):
+    """
+        WeightTrainer that trains on synthetic results instead of loading
+        them from the experiment's result store
+    """
+
+    def __init__(self, exp, options, retrieval_results):
+        super(SyntheticWeightTrainer, self).__init__(exp, options)
+        self.retrieval_results = retrieval_results
+
+    def loadPrecomputedFormulas(self, query_type):
+        return self.retrieval_results
+
+
+def makeTrainingExperiment(compile_formulas=True):
+    return {"name": "benchmark",
+            "exp_dir": "",
+            "queries_classification": "csc_type",
+            "train_weights_for": ["ALL"],
+            "metric": "avg_mrr",
+            "cross_validation_folds": 2,
+            "compile_formulas": compile_formulas,
+            "doc_methods": {
+                "az_annotated": {"type": "annotated_boost",
+                                 "index": "benchmark",
+                                 "parameters": [1],
+                                 "runtime_parameters": {"weights": CORESC_FIELDS}},
+            }}
+
+
+def checkIncrementalScoring(num_queries=300, docs_per_query=50, steps=200, seed=1234):
+    """
+        Follows a random walk of weight changes like the greedy search does and
+        checks that at every step a CompiledRetrievalResults with incremental
+        scoring measures the same as the uncompiled results. Half of the
+        formulas are "max of" formulas that tie exactly with a linear one.
+
+        :returns: number of steps at which the measures differ
+    """
+    rng = random.Random(seed)
+    explanations, formula_pool = makeFormulaPool(rng, docs_per_query * 2, max_fraction=1.0)
+    retrieval_results = makeRetrievalResults(rng, formula_pool, num_queries, docs_per_query)
+    trainer = SyntheticWeightTrainer(makeTrainingExperiment(False), {}, retrieval_results)
+    compiled = CompiledRetrievalResults(retrieval_results)
+    compiled.use_incremental_scoring = True
+
+    weights = {field: 1 for field in CORESC_FIELDS}
+    differences = 0
+    for step in range(steps):
+        for field in rng.sample(CORESC_FIELDS, rng.choice([1, 1, 1, 2])):
+            weights[field] = max(0, weights[field] + rng.choice([-1, 1, 2]))
+
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+            expected = trainer.measurePrecomputedResolution(retrieval_results, "az_annotated", weights)
+            measured = trainer.measurePrecomputedResolution(compiled, "az_annotated", weights)
+        for expected_line, measured_line in zip(expected, measured):
+            for metric in ["avg_mrr", "avg_ndcg", "avg_precision", "avg_rank", "precision_total"]:
+                if not np.isclose(expected_line[metric], measured_line[metric], rtol=1e-12, atol=0):
+                    print("Step %d, weights %s: %s is %r, %r without compiling" % (
+                        step, weights, metric, measured_line[metric], expected_line[metric]))
+                    differences += 1
+                    break
+    return differences
+
+
+def runBenchmarks(sizes, docs_per_query=DOCS_PER_QUERY, repeats=3, seed=1234, max_uncompiled_queries=1000):
+    """
+        Runs all the benchmarks for each number of queries in sizes
+
+        :returns: list of dicts, one per (benchmark, size)
+    """
+    rng = random.Random(seed)
+    explanations, formula_pool = makeFormulaPool(rng, min(FORMULA_POOL_SIZE, max(sizes) * docs_per_query))
+    entries = []
+
+    def addEntry(name, num_queries, items, seconds, **extra):
+        entry = {"benchmark": name,
+                 "num_queries": num_queries,
+                 "docs_per_query": docs_per_query,
+                 "items": items,
+                 "seconds": seconds,
+                 "items_per_second": items / seconds if seconds > 0 else None}
+        entry.update(extra)
+        entries.append(entry)
+        print("%-40s %8s queries %10d items %10.3f s" % (name, num_queries, items, seconds))
+
+    # these don't depend on the number of queries
+    def parseExplanations():
+        for explanation in explanations:
+            StoredFormula().fromElasticExplanation(explanation, save_terms=True)
+
+    addEntry("StoredFormula.fromElasticExplanation", None, len(explanations), timeIt(parseExplanations, repeats))
+
+    weights = {field: rng.randint(0, 5) for field in CORESC_FIELDS}
+
+    def computeScores():
+        for formula in formula_pool:
+            StoredFormula(formula).computeScore(None, weights)
+
+    addEntry("StoredFormula.computeScore", None, len(formula_pool), timeIt(computeScores, repeats))
+
+    for num_queries in sizes:
+        retrieval_results = makeRetrievalResults(rng, formula_pool, num_queries, docs_per_query)
+        sample = retrieval_results[:min(num_queries, 1000)]
+
+        def runQueries():
+            for result in sample:
+                runPrecomputedQuery(result["formulas"], weights)
+
+        addEntry("runPrecomputedQuery", len(sample), len(sample) * docs_per_query, timeIt(runQueries, repeats))
+
+        ranked = [[formula["guid"] for formula in result["formulas"]] for result in retrieval_results]
+
+        def measureAll():
+            for result, guids in zip(retrieval_results, ranked):
+                measureScores(guids, result["match_guids"], {})
+
+        addEntry("measureScores", num_queries, num_queries, timeIt(measureAll, repeats))
+
+        for compile_formulas in [True, False]:
+            if not compile_formulas and num_queries > max_uncompiled_queries:
+                continue
+
+            trainer = SyntheticWeightTrainer(makeTrainingExperiment(compile_formulas), {}, retrieval_results)
+
+            def trainFold():
+                # the trainer reports its progress, which would drown the results
+                with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+                    trainer.dynamicWeightValues(0)
+
+            addEntry("WeightTrainer.dynamicWeightValues", num_queries, num_queries // 2, timeIt(trainFold, 1),
+                     compile_formulas=compile_formulas)
+
+    return entries
+
+
+def getGitCommit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"],
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode("utf-8").strip()
+    except Exception:
+        return None
+
+
+def main(output="benchmark_results.json", sizes="1000,10000,50000", docs_per_query=DOCS_PER_QUERY, repeats=3,
+         seed=1234, max_uncompiled_queries=1000, check_only=False):
+    differences = checkIncrementalScoring(seed=int(seed))
+    if differences:
+        raise ValueError("Incremental scoring measured differently at %d steps" % differences)
+    print("Incremental scoring measures the same as uncompiled scoring")
+    if check_only:
+        return
+
+    sizes = [int(size) for size in str(sizes).split(",")]
+    entries = runBenchmarks(sizes, int(docs_per_query), int(repeats), int(seed), int(max_uncompiled_queries))
+
+    report = {"timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+              "git_commit": getGitCommit(),
+              "python": sys.version.split()[0],
+              "numpy": np.__version__,
+              "platform": platform.platform(),
+              "cpu_count": os.cpu_count(),
+              "seed": int(seed),
+              "results": entries}
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print("Results written to", output)
+
+
+if __name__ == '__main__':
+    import plac
+
+    plac.call(main)
@@ -57,8 +57,7 @@ print("Getting list of papers")
 
 def update_scidocs():
     # manually update /scidocs
-    all_files = c1.listPapers(max_results=100000000)
-    for guid in tqdm(all_files):
+    for guid in tqdm(c1.iterPapers(), desc="Checking scidocs"):
         if not c2.es.exists(index="scidocs", doc_type="scidoc", id=guid):
             print(guid, "missing. Uploading")
             doc = c1.loadSciDoc(guid)
@@ -67,8 +66,7 @@ def update_scidocs():
 
 def update_papers():
     # manually update /papers
-    all_files = c1.listPapers(max_results=100000000)
-    for guid in tqdm(all_files):
+    for guid in tqdm(c1.iterPapers(), desc="Copying papers"):
         meta = c1.getMetadataByGUID(guid)
         c2.addPaper(meta, check_existing=False)
 
@@ -77,8 +75,8 @@ def update_cache_yield(index="cache"):
     # manually update /cache
     total_files = None
 
-    for batch, scroll_size in c1.yieldingUnlimitedQuery(body={"query": {"match_all": {}}}, _source=False,
-                                                        index=index):
+    for batch, scroll_size in c1.scrollQuery(body={"query": {"match_all": {}}}, _source=False,
+                                             index=index, page_size=10000, with_total=True):
         if total_files is None:
             total_files = scroll_size
             pbar = tqdm(range(scroll_size), desc="Uploading cached BOWs")
@@ -98,14 +96,13 @@ def update_cache_bulk():
     total_files = None
 
     print("Getting list from server 1...")
-    all_cached_files = [x["_id"] for x in
-                        c1.unlimitedQuery(body={"query": {"match_all": {}}}, _source=False, index="cache")]
+    all_cached_files = set([x["_id"] for x in
+                            c1.iterateQuery(body={"query": {"match_all": {}}}, _source=False, index="cache",
+                                            page_size=10000)])
     print("Getting list from server 2...")
-    all_uploaded_files = [x["_id"] for x in
-                          c2.unlimitedQuery(body={"query": {"match_all": {}}}, _source=False, index="cache")]
-
-    all_cached_files = set(all_cached_files)
-    all_uploaded_files = set(all_uploaded_files)
+    all_uploaded_files = set([x["_id"] for x in
+                              c2.iterateQuery(body={"query": {"match_all": {}}}, _source=False, index="cache",
+                                              page_size=10000)])
 
     new_files = all_cached_files - all_uploaded_files
 
@@ -140,7 +137,7 @@ def copy_papers():
     total_files = None
 
     print("Getting list of papers...")
-    all_guids = c1.listPapers()
+    all_guids = c1.iterPapers()
     #
     # for guid in all_guids:
     #     res = cp.Corpus.es.get(
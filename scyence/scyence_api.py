@@ -18,7 +18,7 @@ from scyence.scyence_search import search_arxiv
 from flask import Flask, request, Response, send_file, abort
 import logging, os, json
 
-import requests
+from db.elastic_connection import getHTTPSession
 
 # set the project root directory as the static folder, you can set others.
 app = Flask(__name__, static_url_path='')
@@ -128,10 +128,10 @@ def bulkmetadata(papers):
     guids = [p for p in papers.split(",") if p != ""]
     logging.info("Getting bulk metadata for %d guids " % len(guids))
     res = []
-    for guid in guids:
-        meta = cp.Corpus.getMetadataByGUID(guid)
+    for meta in cp.Corpus.getMetadataByGUIDs(guids):
         if not meta:
             res.append({"error": "GUID not found", "error_code": 404})
+            continue
 
         del meta["inlinks"]
         del meta["outlinks"]
@@ -173,5 +173,5 @@ def es_query(index):
     """
     logging.info("es_query received: %s" % request.data)
     logging.info("es_query for index: %s" % index)
-    r = requests.post("http://%s/%s" % (ES_URL, index), data=request.data)
+    r = getHTTPSession().post("http://%s/%s" % (ES_URL, index), data=request.data)
     return Response(r.text, mimetype='application/json')
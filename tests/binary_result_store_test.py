@@ -0,0 +1,148 @@
+# Tests that results saved in the binary format are read back unchanged
+#
+# Copyright:   (c) Daniel Duma 2018
+# Author: Daniel Duma <danielduma@gmail.com>
+
+# For license information, see LICENSE.TXT
+
+from __future__ import absolute_import
+from __future__ import print_function
+import json
+import os
+import random
+import shutil
+import tempfile
+
+import numpy as np
+
+from db.binary_result_store import writeBinaryResults, BinaryResultReader
+from retrieval.compiled_formula import CompiledFormulaSet
+from tests.compiled_formula_test import FIELDS, makeRandomPart, makeRandomWeights
+
+
+def makeHit(rng):
+    """
+        A hit in any of the formats StoredFormula saves:
+        (field, qw, fw), (field, qw, fw, term), (field, qw, fw, tf, docFreq,
+        maxDocs) or (field, qw, fw, tf, docFreq, maxDocs, term)
+    """
+    hit = [rng.choice(FIELDS), rng.uniform(0.01, 0.5), rng.uniform(0.1, 10.0)]
+    arity = rng.choice([3, 4, 6, 7])
+    if arity >= 6:
+        hit.extend([rng.choice([None, rng.randint(1, 9)]), rng.randint(1, 1000), 100000])
+    if arity in [4, 7]:
+        hit.append("term%d" % rng.randint(0, 20))
+    return hit
+
+
+def makeFormula(rng):
+    choice = rng.random()
+    if choice < 0.05:
+        # document that did not match
+        return {"coord": 0, "matches": []}
+    elif choice < 0.1:
+        return {"type": "+", "parts": []}
+    elif choice < 0.4:
+        return {"type": "*", "parts": [{"type": "+", "parts": [makeHit(rng) for _ in range(rng.randint(1, 6))]},
+                                       {"type": "coord", "value": 0.5},
+                                       {"type": "const", "value": rng.uniform(0, 2)}]}
+    return makeRandomPart(rng)
+
+
+def makeResults(rng, num_results):
+    results = []
+    for result_num in range(num_results):
+        result = {"file_guid": "file%d" % result_num,
+                  "citation_id": "cit%d" % result_num,
+                  "query_method": "sentence",
+                  "match_guids": ["doc%d" % rng.randint(0, 9)],
+                  "csc_type": rng.choice(FIELDS)}
+        # results that could not be read have no formulas
+        if rng.random() < 0.9:
+            result["formulas"] = [{"guid": "doc%d" % doc_num, "formula": makeFormula(rng)}
+                                  for doc_num in range(rng.randint(0, 10))]
+        results.append(result)
+    return results
+
+
+def normalised(result):
+    """
+        Tuples are read back as lists, as from JSON
+    """
+    return json.loads(json.dumps(result))
+
+
+def testRoundTrip():
+    """
+        Every result, and every formula in it, is read back as it was saved
+    """
+    rng = random.Random(1234)
+    results = makeResults(rng, 50)
+    res_ids = ["res%d" % index for index in range(len(results))]
+
+    path = tempfile.mkdtemp()
+    try:
+        file_path = os.path.join(path, "prr_test.prrbin")
+        writeBinaryResults(results, file_path, res_ids)
+        reader = BinaryResultReader(file_path)
+
+        assert len(reader) == len(results)
+        assert reader.res_ids == res_ids
+        for index, result in enumerate(results):
+            assert reader[index] == normalised(result)
+        assert list(reader) == [normalised(result) for result in results]
+
+        subset = reader.subset([5, 2, 40])
+        assert subset.res_ids == ["res5", "res2", "res40"]
+        assert list(subset) == [normalised(results[index]) for index in [5, 2, 40]]
+
+        limited = BinaryResultReader(file_path, max_results=10)
+        assert len(limited) == 10
+    finally:
+        shutil.rmtree(path)
+
+
+def testCompileFormulas():
+    """
+        compileFormulas() gives the same scores as compiling the formula dicts
+        of the results, for the whole file and for a subset
+    """
+    rng = random.Random(42)
+    results = makeResults(rng, 50)
+
+    path = tempfile.mkdtemp()
+    try:
+        file_path = os.path.join(path, "prr_test.prrbin")
+        writeBinaryResults(results, file_path)
+        reader = BinaryResultReader(file_path)
+
+        for selection in [reader, reader.subset(list(range(0, 50, 3)))]:
+            selected = list(selection)
+            compiled_results, guids, offsets, formula_set = selection.compileFormulas()
+
+            with_formulas = [result for result in selected if "formulas" in result]
+            assert compiled_results == [{key: result[key] for key in result if key != "formulas"}
+                                        for result in with_formulas]
+            assert guids == [item["guid"] for result in with_formulas for item in result["formulas"]]
+            assert list(offsets) == list(np.cumsum([0] + [len(result["formulas"]) for result in with_formulas]))
+
+            expected_set = CompiledFormulaSet(formula_set.fields)
+            expected_set.addFormulas([item["formula"] for result in with_formulas for item in result["formulas"]])
+            expected_set.compile()
+            assert expected_set.fields == formula_set.fields
+            for _ in range(5):
+                weights = makeRandomWeights(rng)
+                assert np.allclose(formula_set.computeScores(weights), expected_set.computeScores(weights),
+                                   rtol=1e-12, atol=0)
+    finally:
+        shutil.rmtree(path)
+
+
+def main():
+    testRoundTrip()
+    testCompileFormulas()
+    print("All tests passed")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+# Tests that CompiledFormulaSet scores formulas as StoredFormula does
+#
+# Copyright:   (c) Daniel Duma 2018
+# Author: Daniel Duma <danielduma@gmail.com>
+
+# For license information, see LICENSE.TXT
+
+from __future__ import absolute_import
+from __future__ import print_function
+import random
+import shutil
+import tempfile
+
+import numpy as np
+
+from retrieval.stored_formula import StoredFormula
+from retrieval.compiled_formula import CompiledFormulaSet
+
+FIELDS = ["Bac", "Con", "Exp", "Goa", "Hyp", "Met", "Mod"]
+
+
+def makeRandomPart(rng, depth=0, max_depth=4):
+    """
+        Random formula tree with +, *, max, const and coord nodes and hits
+        (field, qw, fw, term) as leaves
+    """
+    if depth >= max_depth or rng.random() < 0.3:
+        choice = rng.random()
+        if choice < 0.1:
+            return {"type": "const", "value": rng.uniform(0.0, 2.0)}
+        elif choice < 0.2:
+            return {"type": "coord", "value": rng.choice([0.25, 0.5, 1.0])}
+        return (rng.choice(FIELDS), rng.uniform(0.01, 0.5), rng.uniform(0.1, 10.0), "term%d" % rng.randint(0, 20))
+
+    operation = rng.choice(["+", "+", "*", "max"])
+    return {"type": operation, "parts": [makeRandomPart(rng, depth + 1, max_depth)
+                                         for _ in range(rng.randint(1, 4))]}
+
+
+def makeRandomWeights(rng):
+    """
+        Random {field: weight}, with some weights at 0 as the weight search
+        tries them
+    """
+    return {field: rng.choice([0, 0.5, 1, 2, 3, rng.uniform(0, 5)]) for field in FIELDS}
+
+
+def makeFormulaSet(formulas):
+    formula_set = CompiledFormulaSet(FIELDS)
+    formula_set.addFormulas(formulas)
+    return formula_set.compile()
+
+
+def storedScores(formulas, weights):
+    return np.array([StoredFormula(formula).computeScore(None, weights) for formula in formulas])
+
+
+def testComputeScoresParity():
+    """
+        computeScores() gives the same scores as StoredFormula.computeScore()
+    """
+    rng = random.Random(1234)
+    formulas = [makeRandomPart(rng) for _ in range(300)]
+    formula_set = makeFormulaSet(formulas)
+    assert len(formula_set) == len(formulas)
+
+    for _ in range(20):
+        weights = makeRandomWeights(rng)
+        assert np.allclose(formula_set.computeScores(weights), storedScores(formulas, weights), rtol=1e-12, atol=0)
+
+    # no weights means every weight is 1
+    assert np.allclose(formula_set.computeScores(), storedScores(formulas, None), rtol=1e-12, atol=0)
+
+
+def testComputeScoreMatrixParity():
+    """
+        Each row of computeScoreMatrix() is the scores for one weight vector,
+        also when the matrix is evaluated in several batches
+    """
+    rng = random.Random(42)
+    formulas = [makeRandomPart(rng) for _ in range(100)]
+    formula_set = makeFormulaSet(formulas)
+    formula_set.max_batch_elements = 1
+
+    list_of_weights = [makeRandomWeights(rng) for _ in range(10)]
+    scores = formula_set.computeScoreMatrix(formula_set.weightMatrix(list_of_weights))
+    assert scores.shape == (len(list_of_weights), len(formulas))
+    for row, weights in zip(scores, list_of_weights):
+        assert np.allclose(row, storedScores(formulas, weights), rtol=1e-12, atol=0)
+
+
+def testLinearDecomposition():
+    """
+        Formulas found to be linear score exactly coefficients . weights + bias
+    """
+    rng = random.Random(7)
+    formulas = [makeRandomPart(rng) for _ in range(300)]
+    formula_set = makeFormulaSet(formulas)
+    linear, coefficients, bias = formula_set.linearDecomposition()
+    assert linear.any() and not linear.all()
+
+    for _ in range(10):
+        weights = makeRandomWeights(rng)
+        expected = storedScores(formulas, weights)
+        computed = coefficients.dot(formula_set.weightVector(weights)) + bias
+        assert np.allclose(computed[linear], expected[linear], rtol=1e-9, atol=1e-12)
+
+
+def testSubsetAndSaveLoad():
+    """
+        A subset scores its formulas as the full set does, and so does a set
+        saved and loaded again
+    """
+    rng = random.Random(99)
+    formulas = [makeRandomPart(rng) for _ in range(100)]
+    formula_set = makeFormulaSet(formulas)
+    weights = makeRandomWeights(rng)
+    expected = storedScores(formulas, weights)
+
+    indices = sorted(rng.sample(range(len(formulas)), 30))
+    subset = formula_set.subset(indices)
+    assert np.allclose(subset.computeScores(weights), expected[indices], rtol=1e-12, atol=0)
+
+    path = tempfile.mkdtemp()
+    try:
+        formula_set.save(path)
+        loaded = CompiledFormulaSet().load(path)
+        assert loaded.fields == formula_set.fields
+        assert np.allclose(loaded.computeScores(weights), expected, rtol=1e-12, atol=0)
+    finally:
+        shutil.rmtree(path)
+
+
+def main():
+    testComputeScoresParity()
+    testComputeScoreMatrixParity()
+    testLinearDecomposition()
+    testSubsetAndSaveLoad()
+    print("All tests passed")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+# Tests that incremental scoring gives the same scores and ranks as scoring
+# from scratch
+#
+# Copyright:   (c) Daniel Duma 2018
+# Author: Daniel Duma <danielduma@gmail.com>
+
+# For license information, see LICENSE.TXT
+
+from __future__ import absolute_import
+from __future__ import print_function
+import random
+
+import numpy as np
+
+from evaluation.weight_functions import IncrementalScorer, CompiledRetrievalResults
+from tests.compiled_formula_test import FIELDS, makeRandomPart, makeFormulaSet
+
+
+def walkWeights(rng, weights):
+    """
+        Next step of a random walk of weights like the greedy weight search
+        does: usually one or two weights change, sometimes many at once
+    """
+    weights = dict(weights)
+    num_changes = rng.choice([1, 1, 1, 2, 2, 5])
+    for field in rng.sample(FIELDS, num_changes):
+        weights[field] = max(0, weights[field] + rng.choice([-1, 1, 2]))
+    return weights
+
+
+def makeHits(rng, num_hits):
+    return [(rng.choice(FIELDS), rng.uniform(0.01, 0.3), rng.uniform(0.5, 20.0), "term%d" % index)
+            for index in range(num_hits)]
+
+
+def makeTyingFormulas(rng):
+    """
+        Formulas that score the same, or nearly, for any weights: a sum, the
+        same sum in another order (same score up to rounding), the "max of" the
+        sum and part of it (always exactly the sum's score) and the sum times a
+        coord of 1
+    """
+    hits = makeHits(rng, rng.randint(2, 8))
+    linear = {"type": "+", "parts": hits}
+    reordered = {"type": "+", "parts": list(reversed(hits))}
+    with_max = {"type": "max", "parts": [linear, {"type": "+", "parts": hits[:len(hits) // 2]}]}
+    with_coord = {"type": "*", "parts": [linear, {"type": "coord", "value": 1.0}]}
+    return [linear, reordered, with_max, with_coord]
+
+
+def makeRetrievalResults(rng, num_queries, docs_per_query):
+    """
+        Precomputed results in which every cited document has other documents
+        tying with it
+    """
+    results = []
+    for query_num in range(num_queries):
+        formulas = []
+        while len(formulas) < docs_per_query:
+            if rng.random() < 0.5:
+                formulas.extend(makeTyingFormulas(rng))
+            else:
+                formulas.append(makeRandomPart(rng))
+        formulas = [{"guid": "doc%d" % index, "formula": formula} for index, formula in enumerate(formulas)]
+        match_guids = ["doc%d" % index for index in rng.sample(range(len(formulas)), rng.choice([1, 1, 2, 3]))]
+        results.append({"file_guid": "file%d" % query_num,
+                        "citation_id": "cit%d" % query_num,
+                        "query_method": rng.choice(["sentence", "window"]),
+                        "match_guids": match_guids,
+                        "formulas": formulas})
+    return results
+
+
+def testIncrementalScorerMatchesFullScoring():
+    """
+        Along a random walk of weights, the incremental scores stay within
+        tieTolerances() of the scores from scratch. Non-linear formulas, and
+        linear ones whose fields all have weight 0, score exactly the same.
+    """
+    rng = random.Random(1234)
+    formulas = [makeRandomPart(rng) for _ in range(500)]
+    formula_set = makeFormulaSet(formulas)
+    scorer = IncrementalScorer(formula_set, max_changed_fields=3, refresh_every=50)
+    assert scorer.linear.any() and not scorer.linear.all()
+
+    weights = {field: 1 for field in FIELDS}
+    for step in range(300):
+        weights = walkWeights(rng, weights)
+        weight_vector = formula_set.weightVector(weights)
+        scores = scorer.computeScores(weight_vector)
+        expected = formula_set.computeScores(weights)
+
+        assert np.all(np.abs(scores - expected) <= scorer.tieTolerances(weight_vector, scores)), step
+        assert np.array_equal(scores[~scorer.linear], expected[~scorer.linear]), step
+
+        inactive = scorer.linear & (scorer.nonzero_coefficients.dot(weight_vector != 0) == 0)
+        assert np.array_equal(scores[inactive], expected[inactive]), step
+
+
+def testIncrementalRanksWithNearTies():
+    """
+        The ranks of the cited documents are exactly the same with incremental
+        scoring as when scoring every formula from scratch, also when other
+        documents tie or nearly tie with them
+    """
+    rng = random.Random(42)
+    retrieval_results = makeRetrievalResults(rng, num_queries=100, docs_per_query=30)
+    compiled = CompiledRetrievalResults(retrieval_results, fields=FIELDS)
+    compiled.use_incremental_scoring = True
+    formula_set = compiled.formula_set
+
+    weights = {field: 1 for field in FIELDS}
+    rescored_steps = 0
+    for step in range(200):
+        weights = walkWeights(rng, weights)
+        weight_vector = formula_set.weightVector(weights)
+
+        scores = compiled.computeScoreMatrix(weight_vector)
+        expected = formula_set.computeScoreMatrix(weight_vector)
+        assert np.array_equal(compiled.computeMatchRanks(scores), compiled.computeMatchRanks(expected)), step
+
+        incremental = compiled.incremental_scorer.scores
+        tolerances = compiled.incremental_scorer.tieTolerances(weight_vector, incremental)
+        if len(compiled.findNearTies(incremental, tolerances)) > 0:
+            rescored_steps += 1
+
+    # the test is only meaningful if there were ties to break
+    assert rescored_steps > 0
+
+
+def main():
+    testIncrementalScorerMatchesFullScoring()
+    testIncrementalRanksWithNearTies()
+    print("All tests passed")
+
+
+if __name__ == '__main__':
+    main()
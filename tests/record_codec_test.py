@@ -0,0 +1,142 @@
+# Tests that records encoded with any codec decode to the same data
+#
+# Copyright:   (c) Daniel Duma 2018
+# Author: Daniel Duma <danielduma@gmail.com>
+
+# For license information, see LICENSE.TXT
+
+from __future__ import absolute_import
+from __future__ import print_function
+import json
+import shutil
+import tempfile
+
+import six
+
+from db.record_codec import (availableCodecs, checkCodec, encodeRecord, encodeRecordBytes, decodeRecord,
+                             CODECS, CODEC_JSON, CODEC_ZLIB_JSON, DEFAULT_CODEC)
+
+RECORDS = [
+    {},
+    [],
+    "",
+    {"metadata": {"guid": "abc", "title": u"Café – 中文", "year": 2012},
+     "content": [{"id": "s1", "text": "Some text ~ with a tilde", "weights": [0.5, 1e-300, -3]}],
+     "flags": [True, False, None]},
+    [{"field": "Bac", "count": index, "weight": index / 7.0} for index in range(1000)],
+]
+
+
+def testDefaultIsPlainJson():
+    """
+        Records are saved as plain JSON unless a codec is chosen
+    """
+    assert DEFAULT_CODEC == CODEC_JSON
+    assert json.loads(encodeRecord(RECORDS[3])) == RECORDS[3]
+    assert json.loads(encodeRecordBytes(RECORDS[3]).decode("utf-8")) == RECORDS[3]
+
+
+def testRoundTrip():
+    """
+        Every available codec decodes what it encodes, both as text and as
+        bytes
+    """
+    assert CODEC_JSON in availableCodecs()
+    assert CODEC_ZLIB_JSON in availableCodecs()
+    for codec in availableCodecs():
+        checkCodec(codec)
+        for record in RECORDS:
+            encoded = encodeRecord(record, codec)
+            assert isinstance(encoded, six.string_types)
+            assert decodeRecord(encoded) == record, codec
+
+            encoded_bytes = encodeRecordBytes(record, codec)
+            assert isinstance(encoded_bytes, six.binary_type)
+            assert decodeRecord(encoded_bytes) == record, codec
+
+
+def testLegacyJson():
+    """
+        JSON saved before codecs existed still loads
+    """
+    for record in RECORDS:
+        assert decodeRecord(json.dumps(record)) == record
+        assert decodeRecord(json.dumps(record).encode("utf-8")) == record
+        assert decodeRecord(json.dumps(record, indent=3)) == record
+
+
+def testCompressedRecordsAreSmaller():
+    compressed = encodeRecordBytes(RECORDS[4], CODEC_ZLIB_JSON)
+    assert compressed.startswith(b"~" + CODEC_ZLIB_JSON.encode("ascii") + b":")
+    assert len(compressed) < len(encodeRecordBytes(RECORDS[4], CODEC_JSON)) / 2
+
+
+def testUnknownAndUnavailableCodecs():
+    for call in [lambda: checkCodec("nope"),
+                 lambda: encodeRecord({}, "nope"),
+                 lambda: decodeRecord("~nope:abcd")]:
+        try:
+            call()
+        except ValueError:
+            pass
+        else:
+            assert False, "Unknown codec accepted"
+
+    for codec in CODECS:
+        if codec in availableCodecs():
+            continue
+        try:
+            checkCodec(codec)
+        except ImportError:
+            pass
+        else:
+            assert False, "Codec %s accepted without its packages" % codec
+
+
+def testLocalCorpusMixedCodecs():
+    """
+        Records saved by a LocalCorpus with different codecs all load, whatever
+        the current codec is
+    """
+    from db.local_corpus import LocalCorpus
+
+    path = tempfile.mkdtemp()
+    corpus = LocalCorpus()
+    try:
+        corpus.connectCorpus(path, initializing_corpus=True)
+        assert corpus.record_codec == CODEC_JSON
+
+        for codec in availableCodecs():
+            corpus.setRecordCodec(codec)
+            corpus.saveCachedJson("record_" + codec, RECORDS[3])
+
+        corpus.setRecordCodec(CODEC_JSON)
+        for codec in availableCodecs():
+            assert corpus.loadCachedJson("record_" + codec) == RECORDS[3]
+        assert corpus.loadCachedJsonMany(["record_" + codec for codec in availableCodecs()] + ["missing"]) == \
+            [RECORDS[3]] * len(availableCodecs()) + [None]
+
+        try:
+            corpus.setRecordCodec("nope")
+        except ValueError:
+            pass
+        else:
+            assert False, "Unknown codec accepted"
+    finally:
+        if corpus.globalDBconn is not None:
+            corpus.globalDBconn.close()
+        shutil.rmtree(path)
+
+
+def main():
+    testDefaultIsPlainJson()
+    testRoundTrip()
+    testLegacyJson()
+    testCompressedRecordsAreSmaller()
+    testUnknownAndUnavailableCodecs()
+    testLocalCorpusMixedCodecs()
+    print("All tests passed")
+
+
+if __name__ == '__main__':
+    main()
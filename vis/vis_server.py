@@ -18,7 +18,7 @@ from multi.config import set_config
 from flask import Flask, request, Response, send_file, abort
 import logging, os, json
 
-import requests
+from db.elastic_connection import getHTTPSession
 
 # set the project root directory as the static folder, you can set others.
 app = Flask(__name__, static_url_path='')
@@ -89,10 +89,10 @@ def bulkmetadata(papers):
     guids = [p for p in papers.split(",") if p != ""]
     logging.info("Getting bulk metadata for %d guids " % len(guids))
     res = []
-    for guid in guids:
-        meta = cp.Corpus.getMetadataByGUID(guid)
+    for meta in cp.Corpus.getMetadataByGUIDs(guids):
         if not meta:
             res.append({"error": "GUID not found", "error_code": 404})
+            continue
 
         del meta["inlinks"]
         del meta["outlinks"]
@@ -123,8 +123,15 @@ def getgraph(paper_id):
     if not meta:
         return json.dumps({"error": "GUID not found", "error_code": 404})
 
+    res = {"metadata": meta}
+    if cp.Corpus.citation_graph is not None:
+        graph = cp.Corpus.citation_graph
+        res["inlinks"] = graph.inlinks(meta["guid"])
+        res["outlinks"] = graph.outlinks(meta["guid"])
+        res["cocited"] = graph.coCitations(meta["guid"], max_results=20)
+
     ##    bows=cp.Corpus.SQLQuery("select ID from cache where ID like \"bow_{}_%\" ".format(meta["guid"]))
-    return json.dumps({"metadata": meta})
+    return json.dumps(res)
 
 
 @app.route('/es_query/<path:index>', methods=["POST"])
@@ -134,7 +141,7 @@ def es_query(index):
     """
     logging.info("es_query received: %s" % request.data)
     logging.info("es_query for index: %s" % index)
-    r = requests.post("http://%s/%s" % (ES_URL, index), data=request.data)
+    r = getHTTPSession().post("http://%s/%s" % (ES_URL, index), data=request.data)
     return Response(r.text, mimetype='application/json')
 
 
@@ -146,17 +153,22 @@ if __name__ == "__main__":
     import sys, getopt
 
     port = 8080
+    graph_path = None
 
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "d:p:", ["dir=", "port="])
+        opts, args = getopt.getopt(sys.argv[1:], "d:p:g:", ["dir=", "port=", "graph="])
     except getopt.GetoptError:
-        print('vis_server.py -p <port>')
+        print('vis_server.py -p <port> -g <citation graph dir>')
         sys.exit(2)
     for opt, arg in opts:
         if opt in ("-p", "--port"):
             port = int(arg)
+        elif opt in ("-g", "--graph"):
+            graph_path = arg
 
     cp.Corpus.connectCorpus("", endpoint=ES_URL)
+    if graph_path:
+        cp.Corpus.loadCitationGraph(graph_path)
     # getmetadata("a81ff731-0c6d-4b59-905d-fa8c1aab9c5e")
 
     print("Starting serving on port %s" % port)